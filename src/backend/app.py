@@ -1,505 +1,3839 @@
-from flask import Flask, request, jsonify
-from flask_cors import CORS
-import json
-import os
-import uuid
-from datetime import datetime
-import boto3
-from botocore.client import Config
-from dotenv import load_dotenv
-
-# ======================
-# init
-# ======================
-load_dotenv()
-
-app = Flask(__name__)
-CORS(app, origins=["http://localhost:5173"])
-
-USERS_FILE = "users.json"
-IMAGES_FILE = "images.json"
-ALBUMS_FILE = "albums.json"
-
-USER_PREFIX = "user/"
-GUEST_FILE = "guest_uploads.json"
-
-# ======================
-# S3 (Yandex Object Storage)
-# ======================
-S3_ENDPOINT = "https://storage.yandexcloud.net"
-S3_BUCKET = "pixo-images"
-
-S3_ACCESS_KEY = os.getenv("S3_ACCESS_KEY")
-S3_SECRET_KEY = os.getenv("S3_SECRET_KEY")
-
-s3 = boto3.client(
-    "s3",
-    endpoint_url=S3_ENDPOINT,
-    aws_access_key_id=S3_ACCESS_KEY,
-    aws_secret_access_key=S3_SECRET_KEY,
-    config=Config(signature_version="s3v4"),
-)
-
-# ======================
-# upload limits
-# ======================
-MAX_SIZE_BYTES = 5 * 1024 * 1024  # 5MB
-GUEST_PREFIX = "guest/"
-
-
-# ======================
-# utils
-# ======================
-def load_users():
-    if not os.path.exists(USERS_FILE):
-        return []
-    with open(USERS_FILE, "r", encoding="utf-8") as f:
-        try:
-            return json.load(f)
-        except json.JSONDecodeError:
-            return []
-
-
-def save_users(users):
-    with open(USERS_FILE, "w", encoding="utf-8") as f:
-        json.dump(users, f, ensure_ascii=False, indent=2)
-
-
-def load_guests():
-    if not os.path.exists(GUEST_FILE):
-        return {}
-    with open(GUEST_FILE, "r", encoding="utf-8") as f:
-        try:
-            data = json.load(f)
-            return data if isinstance(data, dict) else {}
-        except json.JSONDecodeError:
-            return {}
-
-
-def save_guests(data: dict):
-    with open(GUEST_FILE, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
-
-
-def get_or_create_guest_id():
-    guest_id = request.cookies.get("guest_id")
-    if not guest_id:
-        guest_id = str(uuid.uuid4())
-    return guest_id
-
-
-def load_images():
-    if not os.path.exists(IMAGES_FILE):
-        return []
-    with open(IMAGES_FILE, "r", encoding="utf-8") as f:
-        try:
-            data = json.load(f)
-            return data if isinstance(data, list) else []
-        except json.JSONDecodeError:
-            return []
-
-
-def save_images(images):
-    with open(IMAGES_FILE, "w", encoding="utf-8") as f:
-        json.dump(images, f, ensure_ascii=False, indent=2)
-
-
-def load_albums():
-    if not os.path.exists(ALBUMS_FILE):
-        return []
-    with open(ALBUMS_FILE, "r", encoding="utf-8") as f:
-        try:
-            data = json.load(f)
-            return data if isinstance(data, list) else []
-        except json.JSONDecodeError:
-            return []
-
-
-def save_albums(albums):
-    with open(ALBUMS_FILE, "w", encoding="utf-8") as f:
-        json.dump(albums, f, ensure_ascii=False, indent=2)
-
-
-# ======================
-# auth
-# ======================
-@app.route("/api/sign-up", methods=["POST"])
-def sign_up():
-    data = request.get_json() or {}
-    email = data.get("email")
-    password = data.get("password")
-
-    if not email or not password:
-        return jsonify({"error": "email_or_password_missing"}), 400
-
-    users = load_users()
-
-    if any(u.get("email") == email for u in users):
-        return jsonify({"error": "user_exists"}), 400
-
-    user = {
-        "id": str(uuid.uuid4()),
-        "email": email,
-        "password": password, 
-        "created_at": datetime.utcnow().isoformat()
-    }
-
-    users.append(user)
-    save_users(users)
-
-    return jsonify({
-        "message": "registered",
-        "user": {"id": user["id"], "email": user["email"]}
-    }), 201
-
-
-@app.route("/api/sign-in", methods=["POST"])
-def sign_in():
-    data = request.get_json() or {}
-    email = data.get("email")
-    password = data.get("password")
-
-    if not email or not password:
-        return jsonify({"error": "email_or_password_missing"}), 400
-
-    users = load_users()
-    user = next((u for u in users if u.get("email") == email), None)
-
-    if user is None:
-        return jsonify({"error": "user_not_found"}), 400
-
-    if user.get("password") != password:
-        return jsonify({"error": "wrong_password"}), 400
-
-    return jsonify({
-        "message": "ok",
-        "user": {"id": user["id"], "email": user["email"]}
-    }), 200
-
-
-# ======================
-# system
-# ======================
-@app.route("/api/ping", methods=["GET"])
-def ping():
-    return jsonify({"status": "ok"})
-
-
-# ======================
-# guest upload
-# ======================
-@app.route("/api/upload-guest", methods=["POST"])
-def upload_guest():
-    guests = load_guests()
-    guest_id = get_or_create_guest_id()
-
-    if "file" not in request.files:
-        return jsonify({"error": "no_file"}), 400
-
-    file = request.files["file"]
-    if not file.filename:
-        return jsonify({"error": "empty_filename"}), 400
-
-    title = request.form.get("title") or file.filename
-
-    # только изображения
-    if not (file.mimetype or "").startswith("image/"):
-        return jsonify({"error": "only_images_allowed"}), 400
-
-    # проверка размера (5MB)
-    file.seek(0, os.SEEK_END)
-    size = file.tell()
-    file.seek(0)
-
-    if size > MAX_SIZE_BYTES:
-        return jsonify({"error": "file_too_large"}), 400
-
-    # если у гостя было предыдущее фото — удаляем из S3
-    old_key = None
-    if guest_id in guests and isinstance(guests[guest_id], dict):
-        old_key = guests[guest_id].get("key")
-
-    if old_key:
-        try:
-            s3.delete_object(Bucket=S3_BUCKET, Key=old_key)
-        except Exception:
-            pass
-
-    ext = os.path.splitext(file.filename)[1].lower()
-    key = f"{GUEST_PREFIX}{uuid.uuid4()}{ext}"
-
-    s3.upload_fileobj(
-        file,
-        S3_BUCKET,
-        key,
-        ExtraArgs={"ContentType": file.mimetype}
-    )
-
-    guests[guest_id] = {
-        "key": key,
-        "title": title,
-        "uploaded_at": datetime.utcnow().isoformat()
-    }
-    save_guests(guests)
-
-    public_url = f"{S3_ENDPOINT}/{S3_BUCKET}/{key}"
-
-    resp = jsonify({
-        "message": "uploaded",
-        "guest_id": guest_id,
-        "key": key,
-        "url": public_url,
-        "title": title
-    })
-
-    # cookie живёт сутки
-    resp.set_cookie(
-        "guest_id",
-        guest_id,
-        max_age=60 * 60 * 24,
-        httponly=True,
-        samesite="Lax"
-    )
-
-    return resp, 201
-
-
-# ======================
-# user upload
-# ======================
-@app.route("/api/upload-user", methods=["POST"])
-def upload_user():
-    user_id = request.form.get("user_id")
-    if not user_id:
-        return jsonify({"error": "user_id_missing"}), 400
-
-    if "file" not in request.files:
-        return jsonify({"error": "no_file"}), 400
-
-    file = request.files["file"]
-    if not file.filename:
-        return jsonify({"error": "empty_filename"}), 400
-
-    if not (file.mimetype or "").startswith("image/"):
-        return jsonify({"error": "only_images_allowed"}), 400
-
-    # 5MB лимит
-    file.seek(0, os.SEEK_END)
-    size = file.tell()
-    file.seek(0)
-    if size > MAX_SIZE_BYTES:
-        return jsonify({"error": "file_too_large"}), 400
-
-    title = request.form.get("title") or file.filename
-
-    ext = os.path.splitext(file.filename)[1].lower()
-    image_id = str(uuid.uuid4())
-    key = f"{USER_PREFIX}{user_id}/{image_id}{ext}"
-
-    s3.upload_fileobj(
-        file,
-        S3_BUCKET,
-        key,
-        ExtraArgs={"ContentType": file.mimetype}
-    )
-
-    url = f"{S3_ENDPOINT}/{S3_BUCKET}/{key}"
-
-    images = load_images()
-    record = {
-        "id": image_id,
-        "user_id": user_id,
-        "title": title,
-        "album_id": None,  #для альбомов
-        "key": key,
-        "url": url,
-        "created_at": datetime.utcnow().isoformat()
-    }
-    images.append(record)
-    save_images(images)
-
-    return jsonify({"message": "uploaded", "image": record}), 201
-
-
-# ======================
-# gallery / image
-# ======================
-@app.route("/api/gallery/<user_id>", methods=["GET"])
-def gallery(user_id):
-    images = load_images()
-    user_images = [img for img in images if img.get("user_id") == user_id]
-    user_images.sort(key=lambda x: x.get("created_at", ""), reverse=True)
-    return jsonify({"images": user_images}), 200
-
-
-@app.route("/api/image/<image_id>", methods=["GET"])
-def get_image(image_id):
-    images = load_images()
-    img = next((x for x in images if x.get("id") == image_id), None)
-    if not img:
-        return jsonify({"error": "not_found"}), 404
-    return jsonify({"image": img}), 200
-
-
-# ======================
-# albums
-# ======================
-@app.route("/api/albums", methods=["POST"])
-def create_album():
-    data = request.get_json() or {}
-    user_id = data.get("user_id")
-    title = (data.get("title") or "").strip()
-
-    if not user_id or not title:
-        return jsonify({"error": "user_id_or_title_missing"}), 400
-
-    albums = load_albums()
-    album = {
-        "id": str(uuid.uuid4()),
-        "user_id": user_id,
-        "title": title,
-        "created_at": datetime.utcnow().isoformat()
-    }
-    albums.append(album)
-    save_albums(albums)
-
-    return jsonify({"album": album}), 201
-
-
-@app.route("/api/albums/<user_id>", methods=["GET"])
-def list_albums(user_id):
-    albums = load_albums()
-    user_albums = [a for a in albums if a.get("user_id") == user_id]
-    user_albums.sort(key=lambda x: x.get("created_at", ""), reverse=True)
-    return jsonify({"albums": user_albums}), 200
-
-
-#страница конкретного альбома (AlbumPage)
-@app.route("/api/album/<album_id>", methods=["GET"])
-def get_album(album_id):
-    albums = load_albums()
-    album = next((a for a in albums if a.get("id") == album_id), None)
-    if not album:
-        return jsonify({"error": "album_not_found"}), 404
-
-    images = load_images()
-    album_images = [img for img in images if img.get("album_id") == album_id]
-    album_images.sort(key=lambda x: x.get("created_at", ""), reverse=True)
-
-    return jsonify({"album": album, "images": album_images}), 200
-
-
-@app.route("/api/image/<image_id>/set-album", methods=["POST"])
-def set_image_album(image_id):
-    data = request.get_json() or {}
-    user_id = data.get("user_id")
-    album_id = data.get("album_id")  # может быть "" / None
-
-    if not user_id:
-        return jsonify({"error": "user_id_missing"}), 400
-
-    images = load_images()
-    img = next((x for x in images if x.get("id") == image_id), None)
-    if not img:
-        return jsonify({"error": "not_found"}), 404
-
-    # фото должно принадлежать пользователю
-    if img.get("user_id") != user_id:
-        return jsonify({"error": "forbidden"}), 403
-
-    # если album_id указан — проверим альбом
-    if album_id:
-        albums = load_albums()
-        alb = next((a for a in albums if a.get("id") == album_id), None)
-        if not alb or alb.get("user_id") != user_id:
-            return jsonify({"error": "album_not_found"}), 404
-        img["album_id"] = album_id
-    else:
-        img["album_id"] = None
-
-    save_images(images)
-    return jsonify({"message": "ok", "image": img}), 200
-
-# ======================
-# profile / settings
-# ======================
-
-@app.route("/api/user/<user_id>", methods=["GET"])
-def get_user(user_id):
-    users = load_users()
-    u = next((x for x in users if x.get("id") == user_id), None)
-    if not u:
-        return jsonify({"error": "user_not_found"}), 404
-
-    return jsonify({
-        "user": {
-            "id": u.get("id"),
-            "email": u.get("email"),
-            "username": u.get("username", ""),
-            "lang": u.get("lang", "ru"),
-            "created_at": u.get("created_at")
-        }
-    }), 200
-
-
-@app.route("/api/user/<user_id>/update", methods=["POST"])
-def update_user(user_id):
-    data = request.get_json() or {}
-    email = (data.get("email") or "").strip()
-    username = (data.get("username") or "").strip()
-    lang = (data.get("lang") or "ru").strip()
-
-    users = load_users()
-    u = next((x for x in users if x.get("id") == user_id), None)
-    if not u:
-        return jsonify({"error": "user_not_found"}), 404
-
-    # если меняем email — проверим уникальность
-    if email and email != u.get("email"):
-        if any(x.get("email") == email for x in users):
-            return jsonify({"error": "email_taken"}), 400
-        u["email"] = email
-
-    # остальные поля
-    u["username"] = username
-    u["lang"] = lang
-
-    save_users(users)
-
-    return jsonify({
-        "message": "ok",
-        "user": {
-            "id": u.get("id"),
-            "email": u.get("email"),
-            "username": u.get("username", ""),
-            "lang": u.get("lang", "ru")
-        }
-    }), 200
-
-
-@app.route("/api/user/<user_id>/change-password", methods=["POST"])
-def change_password(user_id):
-    data = request.get_json() or {}
-    old_password = data.get("old_password") or ""
-    new_password = data.get("new_password") or ""
-
-    if not old_password or not new_password:
-        return jsonify({"error": "old_or_new_missing"}), 400
-
-    users = load_users()
-    u = next((x for x in users if x.get("id") == user_id), None)
-    if not u:
-        return jsonify({"error": "user_not_found"}), 404
-
-    if u.get("password") != old_password:
-        return jsonify({"error": "wrong_old_password"}), 400
-
-    u["password"] = new_password
-    save_users(users)
-
-    return jsonify({"message": "ok"}), 200
-
-
-# ======================
-if __name__ == "__main__":
-    app.run(port=5000, debug=True)
+from flask import Flask, Request, g, request, jsonify, has_request_context, send_file
+from flask_cors import CORS
+import base64
+import bisect
+import contextvars
+import gzip
+import hashlib
+import heapq
+import hmac
+import importlib.util
+import io
+import itertools
+import json
+import os
+import random
+import secrets
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import wraps
+from datetime import datetime, timedelta, timezone
+from dotenv import load_dotenv
+from urllib.parse import quote
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.security import safe_join
+
+try:
+    import fcntl
+except ImportError:  # Windows: блокировка только между потоками одного процесса
+    fcntl = None
+
+# Pillow, orjson и brotli (как и cProfile, multiprocessing, sqlite3)
+# импортируются там, где нужны; при импорте app — только проверка, что
+# они установлены: их импорт платил бы каждый воркер и процесс пула превью
+HAS_PILLOW = importlib.util.find_spec("PIL") is not None  # без Pillow превью не строятся
+HAS_ORJSON = importlib.util.find_spec("orjson") is not None  # без orjson — стандартный json
+HAS_BROTLI = importlib.util.find_spec("brotli") is not None  # без brotli клиенты получают gzip
+
+# ======================
+# init
+# ======================
+load_dotenv()
+
+app = Flask(__name__)
+CORS(app, origins=["http://localhost:5173"])
+
+USERS_FILE = "users.json"
+IMAGES_FILE = "images.json"
+ALBUMS_FILE = "albums.json"
+
+USER_PREFIX = "user/"
+GUEST_FILE = "guest_uploads.json"
+BLOBS_FILE = "blobs.json"  # sha256 содержимого -> объект в бакете и число ссылок
+
+# ======================
+# S3 (Yandex Object Storage)
+# ======================
+S3_ENDPOINT = "https://storage.yandexcloud.net"
+S3_BUCKET = "pixo-images"
+
+S3_ACCESS_KEY = os.getenv("S3_ACCESS_KEY")
+S3_SECRET_KEY = os.getenv("S3_SECRET_KEY")
+
+# s3    — Yandex Object Storage (boto3)
+# local — каталог на диске, объекты отдаёт сам Flask по /objects/<key>
+#         (on-prem узлы, бенчмарки, тесты без сети)
+OBJECT_STORE = os.getenv("PIXO_OBJECT_STORE", "s3")
+LOCAL_STORE_DIR = os.getenv("PIXO_LOCAL_STORE", "object_store")
+LOCAL_STORE_URL = os.getenv("PIXO_LOCAL_STORE_URL", "http://localhost:5000/objects")
+LOCAL_STORE_MAX_AGE = 60 * 60
+
+
+def s3_client():
+    # boto3/botocore импортируются только здесь: импорт и сборка клиента —
+    # это сотни миллисекунд и десятки МБ на каждый воркер и каждый тест
+    import boto3
+    from botocore.client import Config
+
+    return boto3.client(
+        "s3",
+        endpoint_url=S3_ENDPOINT,
+        aws_access_key_id=S3_ACCESS_KEY,
+        aws_secret_access_key=S3_SECRET_KEY,
+        config=Config(signature_version="s3v4"),
+    )
+
+
+class LazyClient:
+    """Клиент boto3, который строится при первом обращении — заново в каждом процессе после fork."""
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._client = None
+        self._pid = None
+        self._guard = threading.Lock()
+
+    def get(self):
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._guard:
+                if self._pid != pid:
+                    self._client = self._factory()
+                    self._pid = pid
+        return self._client
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+
+# ======================
+# object store (локальный диск)
+# ======================
+# LocalObjectStore повторяет ту часть интерфейса клиента boto3, которой
+# пользуется app.py, поэтому код загрузок не знает, куда пишет. Bucket
+# игнорируется (каталог — один бакет), Content-Type лежит рядом в
+# <каталог>/.meta/<ключ>.json. Запись атомарная: временный файл + os.replace.
+LOCAL_META_DIR = ".meta"
+
+
+class ObjectNotFound(Exception):
+    pass
+
+
+class LocalObjectStore:
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+
+    def path(self, key):
+        if not key or key.split("/", 1)[0] == LOCAL_META_DIR:
+            raise ObjectNotFound(key)
+        path = safe_join(self.root, key)
+        if path is None:
+            raise ObjectNotFound(key)
+        return path
+
+    def meta_path(self, key):
+        return os.path.join(self.root, LOCAL_META_DIR, key + ".json")
+
+    def upload_fileobj(self, fileobj, Bucket, Key, ExtraArgs=None, Config=None):
+        path = self.path(Key)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix=".upload-", dir=directory)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                shutil.copyfileobj(fileobj, f, UPLOAD_CHUNK_SIZE)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self.write_meta(Key, (ExtraArgs or {}).get("ContentType"))
+
+    def write_meta(self, key, content_type):
+        # не через write_json_file: у того метрики по имени файла, а ключей много
+        meta_path = self.meta_path(key)
+        os.makedirs(os.path.dirname(meta_path), exist_ok=True)
+        with open(meta_path, "w", encoding="utf-8") as f:
+            json.dump({"ContentType": content_type}, f)
+
+    def content_type(self, key):
+        try:
+            with open(self.meta_path(key), "r", encoding="utf-8") as f:
+                return json.load(f).get("ContentType") or "application/octet-stream"
+        except (OSError, ValueError):
+            return "application/octet-stream"
+
+    def head_object(self, Bucket, Key):
+        path = self.path(Key)
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            raise ObjectNotFound(Key) from None
+        return {
+            "ContentLength": st.st_size,
+            "ContentType": self.content_type(Key),
+            "LastModified": datetime.fromtimestamp(st.st_mtime, timezone.utc),
+            "ETag": f'"{st.st_mtime_ns:x}-{st.st_size:x}"',
+        }
+
+    def get_object(self, Bucket, Key):
+        head = self.head_object(Bucket, Key)
+        return {**head, "Body": open(self.path(Key), "rb")}
+
+    def delete_object(self, Bucket, Key):
+        # как в S3: удаление отсутствующего ключа — не ошибка
+        for path in (self.path(Key), self.meta_path(Key)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        return {}
+
+    def delete_objects(self, Bucket, Delete):
+        deleted, errors = [], []
+        for obj in Delete["Objects"]:
+            try:
+                self.delete_object(Bucket, obj["Key"])
+                deleted.append({"Key": obj["Key"]})
+            except Exception as e:
+                errors.append({"Key": obj["Key"], "Code": type(e).__name__, "Message": str(e)})
+        return {"Errors": errors} if Delete.get("Quiet") else {"Deleted": deleted, "Errors": errors}
+
+    def generate_presigned_post(self, Bucket, Key, Fields=None, Conditions=None, ExpiresIn=3600):
+        policy = b64encode(json.dumps({
+            "key": Key,
+            "expires": int(time.time()) + ExpiresIn,
+            "conditions": Conditions or [],
+        }).encode())
+        return {
+            "url": LOCAL_STORE_URL,
+            "fields": {
+                **(Fields or {}),
+                "key": Key,
+                "policy": policy,
+                "signature": b64encode(token_signature(policy)),
+            },
+        }
+
+
+def public_url(key):
+    if isinstance(s3, LocalObjectStore):
+        return f"{LOCAL_STORE_URL}/{quote(key)}"
+    return f"{S3_ENDPOINT}/{S3_BUCKET}/{key}"
+
+
+def check_policy(form, size):
+    """Проверка presigned POST локального хранилища: ошибка или None."""
+    policy = form.get("policy") or ""
+    signature = form.get("signature") or ""
+    # compare_digest на str с не-ASCII бросает TypeError — сравниваем байты
+    if not hmac.compare_digest(signature.encode(), b64encode(token_signature(policy)).encode()):
+        return "bad_signature"
+    try:
+        data = json.loads(b64decode(policy))
+    except ValueError:
+        return "bad_signature"
+
+    if data.get("expires", 0) < time.time():
+        return "policy_expired"
+    if form.get("key") != data.get("key"):
+        return "bad_key"
+
+    for condition in data.get("conditions", []):
+        if condition[0] == "starts-with":
+            if not (form.get(condition[1].lstrip("$")) or "").startswith(condition[2]):
+                return "policy_condition_failed"
+        elif condition[0] == "content-length-range":
+            if not condition[1] <= size <= condition[2]:
+                return "policy_condition_failed"
+    return None
+
+
+@app.route("/objects", methods=["POST"])
+def local_store_upload():
+    if not isinstance(s3, LocalObjectStore):
+        return jsonify({"error": "not_found"}), 404
+
+    file = request.files.get("file")
+    if file is None:
+        return jsonify({"error": "no_file"}), 400
+    file.seek(0, os.SEEK_END)
+    size = file.tell()
+    file.seek(0)
+
+    error = check_policy(request.form, size)
+    if error:
+        return jsonify({"error": error}), 403
+
+    content_type = request.form.get("Content-Type") or file.mimetype
+    s3_upload(file, request.form["key"], content_type, size)
+    return "", 204
+
+
+@app.route("/objects/<path:key>", methods=["GET", "HEAD"])
+def local_store_object(key):
+    if not isinstance(s3, LocalObjectStore):
+        return jsonify({"error": "not_found"}), 404
+    try:
+        head = s3.head_object(Bucket=S3_BUCKET, Key=key)
+    except ObjectNotFound:
+        return jsonify({"error": "not_found"}), 404
+
+    return send_file(
+        s3.path(key),
+        mimetype=head["ContentType"],
+        conditional=True,
+        etag=head["ETag"].strip('"'),
+        last_modified=head["LastModified"],
+        max_age=LOCAL_STORE_MAX_AGE,
+    )
+
+
+s3 = LocalObjectStore(LOCAL_STORE_DIR) if OBJECT_STORE == "local" else LazyClient(s3_client)
+
+# ======================
+# upload limits
+# ======================
+MAX_SIZE_BYTES = 5 * 1024 * 1024  # 5MB
+GUEST_PREFIX = "guest/"
+
+# загрузка гостя живёт столько же, сколько cookie guest_id; просроченные
+# записи и их объекты раз в GUEST_SWEEP_INTERVAL убирает фоновый поток
+GUEST_TTL = 60 * 60 * 24
+GUEST_SWEEP_INTERVAL = 10 * 60
+# 0 — воркеры не убирают гостей сами (тогда нужен cron: flask sweep-guests)
+GUEST_SWEEPER = os.getenv("PIXO_GUEST_SWEEPER", "1") != "0"
+S3_DELETE_BATCH = 1000  # предел DeleteObjects на один вызов
+
+# прямая загрузка в бакет (presigned POST): сколько живёт выданная политика
+PRESIGN_EXPIRES = 10 * 60
+
+# запас на заголовки частей и поля формы сверх самого файла
+MULTIPART_OVERHEAD = 64 * 1024
+
+# потоковая отправка в S3: крупные файлы идут multipart-загрузкой
+# кусками по UPLOAD_CHUNK_SIZE, не собираясь целиком в памяти
+UPLOAD_MULTIPART_THRESHOLD = 8 * 1024 * 1024
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+UPLOAD_MAX_CONCURRENCY = 4
+
+# превью одного содержимого строит одна задача; её отметка "building"
+# в blob старше этого (воркер упал) не мешает построить заново
+DERIVATIVE_BUILD_TIMEOUT = 10 * 60
+
+_transfer_config = None
+
+
+def transfer_config():
+    global _transfer_config
+    if _transfer_config is None:
+        from boto3.s3.transfer import TransferConfig
+
+        _transfer_config = TransferConfig(
+            multipart_threshold=UPLOAD_MULTIPART_THRESHOLD,
+            multipart_chunksize=UPLOAD_CHUNK_SIZE,
+            max_concurrency=UPLOAD_MAX_CONCURRENCY,
+        )
+    return _transfer_config
+
+# sync  — upload_user отвечает после загрузки в S3 (как раньше)
+# async — файл кладётся в UPLOAD_SPOOL_DIR, ответ 202 с job_id сразу,
+#         загрузку и запись метаданных делает пул фоновых потоков
+UPLOAD_MODE = os.getenv("PIXO_UPLOAD_MODE", "sync")
+UPLOAD_SPOOL_DIR = os.getenv("PIXO_UPLOAD_SPOOL", "upload_spool")
+UPLOAD_WORKERS = 4
+UPLOAD_QUEUE_SIZE = 64  # сверх этого новые загрузки получают 503
+JOB_TTL = 24 * 60 * 60  # статусы задач и брошенные spool-файлы старше этого удаляются
+JOB_SWEEP_INTERVAL = 10 * 60
+
+# пакетная загрузка: сколько файлов и байт в одном запросе и сколько
+# объектов отправляется в S3 одновременно (на все запросы процесса)
+BATCH_MAX_FILES = 50
+BATCH_MAX_BYTES = 50 * 1024 * 1024
+BATCH_UPLOAD_WORKERS = 8
+
+# массовый перенос фото в альбом: id в одном запросе
+BULK_MAX_IDS = 1000
+
+# уменьшенные копии для сетки галереи и просмотра: derived/<имя>/<ключ>.webp
+DERIVATIVE_PREFIX = "derived/"
+DERIVATIVE_SIZES = {"thumb": 256, "preview": 1024}
+DERIVATIVE_QUALITY = 80
+DERIVATIVE_WORKERS = os.cpu_count() or 2  # 0 — считать прямо в фоновом потоке
+# у превью своя очередь: заполненная очередь загрузок их не отбрасывает
+DERIVATIVE_THREADS = 2
+DERIVATIVE_QUEUE_SIZE = 256
+
+
+# ======================
+# metrics (Prometheus, /metrics)
+# ======================
+# Счётчики и гистограммы живут в памяти процесса: у каждого воркера gunicorn
+# свои, Prometheus собирает их с каждого воркера отдельно. Время хранения
+# разложено по видам (чтение/запись файла, разбор/сборка JSON, sqlite) и
+# отдельно от вызовов S3 — так видно, на чём медленный /api/upload-user.
+METRIC_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+METRICS = {
+    "pixo_http_requests_total": ("counter", "HTTP requests by route, method and status"),
+    "pixo_http_request_duration_seconds": ("histogram", "HTTP request latency by route"),
+    "pixo_storage_seconds": ("histogram", "Metadata storage time by file and kind (read/write/decode/encode/sqlite)"),
+    "pixo_s3_seconds": ("histogram", "Object storage call latency by operation"),
+    "pixo_s3_errors_total": ("counter", "Failed object storage calls by operation"),
+    "pixo_s3_uploaded_bytes_total": ("counter", "Bytes uploaded to object storage"),
+    "pixo_image_cache_requests_total": ("counter", "Image proxy lookups by result (memory/disk/miss/coalesced)"),
+    "pixo_storage_file_bytes": ("gauge", "Size of metadata files on disk"),
+    "pixo_table_records": ("gauge", "Records per metadata collection"),
+}
+
+_metrics_lock = threading.Lock()
+_counters = {}    # (имя, метки) -> значение
+_histograms = {}  # (имя, метки) -> [по корзинам..., сверх последней, сумма]
+
+
+def metric_route():
+    if not has_request_context():
+        return "background"
+    return request.url_rule.rule if request.url_rule is not None else "unmatched"
+
+
+def metric_inc(name, value=1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with _metrics_lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def metric_observe(name, seconds, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with _metrics_lock:
+        hist = _histograms.get(key)
+        if hist is None:
+            hist = _histograms[key] = [0] * (len(METRIC_BUCKETS) + 1) + [0.0]
+        hist[bisect.bisect_left(METRIC_BUCKETS, seconds)] += 1
+        hist[-1] += seconds
+
+
+@contextmanager
+def timed(name, route=None, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metric_observe(name, time.perf_counter() - start, route=route or metric_route(), **labels)
+
+
+@contextmanager
+def s3_timer(op, route=None):
+    # route — для вызовов вне контекста запроса (asgi.py ждёт их в цикле событий)
+    try:
+        with timed("pixo_s3_seconds", route, op=op):
+            yield
+    except (FileTooLarge, ClientDisconnected):
+        raise  # оборвали сами или клиент, бакет ни при чём
+    except Exception:
+        metric_inc("pixo_s3_errors_total", op=op)
+        raise
+
+
+def s3_upload(fileobj, key, content_type, size=None):
+    with s3_timer("upload_fileobj"):
+        s3.upload_fileobj(
+            fileobj,
+            S3_BUCKET,
+            key,
+            ExtraArgs={"ContentType": content_type},
+            Config=None if isinstance(s3, LocalObjectStore) else transfer_config()
+        )
+    if size is None:
+        size = getattr(fileobj, "size", 0)
+    metric_inc("pixo_s3_uploaded_bytes_total", size, route=metric_route())
+
+
+def metric_labels(labels, extra=None):
+    items = list(labels) + ([extra] if extra else [])
+    if not items:
+        return ""
+    escaped = (
+        (k, str(v).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n"))
+        for k, v in items
+    )
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+def storage_gauges():
+    gauges = []
+    if STORAGE_MODE == "sqlite":
+        files = [SQLITE_FILE, SQLITE_FILE + "-wal"]
+        for name in TABLES:
+            (count,) = db().execute(f"SELECT COUNT(*) FROM {name}").fetchone()
+            gauges.append(("pixo_table_records", (("table", name),), count))
+    else:
+        files = []
+        for name in TABLES:
+            files.append(table_path(name))
+            if STORAGE_MODE == "wal":
+                files.append(wal_path(name))
+            gauges.append(("pixo_table_records", (("table", name),), len(repo(name).records)))
+
+    for path in files:
+        sig = file_signature(path)
+        if sig is not None:
+            gauges.append(("pixo_storage_file_bytes", (("file", os.path.basename(path)),), sig[2]))
+    return gauges
+
+
+def render_metrics():
+    with _metrics_lock:
+        counters = dict(_counters)
+        histograms = {k: list(v) for k, v in _histograms.items()}
+    gauges = storage_gauges()
+
+    lines = []
+    for name, (kind, help_text) in METRICS.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        if kind == "counter":
+            for (n, labels), value in sorted(counters.items()):
+                if n == name:
+                    lines.append(f"{name}{metric_labels(labels)} {value}")
+        elif kind == "gauge":
+            for n, labels, value in gauges:
+                if n == name:
+                    lines.append(f"{name}{metric_labels(labels)} {value}")
+        else:
+            for (n, labels), hist in sorted(histograms.items()):
+                if n != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(METRIC_BUCKETS, hist):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{metric_labels(labels, ('le', bound))} {cumulative}")
+                cumulative += hist[len(METRIC_BUCKETS)]
+                lines.append(f"{name}_bucket{metric_labels(labels, ('le', '+Inf'))} {cumulative}")
+                lines.append(f"{name}_sum{metric_labels(labels)} {hist[-1]}")
+                lines.append(f"{name}_count{metric_labels(labels)} {cumulative}")
+    return "\n".join(lines) + "\n"
+
+
+def record_request(status):
+    start = g.pop("metrics_start", None)
+    if start is None:
+        return
+    route = metric_route()
+    metric_observe("pixo_http_request_duration_seconds", time.perf_counter() - start, route=route, method=request.method)
+    metric_inc("pixo_http_requests_total", route=route, method=request.method, status=str(status))
+
+
+@app.before_request
+def start_request_timer():
+    g.metrics_start = time.perf_counter()
+
+
+@app.after_request
+def observe_request(response):
+    record_request(response.status_code)
+    return response
+
+
+@app.teardown_request
+def observe_failed_request(_exc):
+    # после необработанного исключения after_request не вызывается
+    record_request(500)
+
+
+# ======================
+# profiling (выборочный cProfile)
+# ======================
+# Доля PIXO_PROFILE_RATE запросов — и любой запрос с заголовком
+# X-Pixo-Profile, равным PIXO_ADMIN_TOKEN, — выполняется под cProfile.
+# Профиль пишется в PROFILE_DIR как <время>-<метод>_<роут>-<мс>ms-<id>.prof
+# (открывается snakeviz / pstats). Без перевыкладки видно, сколько в
+# upload_user занимает load_images, json.dumps и S3.
+# Время каждого запроса попадает в список PROFILE_SLOWEST самых медленных
+# (на процесс), он и последние профили — на /api/system/profiles.
+PROFILE_SAMPLE_RATE = float(os.getenv("PIXO_PROFILE_RATE") or 0)
+PROFILE_DIR = os.getenv("PIXO_PROFILE_DIR", "profiles")
+PROFILE_HEADER = "X-Pixo-Profile"
+PROFILE_SLOWEST = 50
+PROFILE_TOP_FUNCTIONS = 15
+
+# общий ключ для служебных роутов; пустой — они закрыты
+ADMIN_TOKEN = os.getenv("PIXO_ADMIN_TOKEN") or ""
+ADMIN_HEADER = "X-Admin-Token"
+
+_profile_guard = threading.Lock()  # под cProfile — один запрос процесса за раз
+_slowest_guard = threading.Lock()
+_slowest = []  # куча (мс, №, запись): PROFILE_SLOWEST самых медленных запросов
+_slowest_seq = itertools.count()
+_recent_profiles = deque(maxlen=PROFILE_SLOWEST)
+
+
+def trusted_header(name):
+    value = request.headers.get(name) or ""
+    return bool(ADMIN_TOKEN) and hmac.compare_digest(value.encode(), ADMIN_TOKEN.encode())
+
+
+def profile_requested():
+    if trusted_header(PROFILE_HEADER):
+        return True
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+
+def profile_top(profiler):
+    import pstats
+
+    stats = pstats.Stats(profiler).stats
+    rows = sorted(stats.items(), key=lambda item: item[1][3], reverse=True)
+    return [
+        {
+            "function": f"{os.path.basename(path)}:{line}({func})",
+            "calls": calls,
+            "tottime_ms": round(tottime * 1000, 3),
+            "cumtime_ms": round(cumtime * 1000, 3),
+        }
+        for (path, line, func), (_cc, calls, tottime, cumtime, _callers) in rows[:PROFILE_TOP_FUNCTIONS]
+    ]
+
+
+def dump_profile(profiler, method, route, ms):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    slug = "_".join([method] + "".join(c if c.isalnum() else " " for c in route).split())
+    name = f"{time.strftime('%Y%m%dT%H%M%S')}-{slug}-{int(ms)}ms-{uuid.uuid4().hex[:8]}.prof"
+    profiler.dump_stats(os.path.join(PROFILE_DIR, name))
+    return name
+
+
+def remember_request(entry):
+    item = (entry["ms"], next(_slowest_seq), entry)
+    with _slowest_guard:
+        if len(_slowest) < PROFILE_SLOWEST:
+            heapq.heappush(_slowest, item)
+        elif item[0] > _slowest[0][0]:
+            heapq.heapreplace(_slowest, item)
+        if "profile" in entry:
+            _recent_profiles.append(entry)
+
+
+def finish_profile(status):
+    start = g.pop("profile_start", None)
+    if start is None:
+        return
+    profiler = g.pop("profiler", None)
+    if profiler is not None:
+        profiler.disable()
+        _profile_guard.release()
+
+    ms = (time.perf_counter() - start) * 1000
+    entry = {
+        "route": metric_route(),
+        "method": request.method,
+        "path": request.path,
+        "status": status,
+        "ms": round(ms, 3),
+        "at": datetime.utcnow().isoformat(),
+    }
+    if profiler is not None:
+        try:
+            entry["profile"] = dump_profile(profiler, entry["method"], entry["route"], ms)
+            entry["top"] = profile_top(profiler)
+        except Exception:
+            app.logger.exception("failed to save profile")
+    remember_request(entry)
+
+
+@app.before_request
+def start_profile():
+    g.profile_start = time.perf_counter()
+    if profile_requested() and _profile_guard.acquire(blocking=False):
+        import cProfile
+
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+
+@app.after_request
+def stop_profile(response):
+    finish_profile(response.status_code)
+    return response
+
+
+@app.teardown_request
+def stop_failed_profile(_exc):
+    finish_profile(500)
+
+
+@app.route("/api/system/profiles", methods=["GET"])
+def profiles():
+    if not trusted_header(ADMIN_HEADER):
+        return jsonify({"error": "forbidden"}), 403
+
+    with _slowest_guard:
+        slowest = [entry for _ms, _seq, entry in sorted(_slowest, reverse=True)]
+        recent = list(reversed(_recent_profiles))
+    return jsonify({
+        "sample_rate": PROFILE_SAMPLE_RATE,
+        "profile_dir": PROFILE_DIR,
+        "slowest": slowest,
+        "profiles": recent,
+    }), 200
+
+
+# ======================
+# storage
+# ======================
+# json   — каждый save_* переписывает файл целиком (как раньше)
+# wal    — изменения дописываются записями в <файл>.wal, а фоновый поток
+#          периодически сворачивает журнал в снимок (сам JSON-файл)
+# sqlite — записи лежат в SQLITE_FILE с индексами по user_id/album_id/email
+STORAGE_MODE = os.getenv("PIXO_STORAGE", "json")
+
+WAL_SUFFIX = ".wal"
+WAL_COMPACT_BYTES = 4 * 1024 * 1024  # журнал больше 4MB сворачиваем в снимок
+WAL_COMPACT_INTERVAL = 30  # секунды между проверками фонового потока
+
+SQLITE_FILE = os.getenv("PIXO_SQLITE_FILE", "pixo.db")
+
+TABLES = ("users", "images", "albums", "guests", "blobs")
+# эти коллекции — словари ключ -> запись, остальные — списки записей с id
+KEYED_TABLES = ("guests", "blobs")
+
+LOCK_SUFFIX = ".lock"
+# режим json: версии областей для ETag рядом с файлом, общие для всех воркеров
+VERSIONS_SUFFIX = ".versions"
+
+_table_locks = {}
+_table_locks_guard = threading.Lock()
+_lock_local = threading.local()
+
+_wal_compactor = None
+_wal_compactor_guard = threading.Lock()
+
+
+def table_path(name):
+    return {
+        "users": USERS_FILE,
+        "images": IMAGES_FILE,
+        "albums": ALBUMS_FILE,
+        "guests": GUEST_FILE,
+        "blobs": BLOBS_FILE,
+    }[name]
+
+
+def table_default(name):
+    return {} if name in KEYED_TABLES else []
+
+
+class StorageError(Exception):
+    pass
+
+
+def read_json_file(path, default, metric_file=None):
+    # metric_file — метка file= для файлов с именами вроде <uuid>.job.json,
+    # иначе в /metrics на каждый файл появляется свой ряд
+    if not os.path.exists(path):
+        return default
+    file = metric_file or os.path.basename(path)
+    with timed("pixo_storage_seconds", file=file, kind="read"):
+        with open(path, "r", encoding="utf-8") as f:
+            raw = f.read()
+    if not raw.strip():
+        return default
+    try:
+        with timed("pixo_storage_seconds", file=file, kind="decode"):
+            data = json.loads(raw)
+    except json.JSONDecodeError as e:
+        # файлы пишутся атомарно, так что это настоящая порча данных;
+        # вернуть [] нельзя — следующий save_* затрёт всю коллекцию
+        raise StorageError(f"{path} is corrupted: {e}") from e
+    return data if isinstance(data, type(default)) else default
+
+
+def write_json_file(path, data, metric_file=None):
+    file = metric_file or os.path.basename(path)
+    with timed("pixo_storage_seconds", file=file, kind="encode"):
+        raw = json.dumps(data, ensure_ascii=False, indent=2)
+
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp", dir=directory)
+    try:
+        with timed("pixo_storage_seconds", file=file, kind="write"):
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(raw)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+@contextmanager
+def table_lock(name):
+    """RLock между потоками и flock на <файл>.lock между процессами; в sqlite ничего не делает."""
+    if STORAGE_MODE == "sqlite":
+        yield
+        return
+
+    path = table_path(name) + LOCK_SUFFIX
+    with _table_locks_guard:
+        lock = _table_locks.setdefault(path, threading.RLock())
+
+    with lock:
+        held = getattr(_lock_local, "held", None)
+        if held is None:
+            held = _lock_local.held = {}
+
+        if path in held:
+            yield
+            return
+
+        f = open(path, "a")
+        try:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            held[path] = f
+            try:
+                yield
+            finally:
+                del held[path]
+        finally:
+            f.close()  # закрытие файла снимает flock
+
+
+@contextmanager
+def table_transaction(name):
+    if STORAGE_MODE != "sqlite":
+        with table_lock(name):
+            yield
+        return
+
+    conn = db()
+    if conn.in_transaction:
+        yield
+        return
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield
+    except BaseException:
+        conn.rollback()
+        raise
+    else:
+        conn.commit()
+
+
+def record_key(name, record):
+    return record.get("id")
+
+
+def load_table(name):
+    if STORAGE_MODE == "sqlite":
+        return sqlite_load(name)
+    # копии записей: вызывающий код может их менять до save_*
+    return repo(name).export(copy=True)
+
+
+def save_table(name, data, changed=None, deleted=None):
+    """changed / deleted — изменённые записи; без них коллекция переписывается целиком."""
+    if changed is not None or deleted is not None:
+        items = []
+        for item in changed or []:
+            if name in KEYED_TABLES:
+                items.append((item, data[item]))
+            else:
+                items.append((record_key(name, item), item))
+
+        if STORAGE_MODE == "wal":
+            entries = [{"op": "put", "key": k, "value": v} for k, v in items]
+            entries += [{"op": "del", "key": k} for k in deleted or []]
+            wal_append(name, entries)
+            return
+
+        if STORAGE_MODE == "sqlite":
+            sqlite_write(name, items, deleted or [])
+            return
+
+    if STORAGE_MODE == "sqlite":
+        sqlite_replace(name, data)
+        return
+
+    with table_lock(name):
+        write_json_file(table_path(name), data)
+        if STORAGE_MODE == "wal":
+            truncate_wal(name)
+        repo_replace(name, data)
+
+
+def put_record(name, record, key=None):
+    key = key if key is not None else record_key(name, record)
+
+    if STORAGE_MODE == "wal":
+        wal_append(name, [{"op": "put", "key": key, "value": record}])
+        return
+
+    if STORAGE_MODE == "sqlite":
+        sqlite_write(name, [(key, record)], [])
+        return
+
+    with table_lock(name):
+        data = load_table(name)
+        if name in KEYED_TABLES:
+            data[key] = record
+        else:
+            idx = next((i for i, x in enumerate(data) if record_key(name, x) == key), None)
+            if idx is None:
+                data.append(record)
+            else:
+                data[idx] = record
+        json_commit(name, data, [(key, record)])
+
+
+def append_record(name, record, key=None):
+    if STORAGE_MODE != "json":
+        put_record(name, record, key=key)
+        return
+
+    key = key if key is not None else record_key(name, record)
+    with table_lock(name):
+        data = load_table(name)
+        if name in KEYED_TABLES:
+            data[key] = record
+        else:
+            data.append(record)
+        json_commit(name, data, [(key, record)])
+
+
+def put_records(name, records):
+    if not records:
+        return
+
+    if STORAGE_MODE != "json":
+        save_table(name, None, changed=records)
+        return
+
+    with table_lock(name):
+        data = load_table(name)
+        changed = {record_key(name, r): r for r in records}
+        for i, x in enumerate(data):
+            key = record_key(name, x)
+            if key in changed:
+                data[i] = changed.pop(key)
+        data.extend(changed.values())
+        json_commit(name, data, [(record_key(name, r), r) for r in records])
+
+
+def delete_records(name, keys):
+    if not keys:
+        return
+
+    if STORAGE_MODE != "json":
+        save_table(name, None, deleted=keys)
+        return
+
+    with table_lock(name):
+        data = load_table(name)
+        drop = set(keys)
+        if name in KEYED_TABLES:
+            data = {k: v for k, v in data.items() if k not in drop}
+        else:
+            data = [r for r in data if record_key(name, r) not in drop]
+        json_commit(name, data, [], deleted=drop)
+
+
+def append_records(name, records):
+    if not records:
+        return
+
+    if STORAGE_MODE != "json":
+        save_table(name, None, changed=records)
+        return
+
+    with table_lock(name):
+        data = load_table(name)
+        data.extend(records)
+        json_commit(name, data, [(record_key(name, r), r) for r in records])
+
+
+def json_commit(name, data, items, deleted=()):
+    write_json_file(table_path(name), data)
+    if not repo_apply(name, items, deleted):
+        repo_replace(name, data)
+
+
+# ======================
+# repository (коллекции в памяти)
+# ======================
+# В режимах json/wal каждая коллекция разбирается один раз и держится
+# в памяти вместе с хэш-индексами. Файл перечитывается, только если
+# изменились его mtime/size; дописанный хвост журнала применяется без
+# перечитывания снимка.
+INDEXED_FIELDS = {
+    "users": ("email",),
+    "images": ("user_id", "album_id", "digest"),
+    "albums": ("user_id",),
+    "guests": (),
+    "blobs": (),
+}
+
+# для этих индексов дополнительно держим порядок (created_at, id),
+# чтобы отдавать страницы галереи/альбома без сортировки
+ORDERED_FIELDS = {
+    "users": (),
+    "images": ("user_id", "album_id"),
+    "albums": ("user_id",),
+    "guests": (),
+    "blobs": (),
+}
+
+# версии областей для ETag: вид области -> поле записи с её id
+VERSION_SCOPES = {
+    "users": {"user": "id"},
+    "images": {"user": "user_id", "album": "album_id"},
+    "albums": {"user": "user_id", "album": "id"},
+    "guests": {},
+    "blobs": {},
+}
+
+_repo = {}
+_repo_lock = threading.RLock()
+
+
+def sort_key(key, record):
+    return (record.get("created_at") or "", str(key))
+
+
+class Collection:
+    """Записи коллекции по ключу + индексы поле -> значение -> {ключ: запись}."""
+
+    def __init__(self, name, data, base="0", versions=None, seq=0):
+        self.name = name
+        self.records = {}
+        self.indexes = {field: {} for field in INDEXED_FIELDS[name]}
+        self.orders = {field: {} for field in ORDERED_FIELDS[name]}
+        # ETag области — "<base>.<seq её последнего изменения>". base и seq
+        # одинаковы у всех воркеров: в wal seq — смещение записи в журнале,
+        # в json — счётчик из <файл>.versions (см. repo_reload)
+        self.base = base
+        self.versions = dict(versions or {})  # "user:<id>" / "album:<id>" -> seq
+        self.seq = seq
+        self._bulk = True
+
+        if name in KEYED_TABLES:
+            items = data.items()
+        else:
+            items = []
+            for i, rec in enumerate(data):
+                key = record_key(name, rec) if isinstance(rec, dict) else None
+                items.append((key if key is not None else ("#", i), rec))
+
+        for key, rec in items:
+            self.put(key, rec)
+
+        # при начальной загрузке сортируем каждый список один раз
+        for order in self.orders.values():
+            for entries in order.values():
+                entries.sort()
+        self._bulk = False
+
+    def put(self, key, record):
+        old = self.records.get(key)
+        if isinstance(old, dict):
+            self._unindex(key, old)
+            self._bump(old)
+        self.records[key] = record
+        if isinstance(record, dict):
+            self._bump(record)
+            for field, index in self.indexes.items():
+                index.setdefault(record.get(field), {})[key] = record
+            for field, order in self.orders.items():
+                entries = order.setdefault(record.get(field), [])
+                entry = (*sort_key(key, record), key)
+                if self._bulk:
+                    entries.append(entry)
+                else:
+                    bisect.insort(entries, entry)
+
+    def delete(self, key):
+        old = self.records.pop(key, None)
+        if isinstance(old, dict):
+            self._unindex(key, old)
+            self._bump(old)
+
+    def _bump(self, record):
+        if self._bulk:
+            return
+        for kind, field in VERSION_SCOPES[self.name].items():
+            value = record.get(field)
+            if value is not None:
+                self.versions[f"{kind}:{value}"] = self.seq
+
+    def version(self, kind, value):
+        return f"{self.base}.{self.versions.get(f'{kind}:{value}', 0)}"
+
+    def _unindex(self, key, record):
+        for field, index in self.indexes.items():
+            bucket = index.get(record.get(field))
+            if bucket is not None:
+                bucket.pop(key, None)
+                if not bucket:
+                    del index[record.get(field)]
+        for field, order in self.orders.items():
+            entries = order.get(record.get(field))
+            if entries is not None:
+                entry = (*sort_key(key, record), key)
+                i = bisect.bisect_left(entries, entry)
+                if i < len(entries) and entries[i] == entry:
+                    del entries[i]
+                if not entries:
+                    del order[record.get(field)]
+
+    def apply(self, entries):
+        # entries — пары (смещение конца записи в журнале, запись)
+        for end, entry in entries:
+            self.seq = end
+            if entry.get("op") == "put":
+                self.put(entry["key"], entry["value"])
+            elif entry.get("op") == "del":
+                self.delete(entry["key"])
+
+    def get(self, key):
+        return self.records.get(key)
+
+    def lookup(self, field, value):
+        return list(self.indexes[field].get(value, {}).values())
+
+    def ordered(self, field, value, limit=None, after=None):
+        entries = self.orders[field].get(value)
+        if not entries:
+            return []
+        end = len(entries) if after is None else bisect.bisect_left(entries, tuple(after))
+        start = 0 if limit is None else max(0, end - limit)
+        return [self.records[e[-1]] for e in reversed(entries[start:end])]
+
+    def export(self, copy=False):
+        def conv(rec):
+            return dict(rec) if copy and isinstance(rec, dict) else rec
+
+        if self.name in KEYED_TABLES:
+            return {k: conv(v) for k, v in self.records.items()}
+        return [conv(v) for v in self.records.values()]
+
+
+class CachedCollection:
+    def __init__(self, path, snap_sig, coll, wal_offset, wal_gen):
+        self.path = path
+        self.snap_sig = snap_sig
+        self.coll = coll
+        self.wal_offset = wal_offset
+        self.wal_gen = wal_gen
+
+
+def file_signature(path):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+def wal_generation_of(entries):
+    if entries and entries[0][1].get("op") == "start":
+        return entries[0][1].get("id")
+    return None
+
+
+def snapshot_base(sig):
+    # одинаков у всех процессов, которые видят этот файл
+    return hashlib.sha1(repr(sig).encode()).hexdigest()[:12] if sig else "0"
+
+
+def versions_path(name):
+    return table_path(name) + VERSIONS_SUFFIX
+
+
+def read_versions(name, snap_sig):
+    state = read_json_file(versions_path(name), {})
+    if state.get("sig") == (list(snap_sig) if snap_sig else None):
+        return state.get("base") or "0", state.get("seq") or 0, state.get("scopes") or {}
+    return snapshot_base(snap_sig), 0, {}
+
+
+def write_versions(name, coll, snap_sig):
+    # под table_lock, сразу после записи файла коллекции
+    write_json_file(versions_path(name), {
+        "sig": list(snap_sig) if snap_sig else None,
+        "base": coll.base,
+        "seq": coll.seq,
+        "scopes": coll.versions,
+    })
+
+
+def repo(name):
+    with _repo_lock:
+        coll = repo_cached(name)
+    if coll is not None:
+        return coll
+
+    # полную перечитку делаем под блокировкой коллекции, чтобы снимок
+    # и журнал были прочитаны согласованно (не посреди сворачивания)
+    with table_lock(name):
+        with _repo_lock:
+            coll = repo_cached(name)
+            if coll is None:
+                coll = repo_reload(name)
+    return coll
+
+
+def repo_cached(name):
+    cached = _repo.get(name)
+    path = table_path(name)
+    if cached is None or cached.path != path or cached.snap_sig != file_signature(path):
+        return None
+
+    if STORAGE_MODE != "wal":
+        return cached.coll
+
+    wal_sig = file_signature(wal_path(name))
+    wal_size = wal_sig[2] if wal_sig else 0
+    if wal_size == cached.wal_offset:
+        return cached.coll
+
+    if wal_size > cached.wal_offset:
+        if cached.wal_offset == 0 or read_wal_generation(name) == cached.wal_gen:
+            entries, cached.wal_offset = read_wal_entries(name, cached.wal_offset)
+            cached.wal_gen = cached.wal_gen or wal_generation_of(entries)
+            cached.coll.apply(entries)
+            return cached.coll
+
+    return None
+
+
+def repo_reload(name):
+    path = table_path(name)
+    snap_sig = file_signature(path)
+    if STORAGE_MODE == "wal":
+        base, seq, versions = snapshot_base(snap_sig), 0, {}
+    else:
+        base, seq, versions = read_versions(name, snap_sig)
+    coll = Collection(name, read_json_file(path, table_default(name)), base, versions, seq)
+    wal_offset, wal_gen = 0, None
+    if STORAGE_MODE == "wal":
+        entries, wal_offset = read_wal_entries(name)
+        wal_gen = wal_generation_of(entries)
+        coll.apply(entries)
+
+    _repo[name] = CachedCollection(path, snap_sig, coll, wal_offset, wal_gen)
+    return coll
+
+
+def repo_apply(name, items, deleted=()):
+    path = table_path(name)
+    with _repo_lock:
+        cached = _repo.get(name)
+        if cached is None or cached.path != path:
+            return False
+        coll = cached.coll
+        coll.seq += 1
+        for key, record in items:
+            coll.put(key, record)
+        for key in deleted:
+            coll.delete(key)
+        cached.snap_sig = file_signature(path)
+        write_versions(name, coll, cached.snap_sig)
+        return True
+
+
+def repo_replace(name, data):
+    path = table_path(name)
+    with _repo_lock:
+        snap_sig = file_signature(path)
+        wal_size, wal_gen = 0, None
+        if STORAGE_MODE == "wal":
+            wal_sig = file_signature(wal_path(name))
+            if wal_sig and wal_sig[2]:
+                wal_size, wal_gen = wal_sig[2], read_wal_generation(name)
+            coll = Collection(name, data, snapshot_base(snap_sig))
+        else:
+            coll = Collection(name, data, uuid.uuid4().hex[:12])
+            write_versions(name, coll, snap_sig)
+        _repo[name] = CachedCollection(path, snap_sig, coll, wal_size, wal_gen)
+
+
+# ======================
+# queries
+# ======================
+# Точечные выборки для роутов. В sqlite они идут через индексы базы,
+# в json/wal — через хэш-индексы коллекций в памяти.
+# find_* возвращают копию записи, её можно менять и передавать в put_record.
+def copy_record(record):
+    return dict(record) if isinstance(record, dict) else None
+
+
+def find_user(user_id):
+    if STORAGE_MODE == "sqlite":
+        return sqlite_one("SELECT data FROM users WHERE id = ?", (user_id,))
+    return copy_record(repo("users").get(user_id))
+
+
+def find_user_by_email(email):
+    if STORAGE_MODE == "sqlite":
+        return sqlite_one("SELECT data FROM users WHERE email = ?", (email,))
+    found = repo("users").lookup("email", email)
+    return copy_record(found[0]) if found else None
+
+
+def find_image(image_id):
+    if STORAGE_MODE == "sqlite":
+        return sqlite_one("SELECT data FROM images WHERE id = ?", (image_id,))
+    return copy_record(repo("images").get(image_id))
+
+
+def find_images(image_ids):
+    if STORAGE_MODE == "sqlite":
+        found = {}
+        ids = list(image_ids)
+        # держимся ниже лимита SQLite на число параметров
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            placeholders = ", ".join("?" for _ in chunk)
+            for record in sqlite_all(f"SELECT data FROM images WHERE id IN ({placeholders})", chunk):
+                found[record["id"]] = record
+        return found
+
+    coll = repo("images")
+    return {i: copy_record(coll.get(i)) for i in image_ids if coll.get(i) is not None}
+
+
+def find_album(album_id):
+    if STORAGE_MODE == "sqlite":
+        return sqlite_one("SELECT data FROM albums WHERE id = ?", (album_id,))
+    return copy_record(repo("albums").get(album_id))
+
+
+def find_guest(guest_id):
+    if STORAGE_MODE == "sqlite":
+        return sqlite_one("SELECT data FROM guests WHERE id = ?", (guest_id,))
+    return copy_record(repo("guests").get(guest_id))
+
+
+def find_blob(digest):
+    if STORAGE_MODE == "sqlite":
+        return sqlite_one("SELECT data FROM blobs WHERE id = ?", (digest,))
+    return copy_record(repo("blobs").get(digest))
+
+
+def patch_record(name, key, fields):
+    """Меняет поля записи, перечитав её под блокировкой; None — записи уже нет."""
+    with table_transaction(name):
+        if STORAGE_MODE == "sqlite":
+            record = sqlite_one(f"SELECT data FROM {name} WHERE id = ?", (key,))
+        else:
+            record = copy_record(repo(name).get(key))
+        if record is None:
+            return None
+        record.update(fields)
+        put_record(name, record, key=key)
+        return record
+
+
+def ordered_records(name, field, value, limit=None, after=None):
+    if STORAGE_MODE == "sqlite":
+        sql = f"SELECT data FROM {name} WHERE {field} = ?"
+        params = [value]
+        if after is not None:
+            sql += " AND (created_at, id) < (?, ?)"
+            params += list(after)
+        sql += " ORDER BY created_at DESC, id DESC"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+        return sqlite_all(sql, params)
+    return repo(name).ordered(field, value, limit=limit, after=after)
+
+
+def user_images(user_id, limit=None, after=None):
+    return ordered_records("images", "user_id", user_id, limit, after)
+
+
+def album_images(album_id, limit=None, after=None):
+    return ordered_records("images", "album_id", album_id, limit, after)
+
+
+def user_albums(user_id):
+    return ordered_records("albums", "user_id", user_id)
+
+
+# ======================
+# pagination
+# ======================
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+
+
+def encode_cursor(record):
+    raw = json.dumps([record.get("created_at") or "", str(record.get("id"))])
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        created_at, record_id = json.loads(raw)
+    except (ValueError, TypeError):
+        return None
+    if not isinstance(created_at, str) or not isinstance(record_id, str):
+        return None
+    return created_at, record_id
+
+
+def page_args():
+    raw_limit = request.args.get("limit")
+    cursor = request.args.get("cursor")
+    if raw_limit is None and not cursor:
+        return None, None, None
+
+    try:
+        limit = int(raw_limit) if raw_limit is not None else DEFAULT_PAGE_SIZE
+    except ValueError:
+        return None, None, (jsonify({"error": "bad_limit"}), 400)
+    if limit < 1 or limit > MAX_PAGE_SIZE:
+        return None, None, (jsonify({"error": "bad_limit"}), 400)
+
+    after = None
+    if cursor:
+        after = decode_cursor(cursor)
+        if after is None:
+            return None, None, (jsonify({"error": "bad_cursor"}), 400)
+
+    return limit, after, None
+
+
+def paginate(fetch, limit, after):
+    items = fetch(limit + 1, after)
+    if len(items) > limit:
+        items = items[:limit]
+        return items, encode_cursor(items[-1])
+    return items, None
+
+
+# ======================
+# projection (?fields=)
+# ======================
+def field_args():
+    raw = request.args.get("fields")
+    if raw is None:
+        return None, None
+
+    fields = [f.strip() for f in raw.split(",") if f.strip()]
+    if not fields or not all(f.replace("_", "").isalnum() for f in fields):
+        return None, (jsonify({"error": "bad_fields"}), 400)
+    return ["id", *(f for f in fields if f != "id")], None
+
+
+def project(records, fields):
+    if fields is None:
+        return records
+    return [{f: r[f] for f in fields if f in r} for r in records]
+
+
+# ======================
+# etag
+# ======================
+# ETag строится из счётчиков изменений (на пользователя / на альбом),
+# а не из хэша тела: на совпавший If-None-Match отвечаем 304, даже не
+# собирая ответ.
+def collection_version(name, kind, value):
+    if STORAGE_MODE == "sqlite":
+        with sqlite_timer():
+            rows = dict(db().execute(
+                "SELECT scope, version FROM versions WHERE scope IN ('*', ?)",
+                (f"{name}:{kind}:{value}",),
+            ).fetchall())
+        return f"{rows.pop('*', 0)}.{next(iter(rows.values()), 0)}"
+    return repo(name).version(kind, value)
+
+
+def resource_etag(*scopes):
+    return ".".join(collection_version(*scope) for scope in scopes)
+
+
+def etag_headers(etag):
+    return {"ETag": f'"{etag}"', "Cache-Control": "private, no-cache"}
+
+
+def not_modified(etag):
+    if request.if_none_match.contains_weak(etag):
+        return "", 304, etag_headers(etag)
+    return None
+
+
+# ======================
+# response cache (готовые JSON-ответы)
+# ======================
+# Ключ — путь с query string. Запись действительна, пока у ресурса тот же
+# ETag: любая запись, задевшая пользователя или альбом, меняет его версию,
+# и следующий запрос пересобирает тело (в том числе в других воркерах).
+# Сжатые варианты считаются при первом запросе с таким Accept-Encoding.
+RESPONSE_CACHE_BYTES = 64 * 1024 * 1024
+COMPRESS_MIN_BYTES = 1024  # меньшие тела не сжимаем
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+
+class ResponseCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def lookup(self, key, etag):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] != etag:
+                return None
+            self.entries.move_to_end(key)
+            return dict(entry[1])
+
+    def store(self, key, etag, encoding, body):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] != etag:
+                self._drop(key)
+                entry = None
+            if entry is None:
+                entry = self.entries[key] = (etag, {})
+                self.size += len(key)
+            old = entry[1].get(encoding)
+            self.size += len(body) - (len(old) if old is not None else 0)
+            entry[1][encoding] = body
+            self.entries.move_to_end(key)
+
+            while self.size > self.max_bytes and self.entries:
+                self._drop(next(iter(self.entries)))
+
+    def _drop(self, key):
+        _etag, variants = self.entries.pop(key)
+        self.size -= len(key) + sum(len(b) for b in variants.values())
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+
+response_cache = ResponseCache(RESPONSE_CACHE_BYTES)
+
+
+def dump_json(payload):
+    if HAS_ORJSON:
+        import orjson
+
+        return orjson.dumps(payload)
+    return json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def response_encoding(size):
+    if size < COMPRESS_MIN_BYTES:
+        return "identity"
+    accept = request.accept_encodings
+    if HAS_BROTLI and accept["br"]:
+        return "br"
+    if accept["gzip"]:
+        return "gzip"
+    return "identity"
+
+
+def compress(body, encoding):
+    if encoding == "br":
+        import brotli
+
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, GZIP_LEVEL, mtime=0)
+
+
+def encoded_response(key, etag, variants):
+    raw = variants["identity"]
+    encoding = response_encoding(len(raw))
+    body = variants.get(encoding)
+    if body is None:
+        body = compress(raw, encoding)
+        response_cache.store(key, etag, encoding, body)
+
+    resp = app.response_class(body, status=200, mimetype="application/json")
+    resp.headers.update(etag_headers(etag))
+    resp.headers["Vary"] = "Accept-Encoding"
+    if encoding != "identity":
+        resp.headers["Content-Encoding"] = encoding
+    return resp
+
+
+def cached_response(etag):
+    variants = response_cache.lookup(request.full_path, etag)
+    if variants is None:
+        return None
+    return encoded_response(request.full_path, etag, variants)
+
+
+def json_response(payload, etag):
+    raw = dump_json(payload)
+    response_cache.store(request.full_path, etag, "identity", raw)
+    return encoded_response(request.full_path, etag, {"identity": raw})
+
+
+# ======================
+# sqlite
+# ======================
+class DuplicateRecord(Exception):
+    pass  # запись нарушает уникальный индекс (users.email)
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    id TEXT PRIMARY KEY,
+    email TEXT,
+    created_at TEXT NOT NULL DEFAULT '',
+    data TEXT NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS users_email ON users (email);
+
+CREATE TABLE IF NOT EXISTS images (
+    id TEXT PRIMARY KEY,
+    user_id TEXT,
+    album_id TEXT,
+    created_at TEXT NOT NULL DEFAULT '',
+    data TEXT NOT NULL
+);
+DROP INDEX IF EXISTS images_user;
+DROP INDEX IF EXISTS images_album;
+CREATE INDEX IF NOT EXISTS images_user_created ON images (user_id, created_at, id);
+CREATE INDEX IF NOT EXISTS images_album_created ON images (album_id, created_at, id);
+CREATE INDEX IF NOT EXISTS images_digest ON images (json_extract(data, '$.digest'));
+
+CREATE TABLE IF NOT EXISTS albums (
+    id TEXT PRIMARY KEY,
+    user_id TEXT,
+    created_at TEXT NOT NULL DEFAULT '',
+    data TEXT NOT NULL
+);
+DROP INDEX IF EXISTS albums_user;
+CREATE INDEX IF NOT EXISTS albums_user_created ON albums (user_id, created_at, id);
+
+CREATE TABLE IF NOT EXISTS versions (
+    scope TEXT PRIMARY KEY,
+    version INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS guests (
+    id TEXT PRIMARY KEY,
+    uploaded_at TEXT NOT NULL DEFAULT '',
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS guests_uploaded ON guests (uploaded_at);
+
+CREATE TABLE IF NOT EXISTS blobs (
+    id TEXT PRIMARY KEY,
+    created_at TEXT NOT NULL DEFAULT '',
+    data TEXT NOT NULL
+);
+"""
+
+# индексируемые колонки, которые вынимаются из записи при записи в базу
+SQLITE_COLUMNS = {
+    "users": ("email", "created_at"),
+    "images": ("user_id", "album_id", "created_at"),
+    "albums": ("user_id", "created_at"),
+    "guests": ("uploaded_at",),
+    "blobs": ("created_at",),
+}
+
+_db_local = threading.local()
+
+
+def db():
+    conn = getattr(_db_local, "conn", None)
+    if conn is None or _db_local.path != SQLITE_FILE:
+        import sqlite3
+
+        conn = sqlite3.connect(SQLITE_FILE, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(SQLITE_SCHEMA)
+        _db_local.conn = conn
+        _db_local.path = SQLITE_FILE
+    return conn
+
+
+def sqlite_row(name, key, record):
+    values = []
+    for col in SQLITE_COLUMNS[name]:
+        value = record.get(col)
+        if col in ("created_at", "uploaded_at"):
+            value = value or ""
+        values.append(value)
+    return (key, *values, json.dumps(record, ensure_ascii=False))
+
+
+def sqlite_upsert_sql(name, on_conflict="update"):
+    cols = SQLITE_COLUMNS[name]
+    placeholders = ", ".join("?" for _ in range(len(cols) + 2))
+    sql = f"INSERT INTO {name} (id, {', '.join(cols)}, data) VALUES ({placeholders})"
+    if on_conflict == "ignore":
+        return sql.replace("INSERT", "INSERT OR IGNORE", 1)
+    updates = ", ".join(f"{c} = excluded.{c}" for c in (*cols, "data"))
+    return f"{sql} ON CONFLICT (id) DO UPDATE SET {updates}"
+
+
+def sqlite_timer():
+    # запросы к базе вместе с разбором JSON из колонки data
+    return timed("pixo_storage_seconds", file=os.path.basename(SQLITE_FILE), kind="sqlite")
+
+
+def sqlite_load(name):
+    with sqlite_timer():
+        rows = db().execute(f"SELECT id, data FROM {name} ORDER BY rowid").fetchall()
+    with timed("pixo_storage_seconds", file=os.path.basename(SQLITE_FILE), kind="decode"):
+        if name in KEYED_TABLES:
+            return {key: json.loads(data) for key, data in rows}
+        return [json.loads(data) for _, data in rows]
+
+
+def sqlite_scopes(name, record):
+    scopes = []
+    for kind, field in VERSION_SCOPES[name].items():
+        value = record.get(field)
+        if value is not None:
+            scopes.append(f"{name}:{kind}:{value}")
+    return scopes
+
+
+def sqlite_bump(conn, scopes):
+    conn.executemany(
+        "INSERT INTO versions (scope, version) VALUES (?, 1) "
+        "ON CONFLICT (scope) DO UPDATE SET version = version + 1",
+        [(scope,) for scope in set(scopes)],
+    )
+
+
+def sqlite_write(name, items, deleted):
+    # commit/rollback делает table_transaction: внутри транзакции
+    # вызывающего кода запись не коммитит её раньше времени
+    conn = db()
+    with sqlite_timer(), table_transaction(name):
+        scopes = []
+        if VERSION_SCOPES[name]:
+            for key in [k for k, _ in items] + list(deleted):
+                old = conn.execute(f"SELECT data FROM {name} WHERE id = ?", (key,)).fetchone()
+                if old:
+                    scopes += sqlite_scopes(name, json.loads(old[0]))
+            for _, record in items:
+                scopes += sqlite_scopes(name, record)
+
+        if items:
+            try:
+                conn.executemany(
+                    sqlite_upsert_sql(name),
+                    [sqlite_row(name, key, record) for key, record in items],
+                )
+            except conn.IntegrityError as e:
+                raise DuplicateRecord(name) from e
+        if deleted:
+            conn.executemany(f"DELETE FROM {name} WHERE id = ?", [(k,) for k in deleted])
+        sqlite_bump(conn, scopes)
+
+
+def sqlite_replace(name, data):
+    if name in KEYED_TABLES:
+        items = list(data.items())
+    else:
+        items = [(record_key(name, r), r) for r in data]
+    conn = db()
+    with sqlite_timer(), table_transaction(name):
+        conn.execute(f"DELETE FROM {name}")
+        conn.executemany(
+            sqlite_upsert_sql(name),
+            [sqlite_row(name, key, record) for key, record in items],
+        )
+        # коллекция заменена целиком — сбрасываем все ETag разом
+        sqlite_bump(conn, ["*"])
+
+
+def sqlite_one(sql, params):
+    with sqlite_timer():
+        row = db().execute(sql, params).fetchone()
+        return json.loads(row[0]) if row else None
+
+
+def sqlite_all(sql, params):
+    with sqlite_timer():
+        return [json.loads(data) for (data,) in db().execute(sql, params)]
+
+
+def migrate_json_to_sqlite():
+    """Переносит JSON-файлы (с их журналами) в SQLITE_FILE: {коллекция: (прочитано, записано)}."""
+    result = {}
+    conn = db()
+    for name in TABLES:
+        data = replay_wal(name, read_json_file(table_path(name), table_default(name)))
+        if name in KEYED_TABLES:
+            items = [(k, v) for k, v in data.items() if isinstance(v, dict)]
+        else:
+            items = [(record_key(name, r), r) for r in data if record_key(name, r)]
+        with conn:
+            before = conn.total_changes
+            conn.executemany(
+                sqlite_upsert_sql(name, on_conflict="ignore"),
+                [sqlite_row(name, key, record) for key, record in items],
+            )
+            result[name] = (len(items), conn.total_changes - before)
+            sqlite_bump(conn, ["*"])
+    return result
+
+
+@app.cli.command("migrate-sqlite")
+def migrate_sqlite_command():
+    """Переносит JSON-файлы в SQLite (PIXO_SQLITE_FILE)."""
+    for name, (read, written) in migrate_json_to_sqlite().items():
+        print(f"- {name}: {written}/{read} -> {SQLITE_FILE}")
+
+
+# ======================
+# write-ahead log
+# ======================
+def wal_path(name):
+    return table_path(name) + WAL_SUFFIX
+
+
+def read_wal_entries(name, offset=0):
+    entries = []
+    try:
+        f = open(wal_path(name), "rb")
+    except FileNotFoundError:
+        return entries, 0
+
+    with f, timed("pixo_storage_seconds", file=os.path.basename(wal_path(name)), kind="read"):
+        f.seek(offset)
+        for line in f:
+            if not line.endswith(b"\n"):
+                # строка ещё дописывается (или процесс упал посреди записи)
+                break
+            offset += len(line)
+            try:
+                entries.append((offset, json.loads(line)))
+            except json.JSONDecodeError:
+                continue
+
+    return entries, offset
+
+
+def replay_wal(name, data):
+    coll = Collection(name, data)
+    coll.apply(read_wal_entries(name)[0])
+    return coll.export()
+
+
+def wal_append(name, entries):
+    if not entries:
+        return
+    start_wal_compactor()
+    file = os.path.basename(wal_path(name))
+    with timed("pixo_storage_seconds", file=file, kind="encode"):
+        payload = "".join(json.dumps(e, ensure_ascii=False) + "\n" for e in entries)
+    with table_lock(name), timed("pixo_storage_seconds", file=file, kind="write"):
+        with open(wal_path(name), "a", encoding="utf-8") as f:
+            if f.tell() == 0:
+                # каждое поколение журнала начинается со своего id: так читатель
+                # отличит дописанный хвост от журнала, очищенного и написанного заново
+                payload = json.dumps({"op": "start", "id": str(uuid.uuid4())}) + "\n" + payload
+            f.write(payload)
+
+
+def read_wal_generation(name):
+    try:
+        with open(wal_path(name), "rb") as f:
+            first = f.readline()
+    except FileNotFoundError:
+        return None
+    try:
+        entry = json.loads(first)
+    except json.JSONDecodeError:
+        return None
+    return entry.get("id") if entry.get("op") == "start" else None
+
+
+def truncate_wal(name):
+    path = wal_path(name)
+    if os.path.exists(path):
+        open(path, "w", encoding="utf-8").close()
+
+
+def compact_wal(name):
+    with table_lock(name):
+        path = wal_path(name)
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            return False
+        save_table(name, load_table(name))
+    return True
+
+
+def start_wal_compactor():
+    global _wal_compactor
+    with _wal_compactor_guard:
+        if _wal_compactor is None:
+            _wal_compactor = threading.Thread(
+                target=wal_compactor_loop, name="wal-compactor", daemon=True
+            )
+            _wal_compactor.start()
+
+
+def wal_compactor_loop():
+    while True:
+        time.sleep(WAL_COMPACT_INTERVAL)
+        for name in TABLES:
+            try:
+                if os.path.getsize(wal_path(name)) >= WAL_COMPACT_BYTES:
+                    compact_wal(name)
+            except OSError:
+                continue
+            except Exception:
+                app.logger.exception("wal compaction failed for %s", name)
+
+
+# ======================
+# utils
+# ======================
+def load_users():
+    return load_table("users")
+
+
+def save_users(users, changed=None):
+    save_table("users", users, changed=changed)
+
+
+def load_guests():
+    return load_table("guests")
+
+
+def save_guests(data: dict, changed=None):
+    save_table("guests", data, changed=changed)
+
+
+def get_or_create_guest_id():
+    guest_id = request.cookies.get("guest_id")
+    if not guest_id:
+        guest_id = str(uuid.uuid4())
+    return guest_id
+
+
+def load_images():
+    return load_table("images")
+
+
+def save_images(images, changed=None):
+    save_table("images", images, changed=changed)
+
+
+def load_albums():
+    return load_table("albums")
+
+
+def save_albums(albums, changed=None):
+    save_table("albums", albums, changed=changed)
+
+
+# ======================
+# auth
+# ======================
+# sign_in выдаёт токен <payload>.<hmac-sha256>, payload — {"sub": id, "exp": unix}.
+# Проверка — только HMAC и срок, без чтения users.json.
+SESSION_TTL = 7 * 24 * 60 * 60
+SESSION_SECRET = os.getenv("PIXO_SESSION_SECRET") or ""
+# 1 — защищённые роуты принимают только токен, user_id от клиента игнорируется
+REQUIRE_TOKEN = os.getenv("PIXO_REQUIRE_TOKEN") == "1"
+
+
+
+def require_session_secret(debug=False):
+    # проверяется при запуске сервера, а не при импорте: процессы пула
+    # превью (spawn) импортируют модуль заново, и секрет им не нужен
+    global SESSION_SECRET
+    if SESSION_SECRET:
+        return
+    # без общего секрета токены и подписи загрузок не подходят другим
+    # воркерам, поэтому случайный секрет — только для локального запуска
+    if not debug:
+        raise RuntimeError("PIXO_SESSION_SECRET is not set")
+    app.logger.warning("PIXO_SESSION_SECRET is not set, using a random per-process secret (debug only)")
+    SESSION_SECRET = secrets.token_hex(32)
+
+
+def b64encode(raw):
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode()
+
+
+def b64decode(text):
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+def token_signature(payload):
+    if not SESSION_SECRET:
+        require_session_secret(app.debug)  # flask run без точки входа
+    return hmac.new(SESSION_SECRET.encode(), payload.encode(), hashlib.sha256).digest()
+
+
+def issue_token(user_id, now=None):
+    exp = int(now if now is not None else time.time()) + SESSION_TTL
+    payload = b64encode(json.dumps({"sub": user_id, "exp": exp}, separators=(",", ":")).encode())
+    return f"{payload}.{b64encode(token_signature(payload))}"
+
+
+def verify_token(token, now=None):
+    payload, _, signature = (token or "").partition(".")
+    try:
+        if not hmac.compare_digest(b64decode(signature), token_signature(payload)):
+            return None
+        claims = json.loads(b64decode(payload))
+    except (ValueError, TypeError):
+        return None
+    if not isinstance(claims, dict) or not isinstance(claims.get("exp"), int):
+        return None
+    if claims["exp"] <= (now if now is not None else time.time()):
+        return None
+    return claims.get("sub")
+
+
+def bearer_token():
+    scheme, _, token = (request.headers.get("Authorization") or "").partition(" ")
+    return token.strip() if scheme.lower() == "bearer" else None
+
+
+def client_user_id():
+    # старые клиенты присылают user_id в пути, query, форме или JSON
+    return (
+        (request.view_args or {}).get("user_id")
+        or request.args.get("user_id")
+        or request.form.get("user_id")
+        or (request.get_json(silent=True) or {}).get("user_id")
+    )
+
+
+def with_user(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        token = bearer_token()
+        if token:
+            g.user_id = verify_token(token)
+            if not g.user_id:
+                return jsonify({"error": "invalid_token"}), 401
+        elif REQUIRE_TOKEN:
+            return jsonify({"error": "token_missing"}), 401
+        else:
+            g.user_id = client_user_id()
+        return view(*args, **kwargs)
+
+    return wrapper
+
+
+@app.route("/api/sign-up", methods=["POST"])
+def sign_up():
+    data = request.get_json() or {}
+    email = data.get("email")
+    password = data.get("password")
+
+    if not email or not password:
+        return jsonify({"error": "email_or_password_missing"}), 400
+
+    user = {
+        "id": str(uuid.uuid4()),
+        "email": email,
+        "password": password, 
+        "created_at": datetime.utcnow().isoformat()
+    }
+
+    # проверка и запись под одной блокировкой, иначе два воркера
+    # могут одновременно зарегистрировать один email
+    with table_lock("users"):
+        if find_user_by_email(email) is not None:
+            return jsonify({"error": "user_exists"}), 400
+        try:
+            append_record("users", user)
+        except DuplicateRecord:
+            # уникальный индекс по email: параллельная регистрация успела раньше
+            return jsonify({"error": "user_exists"}), 400
+
+    return jsonify({
+        "message": "registered",
+        "user": {"id": user["id"], "email": user["email"]}
+    }), 201
+
+
+@app.route("/api/sign-in", methods=["POST"])
+def sign_in():
+    data = request.get_json() or {}
+    email = data.get("email")
+    password = data.get("password")
+
+    if not email or not password:
+        return jsonify({"error": "email_or_password_missing"}), 400
+
+    user = find_user_by_email(email)
+
+    if user is None:
+        return jsonify({"error": "user_not_found"}), 400
+
+    if user.get("password") != password:
+        return jsonify({"error": "wrong_password"}), 400
+
+    return jsonify({
+        "message": "ok",
+        "user": {"id": user["id"], "email": user["email"]},
+        "token": issue_token(user["id"])
+    }), 200
+
+
+# ======================
+# system
+# ======================
+@app.route("/api/ping", methods=["GET"])
+def ping():
+    return jsonify({"status": "ok"})
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    return render_metrics(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+
+# ======================
+# upload size limits
+# ======================
+# Тело загрузки проверяется по Content-Length до того, как Werkzeug
+# начнёт его читать; без Content-Length (chunked) чтение оборвётся на лимите.
+MULTIPART_UPLOAD_ENDPOINTS = {"upload_guest", "upload_user", "local_store_upload"}
+STREAM_UPLOAD_ENDPOINTS = {"stream_guest_upload", "stream_user_upload"}
+
+
+class FileTooLarge(Exception):
+    pass
+
+
+class ClientDisconnected(Exception):
+    # клиент ушёл, не дослав тело (asgi.py)
+    pass
+
+
+def upload_limit(endpoint):
+    # None — роут не загрузка, лимита нет
+    if endpoint in MULTIPART_UPLOAD_ENDPOINTS:
+        return MAX_SIZE_BYTES + MULTIPART_OVERHEAD
+    if endpoint in STREAM_UPLOAD_ENDPOINTS:
+        return MAX_SIZE_BYTES
+    if endpoint == "upload_user_batch":
+        return BATCH_MAX_BYTES + MULTIPART_OVERHEAD
+    return None
+
+
+@app.before_request
+def reject_oversized_upload():
+    limit = upload_limit(request.endpoint)
+    if limit is None:
+        return None
+
+    if request.content_length is not None and request.content_length > limit:
+        return jsonify({"error": "file_too_large"}), 400
+    request.max_content_length = limit
+    return None
+
+
+@app.errorhandler(RequestEntityTooLarge)
+def upload_too_large(_e):
+    return jsonify({"error": "file_too_large"}), 400
+
+
+class LimitedStream:
+    def __init__(self, stream, limit):
+        self.stream = stream
+        self.limit = limit
+        self.size = 0
+        self.sha256 = hashlib.sha256()
+
+    def read(self, amount=-1):
+        parts = []
+        want = amount if amount is not None and amount >= 0 else None
+        got = 0
+        while want is None or got < want:
+            chunk = self.stream.read(UPLOAD_CHUNK_SIZE if want is None else min(want - got, UPLOAD_CHUNK_SIZE))
+            if not chunk:
+                break
+            parts.append(chunk)
+            got += len(chunk)
+            self.size += len(chunk)
+            self.sha256.update(chunk)
+            if self.size > self.limit:
+                raise FileTooLarge()
+        return b"".join(parts)
+
+
+class HashedSpool:
+    def __init__(self, spool):
+        self.spool = spool
+        self.sha256 = hashlib.sha256()
+
+    def write(self, data):
+        self.sha256.update(data)
+        return self.spool.write(data)
+
+    def __iter__(self):
+        return iter(self.spool)
+
+    def __getattr__(self, name):
+        return getattr(self.spool, name)
+
+
+class PixoRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        spool = super()._get_file_stream(total_content_length, content_type, filename, content_length)
+        return HashedSpool(spool)
+
+
+app.request_class = PixoRequest
+
+
+def stream_to_s3(key, content_type):
+    try:
+        return (yield BucketCall("upload_fileobj", key, content_type=content_type))
+    except FileTooLarge:
+        return None
+
+
+def stream_args():
+    filename = request.args.get("filename") or ""
+    if not filename:
+        return None, (jsonify({"error": "empty_filename"}), 400)
+    if not (request.mimetype or "").startswith("image/"):
+        return None, (jsonify({"error": "only_images_allowed"}), 400)
+    return os.path.splitext(filename)[1].lower(), None
+
+
+# ======================
+# bucket flows (роуты-генераторы)
+# ======================
+# Роут, который ходит в бакет, — генератор (bucket_view): каждый вызов
+# бакета он отдаёт через yield и получает обратно результат или ошибку.
+# Flask выполняет его сразу (run_flow), а asgi.py ждёт те же вызовы
+# асинхронным клиентом, не занимая поток. Кроме BucketCall можно отдать
+# Future (ждать чужую загрузку), список генераторов (выполнить
+# параллельно, ошибки — на месте результатов) и BackgroundFlow (в фон;
+# результат — принят ли он в очередь).
+ASGI_FLOW = "pixo.asgi_flow"  # ключ environ: роут возвращает генератор, шаги ведёт asgi.py
+
+
+class BucketCall:
+    def __init__(self, op, key, **params):
+        self.op = op
+        self.key = key
+        self.params = params
+        self.route = metric_route()
+
+
+class BackgroundFlow:
+    def __init__(self, flow):
+        self.flow = flow
+
+
+def bucket_view(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        flow = view(*args, **kwargs)
+        if request.environ.get(ASGI_FLOW):
+            return flow
+        return run_flow(flow)
+
+    return wrapper
+
+
+def flow_step(flow, result=None, error=None):
+    # (True, что вернул генератор) или (False, что он отдал через yield)
+    try:
+        return False, flow.throw(error) if error is not None else flow.send(result)
+    except StopIteration as stop:
+        return True, stop.value
+
+
+def run_flow(flow):
+    result = error = None
+    while True:
+        done, value = flow_step(flow, result, error)
+        if done:
+            return value
+        result = error = None
+        try:
+            result = run_step(value)
+        except Exception as e:
+            error = e
+
+
+def run_step(value):
+    if isinstance(value, BucketCall):
+        return call_bucket(value)
+    if isinstance(value, Future):
+        return value.result()
+    if isinstance(value, BackgroundFlow):
+        return submit_background(run_flow, value.flow)
+    # в копии контекста тот же запрос: файлы формы открыты, пока он ждёт все генераторы
+    futures = [batch_executor().submit(contextvars.copy_context().run, run_flow, flow) for flow in value]
+    return [future.exception() or future.result() for future in futures]
+
+
+def call_bucket(call):
+    if call.op == "upload_fileobj":
+        body = call.params.get("body")
+        if body is None:
+            body = LimitedStream(request.stream, MAX_SIZE_BYTES)
+        s3_upload(body, call.key, call.params["content_type"], call.params.get("size"))
+        return body
+    with s3_timer(call.op):
+        if call.op == "get_object":
+            return read_object(s3, call.key)
+        return getattr(s3, call.op)(Bucket=S3_BUCKET, Key=call.key)
+
+
+def read_object(client, key):
+    # (ответ get_object без Body, байты объекта)
+    obj = client.get_object(Bucket=S3_BUCKET, Key=key)
+    body = obj.pop("Body")
+    try:
+        return obj, body.read()
+    finally:
+        body.close()
+
+
+# ======================
+# background uploads
+# ======================
+# Статус задачи лежит файлом <UPLOAD_SPOOL_DIR>/<job_id>.job.json,
+# поэтому /api/upload-status отвечает из любого воркера на этой машине.
+_upload_executor = None
+_upload_executor_guard = threading.Lock()
+_upload_slots = threading.BoundedSemaphore(UPLOAD_QUEUE_SIZE)
+_job_sweep_guard = threading.Lock()
+_job_sweep_last = 0.0
+
+
+def upload_executor():
+    global _upload_executor
+    with _upload_executor_guard:
+        if _upload_executor is None:
+            _upload_executor = ThreadPoolExecutor(
+                max_workers=UPLOAD_WORKERS, thread_name_prefix="upload"
+            )
+        return _upload_executor
+
+
+def job_path(job_id):
+    return os.path.join(UPLOAD_SPOOL_DIR, f"{job_id}.job.json")
+
+
+def save_job(job):
+    write_json_file(job_path(job["id"]), job, metric_file="job")
+
+
+def load_job(job_id):
+    # job_id приходит из URL — в путь пускаем только uuid
+    try:
+        uuid.UUID(job_id)
+    except ValueError:
+        return None
+    return read_json_file(job_path(job_id), {}, metric_file="job") or None
+
+
+def sweep_jobs(now=None):
+    cutoff = (now or time.time()) - JOB_TTL
+    removed = 0
+    try:
+        names = os.listdir(UPLOAD_SPOOL_DIR)
+    except FileNotFoundError:
+        return 0
+    for name in names:
+        if not name.endswith((".job.json", ".part")):
+            continue
+        path = os.path.join(UPLOAD_SPOOL_DIR, name)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+                removed += 1
+        except FileNotFoundError:
+            pass  # убрал другой воркер
+    return removed
+
+
+def maybe_sweep_jobs():
+    # не чаще раза в JOB_SWEEP_INTERVAL на процесс; параллельный вызов не ждёт
+    global _job_sweep_last
+    if time.monotonic() - _job_sweep_last < JOB_SWEEP_INTERVAL:
+        return
+    if not _job_sweep_guard.acquire(blocking=False):
+        return
+    try:
+        _job_sweep_last = time.monotonic()
+        sweep_jobs()
+    except Exception:
+        app.logger.exception("job sweep failed")
+    finally:
+        _job_sweep_guard.release()
+
+
+def submit_queued(executor, slots, fn, *args):
+    if not slots.acquire(blocking=False):
+        return False
+
+    def run():
+        try:
+            fn(*args)
+        except Exception:
+            app.logger.exception("background task %s failed", fn.__name__)
+        finally:
+            slots.release()
+
+    executor.submit(run)
+    return True
+
+
+def submit_background(fn, *args):
+    return submit_queued(upload_executor(), _upload_slots, fn, *args)
+
+
+def enqueue_upload(file, key, content_type, record):
+    os.makedirs(UPLOAD_SPOOL_DIR, exist_ok=True)
+    maybe_sweep_jobs()
+    job = {
+        "id": str(uuid.uuid4()),
+        "status": "queued",
+        "image_id": record["id"],
+        "created_at": datetime.utcnow().isoformat()
+    }
+    spool_path = os.path.join(UPLOAD_SPOOL_DIR, f"{job['id']}.part")
+    with open(spool_path, "wb") as out:
+        shutil.copyfileobj(file.stream, out, UPLOAD_CHUNK_SIZE)
+    save_job(job)
+
+    if not (yield BackgroundFlow(run_upload_job(job, spool_path, key, content_type, record))):
+        os.remove(spool_path)
+        os.remove(job_path(job["id"]))
+        return None
+    return job
+
+
+def take_upload_slot():
+    # место в очереди фоновых загрузок для asgi.py (там задача — корутина)
+    return _upload_slots.acquire(blocking=False)
+
+
+def release_upload_slot():
+    _upload_slots.release()
+
+
+def run_upload_job(job, spool_path, key, content_type, record):
+    try:
+        save_job({**job, "status": "uploading"})
+
+        size = os.path.getsize(spool_path)
+        with open(spool_path, "rb") as f:
+            upload = BucketCall("upload_fileobj", key, body=f, content_type=content_type, size=size)
+            blob = yield from store_once(record["digest"], key, upload, size)
+        use_blob(record, blob)
+        append_record("images", record)
+        save_job({**job, "status": "done", "image": record})
+        if not blob_has_derivatives(blob):
+            with open(spool_path, "rb") as f:
+                schedule_derivatives(record, f.read())
+    except Exception as e:
+        app.logger.exception("upload job %s failed", job["id"])
+        save_job({**job, "status": "failed", "error": type(e).__name__})
+    finally:
+        if os.path.exists(spool_path):
+            os.remove(spool_path)
+
+
+def delete_object_quietly(key):
+    try:
+        yield BucketCall("delete_object", key)
+    except Exception:
+        pass
+
+
+@app.route("/api/upload-status/<job_id>", methods=["GET"])
+def upload_status(job_id):
+    job = load_job(job_id)
+    if not job:
+        return jsonify({"error": "job_not_found"}), 404
+    return jsonify({"job": job}), 200
+
+
+@app.cli.command("sweep-jobs")
+def sweep_jobs_command():
+    """Однократно удаляет старые статусы фоновых загрузок (для cron)."""
+    print(f"- removed: {sweep_jobs()}")
+
+
+# ======================
+# derivatives (превью)
+# ======================
+_derivative_pool = None
+_derivative_pool_guard = threading.Lock()
+_derivative_executor = None
+_derivative_slots = threading.BoundedSemaphore(DERIVATIVE_QUEUE_SIZE)
+
+
+def derivative_key(key, name):
+    return f"{DERIVATIVE_PREFIX}{name}/{os.path.splitext(key)[0]}.webp"
+
+
+def derivative_pool():
+    global _derivative_pool
+    with _derivative_pool_guard:
+        if _derivative_pool is None:
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+
+            # spawn: fork из процесса с потоками может унести в дочерний
+            # процесс захваченные блокировки
+            _derivative_pool = ProcessPoolExecutor(
+                max_workers=DERIVATIVE_WORKERS,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        return _derivative_pool
+
+
+def derivative_executor():
+    # потоки, которые ждут пул процессов и кладут превью в бакет
+    global _derivative_executor
+    with _derivative_pool_guard:
+        if _derivative_executor is None:
+            _derivative_executor = ThreadPoolExecutor(
+                max_workers=DERIVATIVE_THREADS, thread_name_prefix="derivatives"
+            )
+        return _derivative_executor
+
+
+def render_derivatives(data, sizes, quality):
+    from PIL import Image, ImageOps
+
+    result = {}
+    with Image.open(io.BytesIO(data)) as original:
+        im = ImageOps.exif_transpose(original)
+        if im.mode not in ("RGB", "RGBA"):
+            im = im.convert("RGBA" if "A" in im.getbands() else "RGB")
+        for name, size in sizes.items():
+            copy = im.copy()
+            copy.thumbnail((size, size), Image.LANCZOS)
+            buf = io.BytesIO()
+            copy.save(buf, "WEBP", quality=quality)
+            result[name] = buf.getvalue()
+    return result
+
+
+def generate_derivatives(image_id, key, data=None, digest=None):
+    if digest and not start_blob_derivatives(image_id, digest):
+        return
+
+    try:
+        if data is None:
+            with s3_timer("get_object"):
+                data = s3.get_object(Bucket=S3_BUCKET, Key=key)["Body"].read()
+
+        if DERIVATIVE_WORKERS:
+            rendered = derivative_pool().submit(
+                render_derivatives, data, DERIVATIVE_SIZES, DERIVATIVE_QUALITY
+            ).result()
+        else:
+            rendered = render_derivatives(data, DERIVATIVE_SIZES, DERIVATIVE_QUALITY)
+
+        fields = {}
+        for name, body in rendered.items():
+            dkey = derivative_key(key, name)
+            s3_upload(io.BytesIO(body), dkey, "image/webp", len(body))
+            fields[f"{name}_url"] = public_url(dkey)
+    except BaseException:
+        if digest:
+            finish_blob_derivatives(digest, {})
+        raise
+
+    patch_record("images", image_id, fields)
+    if digest:
+        finish_blob_derivatives(digest, fields)
+        for record in images_with_digest(digest):
+            if not all(record.get(field) for field in fields):
+                patch_record("images", record["id"], fields)
+
+
+def start_blob_derivatives(image_id, digest):
+    with table_transaction("blobs"):
+        blob = find_blob(digest)
+        if blob is None:
+            return True
+        if blob_has_derivatives(blob):
+            patch_record("images", image_id, derivative_fields(blob))
+            return False
+        started = blob.get("building")
+        if started and time.time() - started < DERIVATIVE_BUILD_TIMEOUT:
+            return False
+        blob["building"] = time.time()
+        put_record("blobs", blob, key=digest)
+        return True
+
+
+def finish_blob_derivatives(digest, fields):
+    # fields={} — построить не удалось, следующая загрузка попробует снова
+    with table_transaction("blobs"):
+        blob = find_blob(digest)
+        if blob is not None:
+            blob.pop("building", None)
+            blob.update(fields)
+            put_record("blobs", blob, key=digest)
+
+
+def images_with_digest(digest):
+    if STORAGE_MODE == "sqlite":
+        return sqlite_all("SELECT data FROM images WHERE json_extract(data, '$.digest') = ?", (digest,))
+    return [copy_record(r) for r in repo("images").lookup("digest", digest)]
+
+
+def schedule_derivatives(record, data=None):
+    if not HAS_PILLOW:
+        return
+    queued = submit_queued(
+        derivative_executor(), _derivative_slots,
+        generate_derivatives, record["id"], record["key"], data, record.get("digest")
+    )
+    if not queued:
+        app.logger.warning("derivatives for image %s skipped: queue is full", record["id"])
+
+
+# ======================
+# dedup (одинаковое содержимое)
+# ======================
+# blobs: sha256 содержимого -> {"key", "refs", "size", "created_at", превью}.
+# Изображения с одинаковым содержимым ссылаются на один объект в бакете;
+# объект удаляется, только когда refs падает до нуля (release_image).
+# Записи без "digest" (старые и прямые загрузки) объектом владеют сами.
+# Содержимое общее только в пределах одного пользователя (user_digest):
+# ключ user/<id>/ одного пользователя не попадает в записи другого.
+
+def user_digest(user_id, sha256):
+    return f"{user_id}:{sha256.hexdigest()}"
+
+
+def claim_blob(digest, key=None, size=None):
+    with table_transaction("blobs"):
+        blob = find_blob(digest)
+        if blob is not None:
+            blob["refs"] = blob.get("refs", 1) + 1
+        elif key is not None:
+            blob = {
+                "key": key,
+                "refs": 1,
+                "size": size,
+                "created_at": datetime.utcnow().isoformat()
+            }
+        else:
+            return None
+        put_record("blobs", blob, key=digest)
+        return blob
+
+
+def release_blob(digest):
+    with table_transaction("blobs"):
+        blob = find_blob(digest)
+        if blob is None:
+            return None
+        blob["refs"] = blob.get("refs", 1) - 1
+        if blob["refs"] > 0:
+            put_record("blobs", blob, key=digest)
+            return None
+        delete_records("blobs", [digest])
+        return blob["key"]
+
+
+def store_once(digest, key, upload, size=None):
+    blob = claim_blob(digest)
+    if blob is not None:
+        return blob
+
+    yield upload
+    blob = claim_blob(digest, key, size)
+    if blob["key"] != key:
+        # то же самое параллельно загрузил другой запрос — его объект и оставляем
+        yield from delete_object_quietly(key)
+    return blob
+
+
+def use_blob(record, blob):
+    record["key"] = blob["key"]
+    record["url"] = public_url(blob["key"])
+    record.update(derivative_fields(blob))
+
+
+def derivative_fields(blob):
+    return {f"{name}_url": blob[f"{name}_url"] for name in DERIVATIVE_SIZES if blob.get(f"{name}_url")}
+
+
+def blob_has_derivatives(blob):
+    return all(blob.get(f"{name}_url") for name in DERIVATIVE_SIZES)
+
+
+def released_keys(records, derivatives=True):
+    keys = []
+    for record in records:
+        digest = record.get("digest")
+        key = release_blob(digest) if digest else record.get("key")
+        if not key:
+            continue
+        keys.append(key)
+        if derivatives:
+            keys += [derivative_key(key, name) for name in DERIVATIVE_SIZES]
+    return keys
+
+
+def release_image(record):
+    delete_objects_batched(released_keys([record]))
+
+
+# ======================
+# guest upload
+# ======================
+@app.route("/api/upload-guest", methods=["POST"])
+@bucket_view
+def upload_guest():
+    guest_id = get_or_create_guest_id()
+
+    if "file" not in request.files:
+        return jsonify({"error": "no_file"}), 400
+
+    file = request.files["file"]
+    if not file.filename:
+        return jsonify({"error": "empty_filename"}), 400
+
+    title = request.form.get("title") or file.filename
+
+    # только изображения
+    if not (file.mimetype or "").startswith("image/"):
+        return jsonify({"error": "only_images_allowed"}), 400
+
+    # проверка размера (5MB)
+    file.seek(0, os.SEEK_END)
+    size = file.tell()
+    file.seek(0)
+
+    if size > MAX_SIZE_BYTES:
+        return jsonify({"error": "file_too_large"}), 400
+
+    ext = os.path.splitext(file.filename)[1].lower()
+    key = f"{GUEST_PREFIX}{uuid.uuid4()}{ext}"
+
+    yield BucketCall("upload_fileobj", key, body=file, content_type=file.mimetype, size=size)
+
+    return (yield from guest_uploaded(guest_id, key, title))
+
+
+@app.route("/api/upload-guest/stream", methods=["PUT"])
+@bucket_view
+def stream_guest_upload():
+    guest_id = get_or_create_guest_id()
+
+    ext, error = stream_args()
+    if error:
+        return error
+
+    key = f"{GUEST_PREFIX}{uuid.uuid4()}{ext}"
+    if (yield from stream_to_s3(key, request.mimetype)) is None:
+        return jsonify({"error": "file_too_large"}), 400
+
+    title = request.args.get("title") or request.args.get("filename")
+    return (yield from guest_uploaded(guest_id, key, title))
+
+
+def guest_uploaded(guest_id, key, title):
+    old_entry = find_guest(guest_id)
+
+    put_record("guests", {
+        "key": key,
+        "title": title,
+        "uploaded_at": datetime.utcnow().isoformat()
+    }, key=guest_id)
+
+    # если у гостя было предыдущее фото — удаляем из S3
+    if old_entry and old_entry.get("key") != key:
+        release = release_guest_upload(old_entry)
+        # в режиме async удаление не держит запрос; если очередь полна — удаляем сразу
+        if UPLOAD_MODE != "async" or not (yield BackgroundFlow(release)):
+            yield from release
+
+    resp = jsonify({
+        "message": "uploaded",
+        "guest_id": guest_id,
+        "key": key,
+        "url": public_url(key),
+        "title": title
+    })
+
+    set_guest_cookie(resp, guest_id)
+    return resp, 201
+
+
+def release_guest_upload(entry):
+    # превью у гостей не строятся
+    for key in released_keys([entry], derivatives=False):
+        yield from delete_object_quietly(key)
+
+
+def set_guest_cookie(resp, guest_id):
+    # cookie живёт сутки
+    resp.set_cookie(
+        "guest_id",
+        guest_id,
+        max_age=GUEST_TTL,
+        httponly=True,
+        samesite="Lax"
+    )
+
+
+def guest_key_ticket(guest_id, key):
+    return b64encode(token_signature(f"guest-key:{guest_id}:{key}"))
+
+
+# ======================
+# guest expiry (уборка просроченных гостей)
+# ======================
+_guest_sweeper = None
+_guest_sweeper_guard = threading.Lock()
+_guest_sweep_stats = {
+    "runs": 0,
+    "entries": 0,
+    "objects": 0,
+    "failed": 0,
+    "last_run": None,
+    "last": None,
+}
+
+
+def expired_guests(cutoff):
+    if STORAGE_MODE == "sqlite":
+        rows = db().execute("SELECT id, data FROM guests WHERE uploaded_at < ?", (cutoff,))
+        return {key: json.loads(data) for key, data in rows}
+    return {
+        key: record for key, record in repo("guests").records.items()
+        if isinstance(record, dict) and (record.get("uploaded_at") or "") < cutoff
+    }
+
+
+def delete_objects_batched(keys):
+    deleted = failed = 0
+    for i in range(0, len(keys), S3_DELETE_BATCH):
+        chunk = keys[i:i + S3_DELETE_BATCH]
+        try:
+            with s3_timer("delete_objects"):
+                res = s3.delete_objects(
+                    Bucket=S3_BUCKET,
+                    Delete={"Objects": [{"Key": k} for k in chunk], "Quiet": True}
+                )
+        except Exception:
+            app.logger.exception("delete_objects failed for %d keys", len(chunk))
+            failed += len(chunk)
+            continue
+        errors = res.get("Errors") or []
+        for err in errors:
+            app.logger.warning("could not delete %s: %s", err.get("Key"), err.get("Code"))
+        failed += len(errors)
+        deleted += len(chunk) - len(errors)
+    return deleted, failed
+
+
+def sweep_guests(now=None):
+    now = now or datetime.utcnow()
+    cutoff = (now - timedelta(seconds=GUEST_TTL)).isoformat()
+
+    # выборка и удаление под одной блокировкой: гость, успевший
+    # загрузить новое фото, в удаление не попадёт
+    with table_transaction("guests"):
+        expired = expired_guests(cutoff)
+        delete_records("guests", list(expired))
+
+    keys = sorted(set(released_keys(expired.values(), derivatives=False)))
+    deleted, failed = delete_objects_batched(keys)
+
+    result = {"entries": len(expired), "objects": deleted, "failed": failed}
+    with _guest_sweeper_guard:
+        for field, value in result.items():
+            _guest_sweep_stats[field] += value
+        _guest_sweep_stats["runs"] += 1
+        _guest_sweep_stats["last_run"] = now.isoformat()
+        _guest_sweep_stats["last"] = result
+    return result
+
+
+def start_guest_sweeper():
+    global _guest_sweeper
+    with _guest_sweeper_guard:
+        if _guest_sweeper is None and GUEST_SWEEP_INTERVAL:
+            _guest_sweeper = threading.Thread(
+                target=guest_sweeper_loop, name="guest-sweeper", daemon=True
+            )
+            _guest_sweeper.start()
+
+
+def restart_guest_sweeper():
+    # после fork (gunicorn --preload) потока из родителя в воркере нет,
+    # а блокировка могла остаться захваченной
+    global _guest_sweeper, _guest_sweeper_guard
+    _guest_sweeper = None
+    _guest_sweeper_guard = threading.Lock()
+    start_guest_sweeper()
+
+
+def guest_sweeper_loop():
+    while True:
+        time.sleep(GUEST_SWEEP_INTERVAL)
+        try:
+            sweep_guests()
+        except Exception:
+            app.logger.exception("guest sweep failed")
+
+
+@app.route("/api/system/guest-sweep", methods=["GET"])
+def guest_sweep_stats():
+    if not trusted_header(ADMIN_HEADER):
+        return jsonify({"error": "forbidden"}), 403
+
+    with _guest_sweeper_guard:
+        return jsonify({"sweeper": dict(_guest_sweep_stats)}), 200
+
+
+@app.cli.command("sweep-guests")
+def sweep_guests_command():
+    """Однократно убирает просроченные загрузки гостей (для cron)."""
+    result = sweep_guests()
+    print(f"- entries: {result['entries']}, objects: {result['objects']}, failed: {result['failed']}")
+
+
+# ======================
+# user upload
+# ======================
+@app.route("/api/upload-user", methods=["POST"])
+@with_user
+@bucket_view
+def upload_user():
+    user_id = g.user_id
+    if not user_id:
+        return jsonify({"error": "user_id_missing"}), 400
+
+    if "file" not in request.files:
+        return jsonify({"error": "no_file"}), 400
+
+    file = request.files["file"]
+    size, error = check_image_file(file)
+    if error:
+        return jsonify({"error": error}), 400
+
+    title = request.form.get("title") or file.filename
+
+    ext = os.path.splitext(file.filename)[1].lower()
+    image_id = str(uuid.uuid4())
+    key = f"{USER_PREFIX}{user_id}/{image_id}{ext}"
+    record = new_image_record(user_id, image_id, key, title)
+    # sha256 посчитан, пока форма читалась из запроса
+    record["digest"] = user_digest(user_id, file.stream.sha256)
+
+    if UPLOAD_MODE == "async":
+        job = yield from enqueue_upload(file, key, file.mimetype, record)
+        if job is None:
+            return jsonify({"error": "upload_queue_full"}), 503
+        return jsonify({"message": "accepted", "job": job}), 202
+
+    # превью фоновая задача строит по оригиналу из бакета
+    upload = BucketCall("upload_fileobj", key, body=file, content_type=file.mimetype, size=size)
+    blob = yield from store_once(record["digest"], key, upload, size)
+    finish_image_upload(record, blob)
+
+    return jsonify({"message": "uploaded", "image": record}), 201
+
+
+def finish_image_upload(record, blob):
+    use_blob(record, blob)
+    append_record("images", record)
+    if not blob_has_derivatives(blob):
+        schedule_derivatives(record)
+
+
+@app.route("/api/upload-user/stream", methods=["PUT"])
+@with_user
+@bucket_view
+def stream_user_upload():
+    user_id = g.user_id
+    if not user_id:
+        return jsonify({"error": "user_id_missing"}), 400
+
+    ext, error = stream_args()
+    if error:
+        return error
+
+    image_id = str(uuid.uuid4())
+    key = f"{USER_PREFIX}{user_id}/{image_id}{ext}"
+
+    body = yield from stream_to_s3(key, request.mimetype)
+    if body is None:
+        return jsonify({"error": "file_too_large"}), 400
+
+    # хэш известен только после загрузки: дубликат удаляем уже из бакета
+    title = request.args.get("title") or request.args.get("filename")
+    record = new_image_record(user_id, image_id, key, title)
+    record["digest"] = user_digest(user_id, body.sha256)
+    blob = claim_blob(record["digest"], key, body.size)
+    if blob["key"] != key:
+        yield from delete_object_quietly(key)
+    finish_image_upload(record, blob)
+
+    return jsonify({"message": "uploaded", "image": record}), 201
+
+
+_batch_executor = None
+_batch_executor_guard = threading.Lock()
+
+
+def batch_executor():
+    global _batch_executor
+    with _batch_executor_guard:
+        if _batch_executor is None:
+            _batch_executor = ThreadPoolExecutor(
+                max_workers=BATCH_UPLOAD_WORKERS, thread_name_prefix="batch"
+            )
+        return _batch_executor
+
+
+@app.route("/api/upload-user/batch", methods=["POST"])
+@with_user
+@bucket_view
+def upload_user_batch():
+    user_id = g.user_id
+    if not user_id:
+        return jsonify({"error": "user_id_missing"}), 400
+
+    files = request.files.getlist("files")
+    if not files:
+        return jsonify({"error": "no_file"}), 400
+    if len(files) > BATCH_MAX_FILES:
+        return jsonify({"error": "too_many_files"}), 400
+
+    results = [{"filename": f.filename} for f in files]
+    pending = []
+    for result, file in zip(results, files):
+        size, error = check_image_file(file)
+        if error:
+            result["error"] = error
+            continue
+
+        image_id = str(uuid.uuid4())
+        ext = os.path.splitext(file.filename)[1].lower()
+        key = f"{USER_PREFIX}{user_id}/{image_id}{ext}"
+        record = new_image_record(user_id, image_id, key, file.filename)
+        record["digest"] = user_digest(user_id, file.stream.sha256)
+        upload = BucketCall("upload_fileobj", key, body=file, content_type=file.mimetype, size=size)
+        pending.append((result, record, store_once(record["digest"], key, upload, size)))
+
+    blobs = yield [flow for _result, _record, flow in pending]
+
+    uploaded = []
+    for (result, record, _flow), blob in zip(pending, blobs):
+        if isinstance(blob, Exception):
+            app.logger.error("batch upload of %s failed", record["key"], exc_info=blob)
+            result["error"] = "upload_failed"
+            continue
+        use_blob(record, blob)
+        result["image"] = record
+        uploaded.append((record, blob))
+
+    append_records("images", [record for record, _ in uploaded])
+    for record, blob in uploaded:
+        if not blob_has_derivatives(blob):
+            schedule_derivatives(record)
+
+    status = 201 if uploaded else 400
+    return jsonify({"message": "uploaded" if uploaded else "nothing_uploaded", "results": results}), status
+
+
+def check_image_file(file):
+    if not file.filename:
+        return None, "empty_filename"
+
+    if not (file.mimetype or "").startswith("image/"):
+        return None, "only_images_allowed"
+
+    file.seek(0, os.SEEK_END)
+    size = file.tell()
+    file.seek(0)
+    if size > MAX_SIZE_BYTES:
+        return None, "file_too_large"
+    return size, None
+
+
+def new_image_record(user_id, image_id, key, title):
+    url = public_url(key)
+
+    return {
+        "id": image_id,
+        "user_id": user_id,
+        "title": title,
+        "album_id": None,  #для альбомов
+        "key": key,
+        "url": url,
+        "created_at": datetime.utcnow().isoformat()
+    }
+
+
+# ======================
+# direct upload (presigned POST)
+# ======================
+# Шаг 1: /presign выдаёт политику, с которой браузер сам шлёт файл
+#         в бакет (лимит размера и image/* проверяет хранилище).
+# Шаг 2: /confirm проверяет, что объект появился, и записывает метаданные.
+# Байты файла через воркеры Flask при этом не идут.
+def presign_upload(key, content_type):
+    with s3_timer("generate_presigned_post"):
+        return s3.generate_presigned_post(
+            Bucket=S3_BUCKET,
+            Key=key,
+            Fields={"Content-Type": content_type},
+            Conditions=[
+                ["starts-with", "$Content-Type", "image/"],
+                ["content-length-range", 1, MAX_SIZE_BYTES],
+            ],
+            ExpiresIn=PRESIGN_EXPIRES,
+        )
+
+
+def presign_args(data):
+    filename = data.get("filename") or ""
+    content_type = data.get("content_type") or ""
+
+    if not filename:
+        return None, None, (jsonify({"error": "empty_filename"}), 400)
+    if not content_type.startswith("image/"):
+        return None, None, (jsonify({"error": "only_images_allowed"}), 400)
+
+    return os.path.splitext(filename)[1].lower(), content_type, None
+
+
+def check_uploaded_object(key):
+    try:
+        head = yield BucketCall("head_object", key)
+    except Exception:
+        return jsonify({"error": "upload_not_found"}), 400
+
+    if head.get("ContentLength", 0) > MAX_SIZE_BYTES:
+        return jsonify({"error": "file_too_large"}), 400
+    if not (head.get("ContentType") or "").startswith("image/"):
+        return jsonify({"error": "only_images_allowed"}), 400
+    return None
+
+
+@app.route("/api/upload-user/presign", methods=["POST"])
+@with_user
+def presign_user_upload():
+    data = request.get_json() or {}
+    user_id = g.user_id
+    if not user_id:
+        return jsonify({"error": "user_id_missing"}), 400
+
+    ext, content_type, error = presign_args(data)
+    if error:
+        return error
+
+    image_id = str(uuid.uuid4())
+    key = f"{USER_PREFIX}{user_id}/{image_id}{ext}"
+
+    return jsonify({
+        "image_id": image_id,
+        "key": key,
+        "upload": presign_upload(key, content_type),
+        "expires_in": PRESIGN_EXPIRES
+    }), 200
+
+
+@app.route("/api/upload-user/confirm", methods=["POST"])
+@with_user
+@bucket_view
+def confirm_user_upload():
+    data = request.get_json() or {}
+    user_id = g.user_id
+    image_id = data.get("image_id") or ""
+    key = data.get("key") or ""
+
+    if not user_id:
+        return jsonify({"error": "user_id_missing"}), 400
+
+    # ключ должен быть тем, что выдал /presign этому пользователю
+    prefix = f"{USER_PREFIX}{user_id}/{image_id}"
+    if not image_id or not key.startswith(prefix) or "/" in key[len(prefix):]:
+        return jsonify({"error": "bad_key"}), 400
+
+    # повторное подтверждение (ретрай клиента) не плодит записи
+    existing = find_image(image_id)
+    if existing:
+        if existing.get("key") != key:
+            return jsonify({"error": "bad_key"}), 400
+        return jsonify({"message": "uploaded", "image": existing}), 200
+
+    error = yield from check_uploaded_object(key)
+    if error:
+        return error
+
+    title = data.get("title") or os.path.basename(key)
+    record = new_image_record(user_id, image_id, key, title)
+    append_record("images", record)
+    schedule_derivatives(record)
+
+    return jsonify({"message": "uploaded", "image": record}), 201
+
+
+@app.route("/api/upload-guest/presign", methods=["POST"])
+def presign_guest_upload():
+    data = request.get_json() or {}
+    ext, content_type, error = presign_args(data)
+    if error:
+        return error
+
+    key = f"{GUEST_PREFIX}{uuid.uuid4()}{ext}"
+    # ключ привязан к гостю: cookie ставим уже здесь, подпись проверит confirm
+    guest_id = get_or_create_guest_id()
+
+    resp = jsonify({
+        "key": key,
+        "ticket": guest_key_ticket(guest_id, key),
+        "upload": presign_upload(key, content_type),
+        "expires_in": PRESIGN_EXPIRES
+    })
+    set_guest_cookie(resp, guest_id)
+    return resp, 200
+
+
+@app.route("/api/upload-guest/confirm", methods=["POST"])
+@bucket_view
+def confirm_guest_upload():
+    data = request.get_json() or {}
+    key = data.get("key") or ""
+
+    if not key.startswith(GUEST_PREFIX) or "/" in key[len(GUEST_PREFIX):]:
+        return jsonify({"error": "bad_key"}), 400
+
+    # чужой ключ (или ключ без presign) не подтверждаем
+    guest_id = request.cookies.get("guest_id") or ""
+    ticket = str(data.get("ticket") or "")
+    if not guest_id or not hmac.compare_digest(
+        ticket.encode(), guest_key_ticket(guest_id, key).encode()
+    ):
+        return jsonify({"error": "bad_key"}), 400
+
+    error = yield from check_uploaded_object(key)
+    if error:
+        return error
+
+    title = data.get("title") or os.path.basename(key)
+    return (yield from guest_uploaded(guest_id, key, title))
+
+
+# ======================
+# gallery / image
+# ======================
+@app.route("/api/gallery/<user_id>", methods=["GET"])
+def gallery(user_id):
+    limit, after, error = page_args()
+    if error:
+        return error
+    fields, error = field_args()
+    if error:
+        return error
+
+    etag = resource_etag(("images", "user", user_id))
+    cached = not_modified(etag) or cached_response(etag)
+    if cached:
+        return cached
+
+    return json_response(gallery_page(user_id, limit, after, fields), etag)
+
+
+def gallery_page(user_id, limit, after, fields):
+    if limit is None:
+        return {"images": project(user_images(user_id), fields)}
+
+    images, next_cursor = paginate(
+        lambda n, a: user_images(user_id, limit=n, after=a), limit, after
+    )
+    return {"images": project(images, fields), "next_cursor": next_cursor}
+
+
+@app.route("/api/bootstrap/<user_id>", methods=["GET"])
+def bootstrap(user_id):
+    limit, after, error = page_args()
+    if error:
+        return error
+    fields, error = field_args()
+    if error:
+        return error
+
+    etag = resource_etag(
+        ("users", "user", user_id),
+        ("albums", "user", user_id),
+        ("images", "user", user_id),
+    )
+    cached = not_modified(etag) or cached_response(etag)
+    if cached:
+        return cached
+
+    u = find_user(user_id)
+    if not u:
+        return jsonify({"error": "user_not_found"}), 404
+
+    return json_response({
+        "user": public_user(u),
+        "albums": user_albums(user_id),
+        **gallery_page(user_id, limit, after, fields)
+    }, etag)
+
+
+@app.route("/api/image/<image_id>", methods=["GET"])
+def get_image(image_id):
+    img = find_image(image_id)
+    if not img:
+        return jsonify({"error": "not_found"}), 404
+
+    # владелец у изображения не меняется, поэтому версию можно взять
+    # после первого чтения, а само изображение перечитать уже после неё
+    etag = resource_etag(("images", "user", img.get("user_id")))
+    cached = not_modified(etag)
+    if cached:
+        return cached
+
+    img = find_image(image_id)
+    if not img:
+        return jsonify({"error": "not_found"}), 404
+    return jsonify({"image": img}), 200, etag_headers(etag)
+
+
+@app.route("/api/image/<image_id>", methods=["DELETE"])
+@with_user
+def delete_image(image_id):
+    user_id = g.user_id
+    if not user_id:
+        return jsonify({"error": "user_id_missing"}), 400
+
+    # проверка владельца и удаление под одной блокировкой
+    with table_transaction("images"):
+        img = find_image(image_id)
+        if not img:
+            return jsonify({"error": "not_found"}), 404
+        if img.get("user_id") != user_id:
+            return jsonify({"error": "forbidden"}), 403
+        delete_records("images", [image_id])
+
+    # объект и превью уходят из бакета, только если на них никто больше не ссылается
+    release_image(img)
+    return jsonify({"message": "ok"}), 200
+
+
+# ======================
+# image proxy (/api/image/<id>/raw)
+# ======================
+# Для приватного бакета объект идёт через приложение. Горячие объекты
+# держит LRU по ключу S3: сначала в памяти (IMAGE_CACHE_MEMORY_BYTES),
+# вытесненные оттуда — файлами в IMAGE_CACHE_DIR (IMAGE_CACHE_DISK_BYTES,
+# переживает перезапуск). Одновременные промахи по одному ключу ждут
+# одну загрузку из бакета. Ключи не переиспользуются (uuid в имени),
+# поэтому запись не устаревает, пока жив сам объект.
+IMAGE_CACHE_MEMORY_BYTES = 64 * 1024 * 1024
+IMAGE_CACHE_DISK_BYTES = 1024 * 1024 * 1024
+IMAGE_CACHE_DIR = os.getenv("PIXO_IMAGE_CACHE", "image_cache")
+IMAGE_PROXY_MAX_AGE = 60 * 60
+
+
+class ObjectCache:
+    """Двухуровневый LRU объектов бакета: key -> (meta, байты | файл)."""
+
+    def __init__(self, memory_bytes, disk_bytes, directory):
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.directory = directory
+        self.memory = OrderedDict()  # key -> (meta, bytes)
+        self.disk = OrderedDict()    # key -> (meta, путь)
+        self.memory_size = 0
+        self.disk_size = 0
+        self.disk_loaded = False
+        self.inflight = {}  # key -> Future загрузки, которую ждут остальные
+        self.lock = threading.Lock()
+
+    def file_path(self, key):
+        return os.path.join(self.directory, hashlib.sha256(key.encode()).hexdigest())
+
+    def load_disk(self):
+        self.disk_loaded = True
+        if not self.disk_bytes or not os.path.isdir(self.directory):
+            return
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json"):
+                continue
+            path = os.path.join(self.directory, name[:-len(".json")])
+            meta = self.read_meta(path)
+            if meta is None:
+                continue  # недописанная или чужая запись — промах
+            entries.append((os.stat(path).st_mtime, meta, path))
+        for _mtime, meta, path in sorted(entries, key=lambda e: e[0]):
+            self.disk[meta["key"]] = (meta, path)
+            self.disk_size += meta["size"]
+        self._trim_disk()
+
+    @staticmethod
+    def read_meta(path):
+        # meta без файла данных, битая или не того размера — не запись кэша
+        try:
+            with open(path + ".json", "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            if not isinstance(meta, dict) or os.path.getsize(path) != meta.get("size"):
+                return None
+            if not all(field in meta for field in ("key", "content_type", "etag", "last_modified")):
+                return None
+        except (OSError, ValueError):
+            return None
+        return meta
+
+    def lookup(self, key):
+        with self.lock:
+            if not self.disk_loaded:
+                self.load_disk()
+            hit = self.memory.get(key)
+            if hit is not None:
+                self.memory.move_to_end(key)
+                return hit[0], hit[1], None
+            hit = self.disk.get(key)
+            if hit is not None:
+                if os.path.exists(hit[1]):
+                    self.disk.move_to_end(key)
+                    return hit[0], None, hit[1]
+                self.disk.pop(key)
+                self.disk_size -= hit[0]["size"]
+        return None
+
+    def get(self, key, fetch):
+        def fetch_flow(key):
+            return fetch(key)
+            yield  # генератор без вызовов бакета
+
+        return run_flow(self.get_flow(key, fetch_flow))
+
+    def get_flow(self, key, fetch):
+        hit = self.lookup(key)
+        if hit is not None:
+            return hit, "memory" if hit[2] is None else "disk"
+
+        with self.lock:
+            future = self.inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self.inflight[key] = Future()
+        if not leader:
+            return (yield future), "coalesced"
+
+        try:
+            meta, data = yield from fetch(key)
+            self.store(key, meta, data)
+        except BaseException as e:
+            # оборванная загрузка (генератор закрыли) для ожидающих — обычная ошибка
+            future.set_exception(e if isinstance(e, Exception) else RuntimeError(f"fetch of {key} aborted"))
+            raise
+        else:
+            future.set_result((meta, data, None))
+        finally:
+            with self.lock:
+                self.inflight.pop(key, None)
+        return (meta, data, None), "miss"
+
+    def store(self, key, meta, data):
+        demoted = []
+        with self.lock:
+            if len(data) <= self.memory_bytes:
+                old = self.memory.pop(key, None)
+                if old is not None:
+                    self.memory_size -= old[0]["size"]
+                self.memory[key] = (meta, data)
+                self.memory_size += meta["size"]
+                while self.memory_size > self.memory_bytes:
+                    old_key, (old_meta, old_data) = self.memory.popitem(last=False)
+                    self.memory_size -= old_meta["size"]
+                    demoted.append((old_key, old_meta, old_data))
+            else:
+                demoted.append((key, meta, data))
+
+        # запись на диск — вне блокировки
+        for old_key, old_meta, old_data in demoted:
+            self.write_disk(old_key, old_meta, old_data)
+
+    def write_disk(self, key, meta, data):
+        if meta["size"] > self.disk_bytes:
+            return
+        with self.lock:
+            if key in self.disk:
+                return
+        path = self.file_path(key)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            # оба файла подменяются целиком: соседний воркер или следующий
+            # запуск видит либо старую пару, либо новую, но не половину meta
+            self.write_atomic(path, data)
+            self.write_atomic(path + ".json", json.dumps(meta).encode())
+        except OSError:
+            app.logger.exception("image cache: failed to write %s", key)
+            return
+
+        with self.lock:
+            if key not in self.disk:
+                self.disk[key] = (meta, path)
+                self.disk_size += meta["size"]
+                self._trim_disk()
+
+    def write_atomic(self, path, data):
+        fd, tmp_path = tempfile.mkstemp(prefix=".cache-", dir=self.directory)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def _trim_disk(self):
+        while self.disk_size > self.disk_bytes:
+            _key, (meta, path) = self.disk.popitem(last=False)
+            self.disk_size -= meta["size"]
+            for p in (path, path + ".json"):
+                try:
+                    os.remove(p)
+                except OSError:
+                    pass
+
+
+image_cache = ObjectCache(IMAGE_CACHE_MEMORY_BYTES, IMAGE_CACHE_DISK_BYTES, IMAGE_CACHE_DIR)
+
+
+def is_missing_object(e):
+    # ObjectNotFound — локальное хранилище, ClientError NoSuchKey / 404 — boto3
+    if isinstance(e, ObjectNotFound):
+        return True
+    code = (getattr(e, "response", None) or {}).get("Error", {}).get("Code")
+    return code in ("NoSuchKey", "404", "NotFound")
+
+
+def fetch_object(key):
+    obj, data = yield BucketCall("get_object", key)
+
+    last_modified = obj.get("LastModified") or datetime.now(timezone.utc)
+    return {
+        "key": key,
+        "content_type": obj.get("ContentType") or "application/octet-stream",
+        "etag": (obj.get("ETag") or "").strip('"') or hashlib.sha256(data).hexdigest()[:32],
+        "last_modified": last_modified.timestamp(),
+        "size": len(data),
+    }, data
+
+
+@app.route("/api/image/<image_id>/raw", methods=["GET", "HEAD"])
+@bucket_view
+def image_raw(image_id):
+    img = find_image(image_id)
+    if not img:
+        return jsonify({"error": "not_found"}), 404
+
+    key = img["key"]
+    variant = request.args.get("variant")
+    if variant:
+        if variant not in DERIVATIVE_SIZES or not img.get(f"{variant}_url"):
+            return jsonify({"error": "variant_not_found"}), 404
+        key = derivative_key(key, variant)
+
+    try:
+        (meta, data, path), source = yield from image_cache.get_flow(key, fetch_object)
+    except Exception as e:
+        if is_missing_object(e):
+            return jsonify({"error": "object_not_found"}), 404
+        app.logger.exception("image proxy: failed to fetch %s", key)
+        return jsonify({"error": "upstream_error"}), 502
+    metric_inc("pixo_image_cache_requests_total", result=source)
+
+    return send_file(
+        path if path is not None else io.BytesIO(data),
+        mimetype=meta["content_type"],
+        conditional=True,
+        etag=meta["etag"],
+        last_modified=datetime.fromtimestamp(meta["last_modified"], timezone.utc),
+        max_age=IMAGE_PROXY_MAX_AGE,
+    )
+
+
+# ======================
+# albums
+# ======================
+@app.route("/api/albums", methods=["POST"])
+@with_user
+def create_album():
+    data = request.get_json() or {}
+    user_id = g.user_id
+    title = (data.get("title") or "").strip()
+
+    if not user_id or not title:
+        return jsonify({"error": "user_id_or_title_missing"}), 400
+
+    album = {
+        "id": str(uuid.uuid4()),
+        "user_id": user_id,
+        "title": title,
+        "created_at": datetime.utcnow().isoformat()
+    }
+    append_record("albums", album)
+
+    return jsonify({"album": album}), 201
+
+
+@app.route("/api/albums/<user_id>", methods=["GET"])
+def list_albums(user_id):
+    etag = resource_etag(("albums", "user", user_id))
+    cached = not_modified(etag) or cached_response(etag)
+    if cached:
+        return cached
+
+    return json_response({"albums": user_albums(user_id)}, etag)
+
+
+#страница конкретного альбома (AlbumPage)
+@app.route("/api/album/<album_id>", methods=["GET"])
+def get_album(album_id):
+    limit, after, error = page_args()
+    if error:
+        return error
+
+    etag = resource_etag(("albums", "album", album_id), ("images", "album", album_id))
+    cached = not_modified(etag) or cached_response(etag)
+    if cached:
+        return cached
+
+    album = find_album(album_id)
+    if not album:
+        return jsonify({"error": "album_not_found"}), 404
+
+    if limit is None:
+        return json_response({"album": album, "images": album_images(album_id)}, etag)
+
+    images, next_cursor = paginate(
+        lambda n, a: album_images(album_id, limit=n, after=a), limit, after
+    )
+    return json_response({"album": album, "images": images, "next_cursor": next_cursor}, etag)
+
+
+@app.route("/api/image/<image_id>/set-album", methods=["POST"])
+@with_user
+def set_image_album(image_id):
+    data = request.get_json() or {}
+    user_id = g.user_id
+    album_id = data.get("album_id")  # может быть "" / None
+
+    if not user_id:
+        return jsonify({"error": "user_id_missing"}), 400
+
+    img = find_image(image_id)
+    if not img:
+        return jsonify({"error": "not_found"}), 404
+
+    # фото должно принадлежать пользователю
+    if img.get("user_id") != user_id:
+        return jsonify({"error": "forbidden"}), 403
+
+    # если album_id указан — проверим альбом
+    if album_id:
+        alb = find_album(album_id)
+        if not alb or alb.get("user_id") != user_id:
+            return jsonify({"error": "album_not_found"}), 404
+
+    # только album_id: превью, которые фон дописал после find_image, не затираются
+    img = patch_record("images", image_id, {"album_id": album_id or None})
+    if img is None:
+        return jsonify({"error": "not_found"}), 404
+    return jsonify({"message": "ok", "image": img}), 200
+
+
+@app.route("/api/images/set-album", methods=["POST"])
+@with_user
+def set_images_album():
+    data = request.get_json() or {}
+    user_id = g.user_id
+    album_id = data.get("album_id") or None
+    image_ids = data.get("image_ids")
+
+    if not user_id:
+        return jsonify({"error": "user_id_missing"}), 400
+
+    if not isinstance(image_ids, list) or not image_ids:
+        return jsonify({"error": "image_ids_missing"}), 400
+    if len(image_ids) > BULK_MAX_IDS:
+        return jsonify({"error": "too_many_ids"}), 400
+
+    if album_id:
+        alb = find_album(album_id)
+        if not alb or alb.get("user_id") != user_id:
+            return jsonify({"error": "album_not_found"}), 404
+
+    ids = list(dict.fromkeys(str(i) for i in image_ids))
+    results = []
+    changed = []
+    # чтение и запись под одной блокировкой: параллельные правки не теряются
+    with table_transaction("images"):
+        images = find_images(ids)
+        for image_id in ids:
+            img = images.get(image_id)
+            if img is None:
+                results.append({"id": image_id, "error": "not_found"})
+            elif img.get("user_id") != user_id:
+                results.append({"id": image_id, "error": "forbidden"})
+            else:
+                if img.get("album_id") != album_id:
+                    img["album_id"] = album_id
+                    changed.append(img)
+                results.append({"id": image_id, "album_id": album_id})
+        put_records("images", changed)
+
+    return jsonify({"message": "ok", "album_id": album_id, "results": results}), 200
+
+# ======================
+# profile / settings
+# ======================
+
+@app.route("/api/user/<user_id>", methods=["GET"])
+def get_user(user_id):
+    etag = resource_etag(("users", "user", user_id))
+    cached = not_modified(etag)
+    if cached:
+        return cached
+
+    u = find_user(user_id)
+    if not u:
+        return jsonify({"error": "user_not_found"}), 404
+
+    return jsonify({"user": public_user(u)}), 200, etag_headers(etag)
+
+
+def public_user(u):
+    return {
+        "id": u.get("id"),
+        "email": u.get("email"),
+        "username": u.get("username", ""),
+        "lang": u.get("lang", "ru"),
+        "created_at": u.get("created_at")
+    }
+
+
+@app.route("/api/user/<user_id>/update", methods=["POST"])
+@with_user
+def update_user(user_id):
+    if g.user_id != user_id:
+        return jsonify({"error": "forbidden"}), 403
+
+    data = request.get_json() or {}
+    email = (data.get("email") or "").strip()
+    username = (data.get("username") or "").strip()
+    lang = (data.get("lang") or "ru").strip()
+
+    # чтение и запись в одной транзакции: параллельная смена пароля не теряется
+    with table_transaction("users"):
+        u = find_user(user_id)
+        if not u:
+            return jsonify({"error": "user_not_found"}), 404
+
+        fields = {"username": username, "lang": lang}
+
+        # если меняем email — проверим уникальность
+        if email and email != u.get("email"):
+            if find_user_by_email(email) is not None:
+                return jsonify({"error": "email_taken"}), 400
+            fields["email"] = email
+
+        try:
+            u = patch_record("users", user_id, fields)
+        except DuplicateRecord:
+            return jsonify({"error": "email_taken"}), 400
+
+    return jsonify({
+        "message": "ok",
+        "user": {
+            "id": u.get("id"),
+            "email": u.get("email"),
+            "username": u.get("username", ""),
+            "lang": u.get("lang", "ru")
+        }
+    }), 200
+
+
+@app.route("/api/user/<user_id>/change-password", methods=["POST"])
+@with_user
+def change_password(user_id):
+    if g.user_id != user_id:
+        return jsonify({"error": "forbidden"}), 403
+
+    data = request.get_json() or {}
+    old_password = data.get("old_password") or ""
+    new_password = data.get("new_password") or ""
+
+    if not old_password or not new_password:
+        return jsonify({"error": "old_or_new_missing"}), 400
+
+    with table_transaction("users"):
+        u = find_user(user_id)
+        if not u:
+            return jsonify({"error": "user_not_found"}), 404
+
+        if u.get("password") != old_password:
+            return jsonify({"error": "wrong_old_password"}), 400
+
+        patch_record("users", user_id, {"password": new_password})
+
+    return jsonify({"message": "ok"}), 200
+
+
+# ======================
+# старт процесса
+# ======================
+_serving = False
+
+
+def init_serving(debug=False):
+    # вызывают точки входа сервера (wsgi.py, asgi.py, __main__), а не импорт:
+    # тесты, скрипты и процессы пула превью уборку гостей не запускают
+    global _serving
+    require_session_secret(debug or app.debug)
+    if _serving:
+        return
+    _serving = True
+    # уборка гостей идёт с запуска воркера, а не с первой гостевой загрузки
+    if GUEST_SWEEPER:
+        start_guest_sweeper()
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=restart_guest_sweeper)
+
+
+# ======================
+if __name__ == "__main__":
+    init_serving(debug=True)
+    app.run(port=5000, debug=True)
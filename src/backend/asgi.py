@@ -0,0 +1,659 @@
+"""ASGI-точка входа: uvicorn asgi:app --workers 4"""
+
+import asyncio
+import contextvars
+import hashlib
+import inspect
+import io
+import os
+import sys
+import tempfile
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import AsyncExitStack
+from functools import partial
+
+from flask import g
+from werkzeug.exceptions import HTTPException
+from werkzeug.wsgi import FileWrapper
+
+import app as pixo
+
+try:
+    from aiobotocore.config import AioConfig
+    from aiobotocore.session import get_session
+except ImportError:  # без aiobotocore вызовы S3 идут через ThreadedObjectStore
+    get_session = None
+
+ASGI_VIEW_THREADS = int(os.getenv("PIXO_ASGI_THREADS") or 32)
+ASGI_FILE_THREADS = 8
+ASGI_S3_THREADS = 16
+ASGI_S3_CONNECTIONS = 256  # соединений с бакетом у асинхронного клиента на процесс
+
+ASGI_SPOOL_MEMORY = 256 * 1024  # тело до этого размера не пишется на диск
+ASGI_WRITE_CHUNK = 1024 * 1024  # на диск — кусками не меньше этого
+ASGI_READ_CHUNK = 1024 * 1024
+# часть multipart-загрузки в S3 (меньше S3 не принимает); больше одной
+# части тела в памяти не держим, тело меньше части уходит одним PUT
+ASGI_S3_PART_SIZE = 5 * 1024 * 1024
+
+# BucketCall.op -> метод хранилища (кроме upload_fileobj)
+STORE_METHODS = {"delete_object": "delete", "head_object": "head", "get_object": "get"}
+
+
+# ======================
+# request body (тело запроса)
+# ======================
+class BodySpool:
+    def __init__(self, run_file):
+        self.run_file = run_file
+        self.buffer = io.BytesIO()
+        self.file = None
+        self.pending = []
+        self.pending_size = 0
+        self.size = 0
+
+    async def write(self, chunk):
+        self.size += len(chunk)
+        if self.file is None:
+            if self.size <= ASGI_SPOOL_MEMORY:
+                self.buffer.write(chunk)
+                return
+            self.file = await self.run_file(tempfile.TemporaryFile)
+            self.pending = [self.buffer.getvalue()]
+            self.pending_size = len(self.pending[0])
+            self.buffer = None
+
+        self.pending.append(chunk)
+        self.pending_size += len(chunk)
+        if self.pending_size >= ASGI_WRITE_CHUNK:
+            await self.flush()
+
+    async def flush(self):
+        if self.pending:
+            data = b"".join(self.pending)
+            self.pending, self.pending_size = [], 0
+            await self.run_file(self.file.write, data)
+
+    async def stream(self):
+        if self.file is None:
+            self.buffer.seek(0)
+            return self.buffer
+        await self.flush()
+        await self.run_file(self.file.seek, 0)
+        return self.file
+
+    def close(self):
+        (self.file or self.buffer).close()
+
+
+class StreamedBody:
+    def __init__(self, receive, backend):
+        self.receive = receive
+        self.backend = backend
+        self.size = 0
+        self.sha256 = hashlib.sha256()
+
+    async def __aiter__(self):
+        while True:
+            message = await self.receive()
+            if message["type"] == "http.disconnect":
+                raise self.backend.ClientDisconnected()
+            chunk = message.get("body", b"")
+            if chunk:
+                self.size += len(chunk)
+                if self.size > self.backend.MAX_SIZE_BYTES:
+                    raise self.backend.FileTooLarge()
+                self.sha256.update(chunk)
+                yield chunk
+            if not message.get("more_body", False):
+                return
+
+
+def content_length(environ):
+    try:
+        return int(environ.get("CONTENT_LENGTH") or "")
+    except ValueError:
+        return None
+
+
+# ======================
+# object stores (асинхронные клиенты)
+# ======================
+# Общий интерфейс: upload(key, chunks, content_type), где chunks —
+# асинхронный итератор байт, delete(key), head(key) -> ответ head_object
+# и get(key) -> (ответ get_object без Body, байты объекта).
+class AsyncLocalStore:
+    def __init__(self, store, run_file):
+        self.store = store
+        self.run_file = run_file
+
+    @staticmethod
+    def open_temp(directory):
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix=".upload-", dir=directory)
+        return os.fdopen(fd, "wb"), tmp_path
+
+    @staticmethod
+    def discard(f, tmp_path):
+        f.close()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    async def upload(self, key, chunks, content_type):
+        path = self.store.path(key)
+        f, tmp_path = await self.run_file(self.open_temp, os.path.dirname(path))
+        try:
+            pending, pending_size = [], 0
+            async for chunk in chunks:
+                pending.append(chunk)
+                pending_size += len(chunk)
+                if pending_size >= ASGI_WRITE_CHUNK:
+                    await self.run_file(f.write, b"".join(pending))
+                    pending, pending_size = [], 0
+            await self.run_file(f.write, b"".join(pending))
+            await self.run_file(f.close)
+            await self.run_file(os.replace, tmp_path, path)
+        except BaseException:
+            await self.run_file(self.discard, f, tmp_path)
+            raise
+        await self.run_file(self.store.write_meta, key, content_type)
+
+    async def delete(self, key):
+        await self.run_file(self.store.delete_object, None, key)
+
+    async def head(self, key):
+        return await self.run_file(self.store.head_object, None, key)
+
+    async def get(self, key):
+        return await self.run_file(pixo.read_object, self.store, key)
+
+
+class AsyncS3Store:
+    def __init__(self, backend):
+        self.backend = backend
+        self.client = None
+        self.stack = None
+        self.lock = asyncio.Lock()
+
+    async def connect(self):
+        async with self.lock:
+            if self.client is None:
+                stack = AsyncExitStack()
+                self.client = await stack.enter_async_context(get_session().create_client(
+                    "s3",
+                    endpoint_url=self.backend.S3_ENDPOINT,
+                    aws_access_key_id=self.backend.S3_ACCESS_KEY,
+                    aws_secret_access_key=self.backend.S3_SECRET_KEY,
+                    config=AioConfig(signature_version="s3v4", max_pool_connections=ASGI_S3_CONNECTIONS),
+                ))
+                self.stack = stack
+        return self.client
+
+    async def upload(self, key, chunks, content_type):
+        client = await self.connect()
+        bucket = self.backend.S3_BUCKET
+        part = bytearray()
+        upload_id = None
+        parts = []
+        try:
+            async for chunk in chunks:
+                part += chunk
+                if len(part) < ASGI_S3_PART_SIZE:
+                    continue
+                if upload_id is None:
+                    res = await client.create_multipart_upload(Bucket=bucket, Key=key, ContentType=content_type)
+                    upload_id = res["UploadId"]
+                await self.upload_part(client, key, upload_id, parts, part)
+                part = bytearray()
+
+            if upload_id is None:
+                await client.put_object(Bucket=bucket, Key=key, Body=bytes(part), ContentType=content_type)
+                return
+            if part:
+                await self.upload_part(client, key, upload_id, parts, part)
+            await client.complete_multipart_upload(
+                Bucket=bucket, Key=key, UploadId=upload_id, MultipartUpload={"Parts": parts}
+            )
+        except BaseException:
+            if upload_id is not None:
+                try:
+                    await client.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+                except Exception:
+                    self.backend.app.logger.exception("abort_multipart_upload failed for %s", key)
+            raise
+
+    async def upload_part(self, client, key, upload_id, parts, body):
+        number = len(parts) + 1
+        res = await client.upload_part(
+            Bucket=self.backend.S3_BUCKET, Key=key, UploadId=upload_id, PartNumber=number, Body=bytes(body)
+        )
+        parts.append({"PartNumber": number, "ETag": res["ETag"]})
+
+    async def delete(self, key):
+        client = await self.connect()
+        await client.delete_object(Bucket=self.backend.S3_BUCKET, Key=key)
+
+    async def head(self, key):
+        client = await self.connect()
+        return await client.head_object(Bucket=self.backend.S3_BUCKET, Key=key)
+
+    async def get(self, key):
+        client = await self.connect()
+        obj = await client.get_object(Bucket=self.backend.S3_BUCKET, Key=key)
+        async with obj.pop("Body") as body:
+            return obj, await body.read()
+
+    async def close(self):
+        if self.stack is not None:
+            await self.stack.aclose()
+            self.client = self.stack = None
+
+
+class ChunkReader:
+    """Файловый объект для upload_fileobj поверх асинхронного итератора кусков."""
+
+    def __init__(self, chunks, loop):
+        self.chunks = chunks.__aiter__()
+        self.loop = loop
+        self.buffer = bytearray()
+        self.done = False
+
+    async def next_chunk(self):
+        return await self.chunks.__anext__()
+
+    def read(self, size=-1):
+        while not self.done and (size is None or size < 0 or len(self.buffer) < size):
+            try:
+                self.buffer += asyncio.run_coroutine_threadsafe(self.next_chunk(), self.loop).result()
+            except StopAsyncIteration:
+                self.done = True
+        if size is None or size < 0:
+            size = len(self.buffer)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def seekable(self):
+        return False
+
+
+class ThreadedObjectStore:
+    def __init__(self, backend, client, run_s3):
+        self.backend = backend
+        self.client = client
+        self.run_s3 = run_s3
+
+    async def upload(self, key, chunks, content_type):
+        await self.run_s3(
+            self.client.upload_fileobj,
+            ChunkReader(chunks, asyncio.get_running_loop()),
+            self.backend.S3_BUCKET,
+            key,
+            ExtraArgs={"ContentType": content_type},
+            Config=self.backend.transfer_config(),
+        )
+
+    async def delete(self, key):
+        await self.run_s3(self.client.delete_object, Bucket=self.backend.S3_BUCKET, Key=key)
+
+    async def head(self, key):
+        return await self.run_s3(self.client.head_object, Bucket=self.backend.S3_BUCKET, Key=key)
+
+    async def get(self, key):
+        return await self.run_s3(self.backend.read_object, self.client, key)
+
+
+# ======================
+# Flask request (запрос по шагам)
+# ======================
+class FlowRequest:
+    def __init__(self, backend, environ, views):
+        self.backend = backend
+        self.environ = environ
+        self.views = views
+        self.context = contextvars.Context()
+        self.ctx = backend.app.request_context(environ)
+        self.response = None
+
+    def run(self, fn, *args):
+        return asyncio.get_running_loop().run_in_executor(self.views, partial(self.context.run, fn, *args))
+
+    def start(self, too_large):
+        # before_request и роут; генератор bucket_view или None — ответ уже готов
+        app = self.backend.app
+        self.ctx.push()
+        try:
+            rv = app.preprocess_request()
+            if rv is None:
+                rv = self.backend.upload_too_large(None) if too_large else app.dispatch_request()
+        except Exception as e:
+            self.finish(error=e)
+            return None
+        if not inspect.isgenerator(rv):
+            self.finish(rv)
+            return None
+        self.pause_profile()
+        return rv
+
+    def step(self, flow, result, error):
+        # cProfile снимает поток, который его включил: между шагами профиль на паузе
+        profiler = g.get("profiler")
+        if profiler is not None:
+            profiler.enable()
+        try:
+            return self.backend.flow_step(flow, result, error)
+        finally:
+            self.pause_profile()
+
+    def pause_profile(self):
+        profiler = g.get("profiler")
+        if profiler is not None:
+            profiler.disable()
+
+    def finish(self, rv=None, error=None):
+        # как full_dispatch_request и wsgi_app: обработчики ошибок, after_request, teardown
+        app = self.backend.app
+        failed = None
+        try:
+            try:
+                response = app.finalize_request(rv if error is None else self.handle_user_exception(error))
+            except Exception as e:
+                failed = e
+                response = app.handle_exception(e)
+            body, status, headers = response.get_wsgi_response(self.environ)
+            if not response.direct_passthrough:
+                body = [b"".join(body)]
+            self.response = int(status.split(" ", 1)[0]), headers, body
+        finally:
+            self.ctx.pop(failed)
+
+    def handle_user_exception(self, error):
+        # необработанную ошибку Flask пробрасывает голым raise — нужен активный except
+        try:
+            raise error
+        except Exception as e:
+            return self.backend.app.handle_user_exception(e)
+
+    def abort(self, error):
+        self.ctx.pop(error)
+
+
+# ======================
+# ASGI app
+# ======================
+class PixoAsgi:
+    def __init__(self, backend):
+        self.backend = backend
+        self.views = ThreadPoolExecutor(ASGI_VIEW_THREADS, thread_name_prefix="asgi-view")
+        self.files = ThreadPoolExecutor(ASGI_FILE_THREADS, thread_name_prefix="asgi-file")
+        self.s3_threads = ThreadPoolExecutor(ASGI_S3_THREADS, thread_name_prefix="asgi-s3")
+        self.store = None
+        self.store_for = None
+        self.jobs = set()  # BackgroundFlow (PIXO_UPLOAD_MODE=async) — asyncio-задачи
+
+    def run(self, executor, fn, *args, **kwargs):
+        return asyncio.get_running_loop().run_in_executor(executor, partial(fn, *args, **kwargs))
+
+    def run_file(self, fn, *args, **kwargs):
+        return self.run(self.files, fn, *args, **kwargs)
+
+    def run_s3(self, fn, *args, **kwargs):
+        return self.run(self.s3_threads, fn, *args, **kwargs)
+
+    def object_store(self):
+        # асинхронный клиент для текущего backend.s3 (тесты его подменяют)
+        client = self.backend.s3
+        if self.store_for is not client:
+            if isinstance(client, self.backend.LocalObjectStore):
+                store = AsyncLocalStore(client, self.run_file)
+            elif get_session is not None and isinstance(client, self.backend.LazyClient):
+                store = AsyncS3Store(self.backend)
+            else:
+                if isinstance(client, self.backend.LazyClient):
+                    self.backend.app.logger.warning("aiobotocore is not installed, S3 calls run in threads")
+                store = ThreadedObjectStore(self.backend, client, self.run_s3)
+            self.store, self.store_for = store, client
+        return self.store
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self.lifespan(receive, send)
+        if scope["type"] != "http":
+            return  # websocket не обслуживаем
+
+        backend = self.backend
+        environ = self.environ(scope)
+        endpoint = self.endpoint(environ)
+        try:
+            spool = None
+            too_large = False
+            # тело потоковой загрузки читает сам вызов бакета (StreamedBody)
+            if endpoint not in backend.STREAM_UPLOAD_ENDPOINTS:
+                # больше BATCH_MAX_BYTES не примет ни один роут app.py
+                limit = backend.upload_limit(endpoint) or backend.BATCH_MAX_BYTES + backend.MULTIPART_OVERHEAD
+                spool = await self.receive_body(environ, receive, limit)
+                too_large = spool is None
+            try:
+                response = await self.handle(environ, receive, too_large)
+            finally:
+                if spool is not None:
+                    spool.close()
+            await self.send_response(*response, send)
+        except backend.ClientDisconnected:
+            return
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                try:
+                    self.backend.init_serving()
+                except Exception as e:
+                    await send({"type": "lifespan.startup.failed", "message": str(e)})
+                    return
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                if self.jobs:
+                    await asyncio.wait(self.jobs)
+                if isinstance(self.store, AsyncS3Store):
+                    await self.store.close()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    # ---------- WSGI-окружение, тело и ответ ----------
+
+    def environ(self, scope):
+        server = scope.get("server") or ("localhost", 80)
+        client = scope.get("client") or ("", 0)
+        path = scope["path"]
+        root_path = scope.get("root_path", "")
+        if root_path and path.startswith(root_path):
+            path = path[len(root_path):]
+
+        environ = {
+            "REQUEST_METHOD": scope["method"],
+            "SCRIPT_NAME": root_path.encode().decode("latin-1"),
+            "PATH_INFO": path.encode().decode("latin-1"),
+            "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+            "SERVER_NAME": server[0],
+            "SERVER_PORT": str(server[1] or 80),
+            "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+            "REMOTE_ADDR": client[0],
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": scope.get("scheme", "http"),
+            "wsgi.input": io.BytesIO(),
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": True,
+            "wsgi.run_once": False,
+            # send_file читает файл кусками ASGI_READ_CHUNK, а не по 8 КБ
+            "wsgi.file_wrapper": lambda f, _block_size=None: FileWrapper(f, ASGI_READ_CHUNK),
+            self.backend.ASGI_FLOW: True,
+        }
+        for name, value in scope["headers"]:
+            name = name.decode("latin-1").upper().replace("-", "_")
+            value = value.decode("latin-1")
+            key = name if name in ("CONTENT_TYPE", "CONTENT_LENGTH") else f"HTTP_{name}"
+            if key in environ:
+                value = environ[key] + ("; " if key == "HTTP_COOKIE" else ",") + value
+            environ[key] = value
+        return environ
+
+    def endpoint(self, environ):
+        # эндпоинт Flask или None — 404/405 отдаст сам Flask
+        adapter = self.backend.app.url_map.bind_to_environ(environ)
+        try:
+            rule, _args = adapter.match(return_rule=True)
+        except HTTPException:
+            return None
+        return rule.endpoint
+
+    async def receive_body(self, environ, receive, limit):
+        length = content_length(environ)
+        if length is not None and length > limit:
+            return None
+
+        spool = BodySpool(self.run_file)
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                spool.close()
+                raise self.backend.ClientDisconnected()
+            chunk = message.get("body", b"")
+            if spool.size + len(chunk) > limit:
+                spool.close()
+                return None
+            if chunk:
+                await spool.write(chunk)
+            if not message.get("more_body", False):
+                break
+
+        environ["wsgi.input"] = await spool.stream()
+        environ["CONTENT_LENGTH"] = str(spool.size)
+        environ.pop("HTTP_TRANSFER_ENCODING", None)
+        return spool
+
+    async def send_response(self, status, headers, body, send):
+        # тело-список — одним сообщением, иначе (send_file) — кусками из файлового пула
+        try:
+            await send(start_message(status, headers))
+            if isinstance(body, (list, tuple)):
+                await send({"type": "http.response.body", "body": b"".join(body)})
+                return
+            chunks = iter(body)
+            while True:
+                chunk = await self.run_file(next, chunks, None)
+                if chunk is None:
+                    break
+                if chunk:
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            await send({"type": "http.response.body"})
+        finally:
+            close = getattr(body, "close", None)
+            if close is not None:
+                await self.run_file(close)
+
+    # ---------- роуты app.py ----------
+
+    async def handle(self, environ, receive, too_large):
+        request = FlowRequest(self.backend, environ, self.views)
+        flow = await request.run(request.start, too_large)
+        if flow is not None:
+            try:
+                rv = await self.drive(flow, partial(request.run, request.step), request, receive)
+            except self.backend.ClientDisconnected as e:
+                await request.run(request.abort, e)
+                raise
+            except Exception as e:
+                await request.run(request.finish, None, e)
+            else:
+                await request.run(request.finish, rv)
+        return request.response
+
+    async def drive(self, flow, step, request, receive):
+        # step(flow, результат, ошибка) — шаг генератора в пуле роутов
+        result = error = None
+        while True:
+            done, value = await step(flow, result, error)
+            if done:
+                return value
+            result = error = None
+            try:
+                result = await self.resolve(value, request, receive)
+            except Exception as e:
+                error = e
+
+    async def resolve(self, value, request, receive):
+        backend = self.backend
+        if isinstance(value, backend.BucketCall):
+            return await self.bucket(value, receive)
+        if isinstance(value, Future):
+            return await asyncio.wrap_future(value)
+        if isinstance(value, backend.BackgroundFlow):
+            return self.background(value.flow)
+
+        # список генераторов: параллельно, не больше BATCH_UPLOAD_WORKERS на запрос
+        slots = asyncio.Semaphore(backend.BATCH_UPLOAD_WORKERS)
+
+        async def drive_one(flow):
+            async with slots:
+                return await self.drive(flow, self.stepper(request.context.copy()), request, receive)
+
+        return await asyncio.gather(*(drive_one(flow) for flow in value), return_exceptions=True)
+
+    def stepper(self, context):
+        return partial(self.run, self.views, context.run, self.backend.flow_step)
+
+    async def bucket(self, call, receive):
+        backend = self.backend
+        store = self.object_store()
+        if call.op != "upload_fileobj":
+            with backend.s3_timer(call.op, call.route):
+                return await getattr(store, STORE_METHODS[call.op])(call.key)
+
+        body = call.params.get("body")
+        if body is None:
+            body = chunks = StreamedBody(receive, backend)
+        else:
+            chunks = self.file_chunks(body)
+        with backend.s3_timer(call.op, call.route):
+            await store.upload(call.key, chunks, call.params["content_type"])
+        size = call.params.get("size")
+        backend.metric_inc("pixo_s3_uploaded_bytes_total", body.size if size is None else size, route=call.route)
+        return body
+
+    async def file_chunks(self, stream):
+        # куски открытого файла (файла формы, spool), прочитанные в файловом пуле
+        while True:
+            chunk = await self.run_file(stream.read, ASGI_READ_CHUNK)
+            if not chunk:
+                return
+            yield chunk
+
+    def background(self, flow):
+        # место в очереди фоновых загрузок app.py; False — очередь заполнена
+        if not self.backend.take_upload_slot():
+            return False
+        task = asyncio.create_task(self.run_background(flow))
+        self.jobs.add(task)
+        task.add_done_callback(self.jobs.discard)
+        return True
+
+    async def run_background(self, flow):
+        try:
+            await self.drive(flow, self.stepper(contextvars.Context()), None, None)
+        except Exception:
+            self.backend.app.logger.exception("background task failed")
+        finally:
+            self.backend.release_upload_slot()
+
+
+def start_message(status, headers):
+    return {
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers],
+    }
+
+
+app = PixoAsgi(pixo)
@@ -0,0 +1,497 @@
+"""Нагрузочный прогон роутов app.py: python benchmarks/bench_api.py --help"""
+
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timezone
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).resolve().parents[1]
+RESULTS_DIR = Path(__file__).resolve().parent / "results"
+
+sys.path.insert(0, str(BACKEND_DIR / "generator_run"))
+import seed_data  # noqa: E402
+
+IMAGES_PER_USER = 100
+SCALES = {"1k": 1_000, "100k": 100_000, "1m": 1_000_000}
+ADMIN_TOKEN = "bench"  # для служебных роутов (/api/system/profiles)
+
+
+# =========================
+# окружение: данные, приложение, S3
+# =========================
+
+def parse_scale(text):
+    text = text.strip().lower()
+    if text in SCALES:
+        return SCALES[text]
+    return int(text)
+
+
+def seed_dataset(directory, images_count, seed):
+    users_count = max(1, images_count // IMAGES_PER_USER)
+    per_user = min(images_count, IMAGES_PER_USER)
+    with contextlib.redirect_stdout(io.StringIO()):
+        seed_data.generate(
+            users_count=users_count,
+            max_albums_per_user=5,
+            images_per_user=(per_user, per_user),
+            guest_uploads_count=max(1, images_count // 100),
+            seed=seed,
+            workers=os.cpu_count() or 1,
+            out_dir=directory,
+        )
+
+
+def load_app(directory, storage):
+    os.environ.setdefault("PIXO_SESSION_SECRET", "bench")
+    spec = importlib.util.spec_from_file_location("pixo_bench_app", BACKEND_DIR / "app.py")
+    app_module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(app_module)
+
+    app_module.USERS_FILE = str(directory / "users.json")
+    app_module.IMAGES_FILE = str(directory / "images.json")
+    app_module.ALBUMS_FILE = str(directory / "albums.json")
+    app_module.GUEST_FILE = str(directory / "guest_uploads.json")
+    app_module.BLOBS_FILE = str(directory / "blobs.json")
+    app_module.SQLITE_FILE = str(directory / "pixo.db")
+    app_module.UPLOAD_SPOOL_DIR = str(directory / "spool")
+    app_module.s3 = app_module.LocalObjectStore(str(directory / "objects"))
+    app_module.image_cache = app_module.ObjectCache(
+        app_module.IMAGE_CACHE_MEMORY_BYTES, app_module.IMAGE_CACHE_DISK_BYTES, str(directory / "image_cache")
+    )
+    app_module.Image = None  # превью не строим: фоновые задачи исказили бы замеры
+    app_module.ADMIN_TOKEN = ADMIN_TOKEN
+    app_module.PROFILE_SAMPLE_RATE = 0  # профилировщик исказил бы замеры
+    app_module.app.config["TESTING"] = True
+
+    if storage == "sqlite":
+        app_module.migrate_json_to_sqlite()
+    app_module.STORAGE_MODE = storage
+    return app_module
+
+
+class Dataset:
+    def __init__(self, directory, rng):
+        self.rng = rng
+        self.users = json.loads((directory / "users.json").read_text(encoding="utf-8"))
+        albums = json.loads((directory / "albums.json").read_text(encoding="utf-8"))
+        images = json.loads((directory / "images.json").read_text(encoding="utf-8"))
+
+        self.albums_by_user = {}
+        for a in albums:
+            self.albums_by_user.setdefault(a["user_id"], []).append(a["id"])
+        self.images_by_user = {}
+        for img in images:
+            self.images_by_user.setdefault(img["user_id"], []).append(img["id"])
+        self.album_ids = [a["id"] for a in albums]
+        self.image_ids = [img["id"] for img in images]
+        self.object_path = None  # объект в локальном хранилище для GET /objects/<key>
+        self.raw_image_id = None  # фото с объектом в хранилище для /api/image/<id>/raw
+
+    def user(self):
+        return self.rng.choice(self.users)
+
+    def user_with_album(self):
+        u = self.user()
+        while not self.albums_by_user.get(u["id"]):
+            u = self.user()
+        return u, self.rng.choice(self.albums_by_user[u["id"]])
+
+
+# =========================
+# сценарии: один запрос к одному роуту
+# =========================
+# Каждый сценарий по данным строит kwargs для client.open; подготовка
+# (например, /presign перед /confirm) выполняется до замера.
+
+def png_file(rng, name="a.png"):
+    return (io.BytesIO(rng.randbytes(2048)), name, "image/png")
+
+
+def sc_ping(client, ds):
+    return {"method": "GET", "path": "/api/ping"}
+
+
+def sc_sign_up(client, ds):
+    return {"method": "POST", "path": "/api/sign-up",
+            "json": {"email": f"{uuid.uuid4().hex}@bench.invalid", "password": "1"}}
+
+
+def sc_sign_in(client, ds):
+    u = ds.user()
+    return {"method": "POST", "path": "/api/sign-in", "json": {"email": u["email"], "password": u["password"]}}
+
+
+def sc_gallery(client, ds):
+    return {"method": "GET", "path": f"/api/gallery/{ds.user()['id']}"}
+
+
+def sc_gallery_page(client, ds):
+    return {"method": "GET", "path": f"/api/gallery/{ds.user()['id']}?limit=20"}
+
+
+def sc_bootstrap(client, ds):
+    return {"method": "GET", "path": f"/api/bootstrap/{ds.user()['id']}?fields=title,album_id,url,thumb_url"}
+
+
+def sc_image(client, ds):
+    return {"method": "GET", "path": f"/api/image/{ds.rng.choice(ds.image_ids)}"}
+
+
+def sc_delete_image(client, ds):
+    # удаляется свежая загрузка, а не фото датасета: у остальных сценариев они нужны
+    user_id = ds.user()["id"]
+    image = client.post("/api/upload-user", content_type="multipart/form-data",
+                        data={"user_id": user_id, "file": png_file(ds.rng)}).get_json()["image"]
+    return {"method": "DELETE", "path": f"/api/image/{image['id']}", "json": {"user_id": user_id}}
+
+
+def sc_albums(client, ds):
+    return {"method": "GET", "path": f"/api/albums/{ds.user()['id']}"}
+
+
+def sc_album(client, ds):
+    return {"method": "GET", "path": f"/api/album/{ds.rng.choice(ds.album_ids)}"}
+
+
+def sc_user(client, ds):
+    return {"method": "GET", "path": f"/api/user/{ds.user()['id']}"}
+
+
+def sc_upload_user(client, ds):
+    return {"method": "POST", "path": "/api/upload-user", "content_type": "multipart/form-data",
+            "data": {"user_id": ds.user()["id"], "file": png_file(ds.rng)}}
+
+
+def sc_upload_user_stream(client, ds):
+    return {"method": "PUT", "path": f"/api/upload-user/stream?user_id={ds.user()['id']}&filename=a.png",
+            "data": ds.rng.randbytes(2048), "content_type": "image/png"}
+
+
+def sc_upload_user_batch(client, ds):
+    return {"method": "POST", "path": "/api/upload-user/batch", "content_type": "multipart/form-data",
+            "data": {"user_id": ds.user()["id"], "files": [png_file(ds.rng, f"{i}.png") for i in range(5)]}}
+
+
+def sc_presign_user(client, ds):
+    return {"method": "POST", "path": "/api/upload-user/presign",
+            "json": {"user_id": ds.user()["id"], "filename": "a.png", "content_type": "image/png"}}
+
+
+def bucket_form(ds, upload):
+    return {"method": "POST", "path": "/objects", "content_type": "multipart/form-data",
+            "data": {**upload["fields"], "file": png_file(ds.rng)}}
+
+
+def sc_confirm_user(client, ds):
+    user_id = ds.user()["id"]
+    ticket = client.post("/api/upload-user/presign", json={
+        "user_id": user_id, "filename": "a.png", "content_type": "image/png"
+    }).get_json()
+    client.open(**bucket_form(ds, ticket["upload"]))
+    return {"method": "POST", "path": "/api/upload-user/confirm",
+            "json": {"user_id": user_id, "image_id": ticket["image_id"], "key": ticket["key"]}}
+
+
+def sc_upload_guest(client, ds):
+    return {"method": "POST", "path": "/api/upload-guest", "content_type": "multipart/form-data",
+            "data": {"file": png_file(ds.rng)}}
+
+
+def sc_upload_guest_stream(client, ds):
+    return {"method": "PUT", "path": "/api/upload-guest/stream?filename=a.png",
+            "data": ds.rng.randbytes(2048), "content_type": "image/png"}
+
+
+def sc_presign_guest(client, ds):
+    return {"method": "POST", "path": "/api/upload-guest/presign",
+            "json": {"filename": "a.png", "content_type": "image/png"}}
+
+
+def sc_confirm_guest(client, ds):
+    ticket = client.post("/api/upload-guest/presign", json={
+        "filename": "a.png", "content_type": "image/png"
+    }).get_json()
+    client.open(**bucket_form(ds, ticket["upload"]))
+    return {"method": "POST", "path": "/api/upload-guest/confirm",
+            "json": {"key": ticket["key"], "ticket": ticket["ticket"]}}
+
+
+def sc_upload_status(client, ds):
+    return {"method": "GET", "path": f"/api/upload-status/{uuid.uuid4()}"}
+
+
+def sc_create_album(client, ds):
+    return {"method": "POST", "path": "/api/albums", "json": {"user_id": ds.user()["id"], "title": "bench"}}
+
+
+def sc_set_album(client, ds):
+    u, album_id = ds.user_with_album()
+    image_id = ds.rng.choice(ds.images_by_user[u["id"]])
+    return {"method": "POST", "path": f"/api/image/{image_id}/set-album",
+            "json": {"user_id": u["id"], "album_id": album_id}}
+
+
+def sc_bulk_set_album(client, ds):
+    u, album_id = ds.user_with_album()
+    ids = ds.images_by_user[u["id"]][:50]
+    return {"method": "POST", "path": "/api/images/set-album",
+            "json": {"user_id": u["id"], "album_id": album_id, "image_ids": ids}}
+
+
+def sc_update_user(client, ds):
+    u = ds.user()
+    return {"method": "POST", "path": f"/api/user/{u['id']}/update",
+            "json": {"email": u["email"], "username": "bench", "lang": "en"}}
+
+
+def sc_change_password(client, ds):
+    u = ds.user()
+    return {"method": "POST", "path": f"/api/user/{u['id']}/change-password",
+            "json": {"old_password": u["password"], "new_password": u["password"]}}
+
+
+def sc_guest_sweep(client, ds):
+    return {"method": "GET", "path": "/api/system/guest-sweep", "headers": {"X-Admin-Token": ADMIN_TOKEN}}
+
+
+def sc_store_upload(client, ds):
+    ticket = client.post("/api/upload-guest/presign", json={
+        "filename": "a.png", "content_type": "image/png"
+    }).get_json()
+    return bucket_form(ds, ticket["upload"])
+
+
+def sc_store_object(client, ds):
+    if ds.object_path is None:
+        url = client.post("/api/upload-guest", content_type="multipart/form-data",
+                          data={"file": png_file(ds.rng)}).get_json()["url"]
+        ds.object_path = "/objects/" + url.split("/objects/", 1)[1]
+    return {"method": "GET", "path": ds.object_path}
+
+
+def sc_image_raw(client, ds):
+    if ds.raw_image_id is None:
+        ds.raw_image_id = client.post(
+            "/api/upload-user", content_type="multipart/form-data",
+            data={"user_id": ds.user()["id"], "file": png_file(ds.rng)},
+        ).get_json()["image"]["id"]
+    return {"method": "GET", "path": f"/api/image/{ds.raw_image_id}/raw"}
+
+
+def sc_metrics(client, ds):
+    return {"method": "GET", "path": "/metrics"}
+
+
+def sc_profiles(client, ds):
+    return {"method": "GET", "path": "/api/system/profiles", "headers": {"X-Admin-Token": ADMIN_TOKEN}}
+
+
+# имя в отчёте -> (правило маршрута во Flask, сценарий)
+SCENARIOS = {
+    "GET /api/ping": ("/api/ping", sc_ping),
+    "POST /api/sign-up": ("/api/sign-up", sc_sign_up),
+    "POST /api/sign-in": ("/api/sign-in", sc_sign_in),
+    "GET /api/gallery/<user_id>": ("/api/gallery/<user_id>", sc_gallery),
+    "GET /api/gallery/<user_id>?limit=20": ("/api/gallery/<user_id>", sc_gallery_page),
+    "GET /api/bootstrap/<user_id>?fields=": ("/api/bootstrap/<user_id>", sc_bootstrap),
+    "GET /api/image/<image_id>": ("/api/image/<image_id>", sc_image),
+    "DELETE /api/image/<image_id>": ("/api/image/<image_id>", sc_delete_image),
+    "GET /api/albums/<user_id>": ("/api/albums/<user_id>", sc_albums),
+    "GET /api/album/<album_id>": ("/api/album/<album_id>", sc_album),
+    "GET /api/user/<user_id>": ("/api/user/<user_id>", sc_user),
+    "POST /api/upload-user": ("/api/upload-user", sc_upload_user),
+    "PUT /api/upload-user/stream": ("/api/upload-user/stream", sc_upload_user_stream),
+    "POST /api/upload-user/batch (5 files)": ("/api/upload-user/batch", sc_upload_user_batch),
+    "POST /api/upload-user/presign": ("/api/upload-user/presign", sc_presign_user),
+    "POST /api/upload-user/confirm": ("/api/upload-user/confirm", sc_confirm_user),
+    "POST /api/upload-guest": ("/api/upload-guest", sc_upload_guest),
+    "PUT /api/upload-guest/stream": ("/api/upload-guest/stream", sc_upload_guest_stream),
+    "POST /api/upload-guest/presign": ("/api/upload-guest/presign", sc_presign_guest),
+    "POST /api/upload-guest/confirm": ("/api/upload-guest/confirm", sc_confirm_guest),
+    "GET /api/upload-status/<job_id>": ("/api/upload-status/<job_id>", sc_upload_status),
+    "POST /api/albums": ("/api/albums", sc_create_album),
+    "POST /api/image/<image_id>/set-album": ("/api/image/<image_id>/set-album", sc_set_album),
+    "POST /api/images/set-album (50 ids)": ("/api/images/set-album", sc_bulk_set_album),
+    "POST /api/user/<user_id>/update": ("/api/user/<user_id>/update", sc_update_user),
+    "POST /api/user/<user_id>/change-password": ("/api/user/<user_id>/change-password", sc_change_password),
+    "GET /api/system/guest-sweep": ("/api/system/guest-sweep", sc_guest_sweep),
+    "POST /objects": ("/objects", sc_store_upload),
+    "GET /objects/<path:key>": ("/objects/<path:key>", sc_store_object),
+    "GET /api/image/<image_id>/raw": ("/api/image/<image_id>/raw", sc_image_raw),
+    "GET /metrics": ("/metrics", sc_metrics),
+    "GET /api/system/profiles": ("/api/system/profiles", sc_profiles),
+}
+
+
+# =========================
+# замеры
+# =========================
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    rank = max(1, -(-len(sorted_values) * q // 100))
+    return sorted_values[int(rank) - 1]
+
+
+def run_scenario(client, ds, scenario, requests, warmup):
+    for _ in range(warmup):
+        client.open(**scenario(client, ds))
+
+    latencies = []
+    statuses = {}
+    for _ in range(requests):
+        kwargs = scenario(client, ds)
+        started = time.perf_counter()
+        res = client.open(**kwargs)
+        latencies.append(time.perf_counter() - started)
+        statuses[str(res.status_code)] = statuses.get(str(res.status_code), 0) + 1
+
+    total = sum(latencies)
+    latencies.sort()
+    ms = lambda v: round(v * 1000, 3)  # noqa: E731
+    return {
+        "requests": requests,
+        # запросы последовательные: 1 / mean, не пропускная способность
+        "sequential_rps": round(requests / total, 1) if total else None,
+        "mean_ms": ms(total / requests),
+        "p50_ms": ms(percentile(latencies, 50)),
+        "p95_ms": ms(percentile(latencies, 95)),
+        "p99_ms": ms(percentile(latencies, 99)),
+        "max_ms": ms(latencies[-1]),
+        "statuses": statuses,
+    }
+
+
+def uncovered_routes(app_module):
+    covered = {rule for rule, _ in SCENARIOS.values()}
+    return sorted(
+        r.rule for r in app_module.app.url_map.iter_rules()
+        if r.endpoint != "static" and r.rule not in covered
+    )
+
+
+def run_benchmark(scales, requests=200, storage="json", seed=1, warmup=10, only=None, log=print):
+    report = {
+        "meta": {
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "storage": storage,
+            "seed": seed,
+            "requests": requests,
+            "warmup": warmup,
+        },
+        "scales": {},
+    }
+
+    for images_count in scales:
+        with tempfile.TemporaryDirectory(prefix="pixo-bench-") as tmp:
+            directory = Path(tmp)
+            started = time.perf_counter()
+            seed_dataset(directory, images_count, seed)
+            seeded = time.perf_counter() - started
+
+            app_module = load_app(directory, storage)
+            ds = Dataset(directory, random.Random(seed))
+            log(f"[{images_count} images] seeded in {seeded:.1f}s, {len(ds.users)} users")
+
+            endpoints = {}
+            with app_module.app.test_client() as client:
+                for name, (_rule, scenario) in SCENARIOS.items():
+                    if only and only not in name:
+                        continue
+                    endpoints[name] = result = run_scenario(client, ds, scenario, requests, warmup)
+                    log(f"  {name:<45} p50 {result['p50_ms']:>8} ms  p95 {result['p95_ms']:>8} ms"
+                        f"  p99 {result['p99_ms']:>8} ms  {result['sequential_rps']:>8} seq rps")
+
+            report["scales"][str(images_count)] = {
+                "images": len(ds.image_ids),
+                "users": len(ds.users),
+                "albums": len(ds.album_ids),
+                "seed_seconds": round(seeded, 2),
+                "uncovered_routes": uncovered_routes(app_module),
+                "endpoints": endpoints,
+            }
+            for rule in report["scales"][str(images_count)]["uncovered_routes"]:
+                log(f"  ! no scenario for {rule}")
+
+    return report
+
+
+def compare(old, new, threshold):
+    lines = []
+    regressed = False
+    for scale, current in new["scales"].items():
+        before = old.get("scales", {}).get(scale)
+        if not before:
+            continue
+        for name, result in current["endpoints"].items():
+            prev = before["endpoints"].get(name)
+            if not prev or not prev.get("p95_ms"):
+                continue
+            change = result["p95_ms"] / prev["p95_ms"] - 1
+            mark = ""
+            if change > threshold:
+                mark = "  <-- regression"
+                regressed = True
+            lines.append(f"[{scale}] {name:<45} p95 {prev['p95_ms']:>8} -> {result['p95_ms']:>8} ms ({change:+.0%}){mark}")
+    return lines, regressed
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=BACKEND_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark every API route of app.py")
+    parser.add_argument("--scales", default="1k", help="comma-separated image counts: 1k,100k,1m or numbers")
+    parser.add_argument("--requests", type=int, default=200, help="timed requests per endpoint")
+    parser.add_argument("--warmup", type=int, default=10, help="untimed requests per endpoint")
+    parser.add_argument("--storage", choices=["json", "wal", "sqlite"], default="json")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--only", help="run only endpoints whose name contains this text")
+    parser.add_argument("--out", help="result file (default: benchmarks/results/<time>-<commit>.json)")
+    parser.add_argument("--compare", help="previous result file to compare p95 against")
+    parser.add_argument("--threshold", type=float, default=0.2, help="p95 growth counted as regression")
+    args = parser.parse_args(argv)
+
+    scales = [parse_scale(s) for s in args.scales.split(",") if s.strip()]
+    report = run_benchmark(scales, args.requests, args.storage, args.seed, args.warmup, args.only)
+
+    out = Path(args.out) if args.out else RESULTS_DIR / (
+        f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{report['meta']['commit'] or 'nogit'}.json"
+    )
+    out.parent.mkdir(parents=True, exist_ok=True)
+    out.write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+    print(f"results -> {out}")
+
+    if args.compare:
+        old = json.loads(Path(args.compare).read_text(encoding="utf-8"))
+        lines, regressed = compare(old, report, args.threshold)
+        print("\n".join(lines))
+        return 1 if regressed else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
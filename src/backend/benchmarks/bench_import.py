@@ -0,0 +1,151 @@
+"""Время и память на `import app`: python benchmarks/bench_import.py --help"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+from datetime import datetime, timezone
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).resolve().parents[1]
+RESULTS_DIR = Path(__file__).resolve().parent / "results"
+
+# модули, которых не должно быть в sys.modules сразу после import app
+FORBIDDEN_MODULES = (
+    "boto3", "botocore", "s3transfer", "PIL", "orjson", "brotli",
+    "cProfile", "pstats", "multiprocessing", "sqlite3",
+)
+TOP_MODULES = 15
+
+# печатает JSON с временем, пиком памяти и загруженными запрещёнными модулями
+PROBE = """
+import json, resource, sys, time
+started = time.perf_counter()
+import app
+elapsed = time.perf_counter() - started
+print(json.dumps({
+    "import_ms": elapsed * 1000,
+    "maxrss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    "loaded": sorted(m for m in %r if m in sys.modules),
+}))
+"""
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    rank = max(1, -(-len(sorted_values) * q // 100))
+    return sorted_values[int(rank) - 1]
+
+
+def parse_importtime(stderr):
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _self, cumulative, name = line[len("import time:"):].split("|", 2)
+        if not cumulative.strip().isdigit():
+            continue  # заголовок
+        depth = (len(name) - len(name.lstrip())) // 2
+        if depth == 1:
+            modules[name.strip()] = int(cumulative)
+    return modules
+
+
+def measure_once(forbidden=FORBIDDEN_MODULES):
+    env = {**os.environ, "PIXO_SESSION_SECRET": os.environ.get("PIXO_SESSION_SECRET") or "bench"}
+    res = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", PROBE % (tuple(forbidden),)],
+        cwd=BACKEND_DIR, env=env, capture_output=True, text=True, check=True,
+    )
+    result = json.loads(res.stdout.strip().splitlines()[-1])
+    result["modules"] = parse_importtime(res.stderr)
+    return result
+
+
+def measure(runs=10, forbidden=FORBIDDEN_MODULES):
+    samples = [measure_once(forbidden) for _ in range(runs)]
+    times = sorted(s["import_ms"] for s in samples)
+
+    # вклад модулей первого уровня — медиана по прогонам
+    modules = {}
+    for s in samples:
+        for name, us in s["modules"].items():
+            modules.setdefault(name, []).append(us)
+    top = sorted(
+        ((name, percentile(sorted(v), 50) / 1000) for name, v in modules.items()),
+        key=lambda item: item[1], reverse=True,
+    )[:TOP_MODULES]
+
+    return {
+        "meta": {
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "runs": runs,
+        },
+        "import_ms": {
+            "p50": round(percentile(times, 50), 1),
+            "p95": round(percentile(times, 95), 1),
+            "min": round(times[0], 1),
+        },
+        "maxrss_mb": round(max(s["maxrss_kb"] for s in samples) / 1024, 1),
+        "forbidden_loaded": sorted({m for s in samples for m in s["loaded"]}),
+        "top_modules_ms": {name: round(ms, 1) for name, ms in top},
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=BACKEND_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure `import app` time and memory")
+    parser.add_argument("--runs", type=int, default=10, help="fresh interpreters to measure")
+    parser.add_argument("--max-ms", type=float, help="fail if median import time is above this")
+    parser.add_argument("--out", help="result file (default: benchmarks/results/import-<time>-<commit>.json)")
+    parser.add_argument("--compare", help="previous result file to compare the median against")
+    parser.add_argument("--threshold", type=float, default=0.2, help="median growth counted as regression")
+    args = parser.parse_args(argv)
+
+    report = measure(args.runs)
+    print(f"import app: p50 {report['import_ms']['p50']} ms, p95 {report['import_ms']['p95']} ms, "
+          f"max rss {report['maxrss_mb']} MB")
+    for name, ms in report["top_modules_ms"].items():
+        print(f"  {name:<30} {ms:>8} ms")
+
+    out = Path(args.out) if args.out else RESULTS_DIR / (
+        f"import-{datetime.now().strftime('%Y%m%d-%H%M%S')}-{report['meta']['commit'] or 'nogit'}.json"
+    )
+    out.parent.mkdir(parents=True, exist_ok=True)
+    out.write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+    print(f"results -> {out}")
+
+    failed = False
+    if report["forbidden_loaded"]:
+        print(f"! loaded at import: {', '.join(report['forbidden_loaded'])}")
+        failed = True
+    if args.max_ms is not None and report["import_ms"]["p50"] > args.max_ms:
+        print(f"! median {report['import_ms']['p50']} ms > {args.max_ms} ms")
+        failed = True
+    if args.compare:
+        old = json.loads(Path(args.compare).read_text(encoding="utf-8"))
+        before = old["import_ms"]["p50"]
+        change = report["import_ms"]["p50"] / before - 1
+        mark = "  <-- regression" if change > args.threshold else ""
+        print(f"p50 {before} -> {report['import_ms']['p50']} ms ({change:+.0%}){mark}")
+        failed = failed or bool(mark)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,206 +1,443 @@
-import json
-import uuid
-from pathlib import Path
-from datetime import datetime, timezone
-from faker import Faker
-import random
-
-# Инициализация генератора фейковых данных
-fake = Faker()
-
-# Базовая директория — папка, где лежит этот файл
-BASE_DIR = Path(__file__).resolve().parent
-
-# Пути к JSON-файлам, которые будут сгенерированы
-USERS_FILE = BASE_DIR / "users.json"
-ALBUMS_FILE = BASE_DIR / "albums.json"
-IMAGES_FILE = BASE_DIR / "images.json"
-GUEST_FILE = BASE_DIR / "guest_uploads.json"
-
-# Параметры S3-хранилища (используются для генерации URL изображений)
-S3_ENDPOINT = "https://storage.yandexcloud.net"
-S3_BUCKET = "pixo-images"
-
-
-def now_iso():
-    """
-    Возвращает текущую дату и время в формате ISO 8601 (UTC).
-    Используется для created_at / uploaded_at.
-    """
-    return datetime.now(timezone.utc).isoformat()
-
-
-def dump(path: Path, data):
-    """
-    Сохраняет переданные данные в JSON-файл:
-    - с отступами
-    - с поддержкой Unicode
-    """
-    path.write_text(
-        json.dumps(data, ensure_ascii=False, indent=2),
-        encoding="utf-8"
-    )
-
-
-def make_user(lang=None):
-    """
-    Генерирует одного пользователя.
-
-    Поля:
-    - id            — уникальный UUID
-    - email         — фейковый email
-    - password      — фейковый пароль (в открытом виде, для тестов)
-    - username      — никнейм
-    - lang          — язык интерфейса (ru / en)
-    - created_at    — дата создания
-    """
-    user_id = str(uuid.uuid4())
-    email = fake.unique.email()
-    password = fake.password(length=8)
-
-    return {
-        "id": user_id,
-        "email": email,
-        "password": password,
-        "username": fake.user_name(),
-        "lang": lang or random.choice(["ru", "en"]),
-        "created_at": now_iso(),
-    }
-
-
-def make_album(user_id):
-    """
-    Генерирует альбом для конкретного пользователя.
-
-    - user_id       — владелец альбома
-    - title         — случайное название
-    - created_at    — дата создания
-    """
-    return {
-        "id": str(uuid.uuid4()),
-        "user_id": user_id,
-        "title": fake.sentence(nb_words=2).replace(".", ""),
-        "created_at": now_iso(),
-    }
-
-
-def make_image(user_id, album_id=None):
-    """
-    Генерирует изображение.
-
-    - user_id       — владелец изображения
-    - album_id      — альбом (может быть None)
-    - key           — путь к файлу в S3
-    - url           — публичный URL изображения
-    """
-    image_id = str(uuid.uuid4())
-    ext = random.choice([".jpg", ".png", ".jpeg", ".webp"])
-
-    # S3-ключ формируется по шаблону user/{user_id}/{image_id}.{ext}
-    key = f"user/{user_id}/{image_id}{ext}"
-    url = f"{S3_ENDPOINT}/{S3_BUCKET}/{key}"
-
-    return {
-        "id": image_id,
-        "user_id": user_id,
-        "title": fake.sentence(nb_words=3).replace(".", ""),
-        "album_id": album_id,
-        "key": key,
-        "url": url,
-        "created_at": now_iso(),
-    }
-
-
-def make_guest_upload():
-    """
-    Генерирует загрузку гостя (без пользователя).
-
-    Возвращает:
-    - guest_id      — уникальный идентификатор записи
-    - объект с данными загрузки
-    """
-    guest_id = str(uuid.uuid4())
-    ext = random.choice([".jpg", ".png", ".jpeg"])
-
-    # Файлы гостей лежат в guest/
-    key = f"guest/{uuid.uuid4()}{ext}"
-    url = f"{S3_ENDPOINT}/{S3_BUCKET}/{key}"
-
-    return guest_id, {
-        "key": key,
-        "title": fake.sentence(nb_words=2).replace(".", ""),
-        "uploaded_at": now_iso(),
-        "url": url,
-    }
-
-
-def generate(
-    users_count=15,
-    max_albums_per_user=5,
-    images_per_user=(8, 25),
-    guest_uploads_count=10,
-):
-    """
-    Основная функция генерации seed-данных.
-
-    Параметры:
-    - users_count            — количество пользователей
-    - max_albums_per_user    — максимум альбомов на пользователя
-    - images_per_user        — диапазон количества изображений
-    - guest_uploads_count    — количество гостевых загрузок
-    """
-    users = []
-    albums = []
-    images = []
-    guests = {}
-
-    # Генерация пользователей
-    for _ in range(users_count):
-        u = make_user()
-        users.append(u)
-
-        # Генерация альбомов пользователя
-        user_albums = []
-        albums_count = random.randint(0, max_albums_per_user)
-        for _ in range(albums_count):
-            a = make_album(u["id"])
-            albums.append(a)
-            user_albums.append(a)
-
-        # Генерация изображений пользователя
-        # Часть изображений кладётся в альбомы, часть — без альбома
-        count_imgs = random.randint(images_per_user[0], images_per_user[1])
-        for _ in range(count_imgs):
-            if user_albums and random.random() < 0.6:
-                album_id = random.choice(user_albums)["id"]
-            else:
-                album_id = None
-
-            images.append(make_image(u["id"], album_id=album_id))
-
-    # Генерация гостевых загрузок
-    for _ in range(guest_uploads_count):
-        gid, obj = make_guest_upload()
-        guests[gid] = {
-            "key": obj["key"],
-            "title": obj["title"],
-            "uploaded_at": obj["uploaded_at"],
-        }
-
-    # Сохранение данных в JSON-файлы
-    dump(USERS_FILE, users)
-    dump(ALBUMS_FILE, albums)
-    dump(IMAGES_FILE, images)
-    dump(GUEST_FILE, guests)
-
-    # Информация в консоль
-    print("Seed data generated:")
-    print(f"- users:  {len(users)}  -> {USERS_FILE}")
-    print(f"- albums: {len(albums)} -> {ALBUMS_FILE}")
-    print(f"- images: {len(images)} -> {IMAGES_FILE}")
-    print(f"- guests: {len(guests)} -> {GUEST_FILE}")
-
-
-# Запуск генерации при прямом запуске файла
-if __name__ == "__main__":
-    generate()
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import uuid
+from multiprocessing import Pool
+from pathlib import Path
+from datetime import datetime, timedelta, timezone
+from faker import Faker
+import random
+
+# Инициализация генератора фейковых данных
+fake = Faker()
+
+# Базовая директория — папка, где лежит этот файл
+BASE_DIR = Path(__file__).resolve().parent
+
+# Пути к JSON-файлам, которые будут сгенерированы
+USERS_FILE = BASE_DIR / "users.json"
+ALBUMS_FILE = BASE_DIR / "albums.json"
+IMAGES_FILE = BASE_DIR / "images.json"
+GUEST_FILE = BASE_DIR / "guest_uploads.json"
+
+# Параметры S3-хранилища (используются для генерации URL изображений)
+S3_ENDPOINT = "https://storage.yandexcloud.net"
+S3_BUCKET = "pixo-images"
+
+# Пользователи генерируются блоками по BLOCK_USERS (гости — по BLOCK_GUESTS).
+# У каждого блока свой seed, поэтому результат при одном --seed не зависит
+# от числа процессов: процессы лишь параллельно считают разные блоки.
+BLOCK_USERS = 1000
+BLOCK_GUESTS = 10000
+
+# С --seed даты отсчитываются от фиксированного момента, без него — от «сейчас»
+SEED_EPOCH = datetime(2024, 1, 1, tzinfo=timezone.utc)
+HISTORY_DAYS = 365
+
+
+def now_iso():
+    """
+    Возвращает текущую дату и время в формате ISO 8601 (UTC).
+    Используется для created_at / uploaded_at.
+    """
+    return datetime.now(timezone.utc).isoformat()
+
+
+def dump(path: Path, data):
+    """
+    Сохраняет переданные данные в JSON-файл:
+    - с отступами
+    - с поддержкой Unicode
+    """
+    path.write_text(
+        json.dumps(data, ensure_ascii=False, indent=2),
+        encoding="utf-8"
+    )
+
+
+def make_user(lang=None, rng=None, index=None, created_at=None):
+    """
+    Генерирует одного пользователя.
+
+    Поля:
+    - id            — уникальный UUID
+    - email         — фейковый email
+    - password      — фейковый пароль (в открытом виде, для тестов)
+    - username      — никнейм
+    - lang          — язык интерфейса (ru / en)
+    - created_at    — дата создания
+
+    rng / index / created_at передаёт потоковая генерация: с ними id и
+    дата воспроизводимы, а email уникален за счёт номера пользователя
+    (без fake.unique, который замедляется с ростом числа записей).
+    """
+    rng = rng or random
+    username = fake.user_name()
+    if index is None:
+        email = fake.unique.email()
+    else:
+        email = f"{username}.{index}@{fake.free_email_domain()}"
+
+    return {
+        "id": new_id(rng),
+        "email": email,
+        "password": fake.password(length=8),
+        "username": username,
+        "lang": lang or rng.choice(["ru", "en"]),
+        "created_at": created_at or now_iso(),
+    }
+
+
+def make_album(user_id, rng=None, created_at=None):
+    """
+    Генерирует альбом для конкретного пользователя.
+
+    - user_id       — владелец альбома
+    - title         — случайное название
+    - created_at    — дата создания
+    """
+    return {
+        "id": new_id(rng or random),
+        "user_id": user_id,
+        "title": fake.sentence(nb_words=2).replace(".", ""),
+        "created_at": created_at or now_iso(),
+    }
+
+
+def make_image(user_id, album_id=None, rng=None, created_at=None):
+    """
+    Генерирует изображение.
+
+    - user_id       — владелец изображения
+    - album_id      — альбом (может быть None)
+    - key           — путь к файлу в S3
+    - url           — публичный URL изображения
+    """
+    rng = rng or random
+    image_id = new_id(rng)
+    ext = rng.choice([".jpg", ".png", ".jpeg", ".webp"])
+
+    # S3-ключ формируется по шаблону user/{user_id}/{image_id}.{ext}
+    key = f"user/{user_id}/{image_id}{ext}"
+    url = f"{S3_ENDPOINT}/{S3_BUCKET}/{key}"
+
+    return {
+        "id": image_id,
+        "user_id": user_id,
+        "title": fake.sentence(nb_words=3).replace(".", ""),
+        "album_id": album_id,
+        "key": key,
+        "url": url,
+        "created_at": created_at or now_iso(),
+    }
+
+
+def make_guest_upload(rng=None, uploaded_at=None):
+    """
+    Генерирует загрузку гостя (без пользователя).
+
+    Возвращает:
+    - guest_id      — уникальный идентификатор записи
+    - объект с данными загрузки
+    """
+    rng = rng or random
+    guest_id = new_id(rng)
+    ext = rng.choice([".jpg", ".png", ".jpeg"])
+
+    # Файлы гостей лежат в guest/
+    key = f"guest/{new_id(rng)}{ext}"
+    url = f"{S3_ENDPOINT}/{S3_BUCKET}/{key}"
+
+    return guest_id, {
+        "key": key,
+        "title": fake.sentence(nb_words=2).replace(".", ""),
+        "uploaded_at": uploaded_at or now_iso(),
+        "url": url,
+    }
+
+
+def new_id(rng):
+    # uuid4 из переданного генератора: с --seed id тоже воспроизводимы
+    if rng is random:
+        return str(uuid.uuid4())
+    return str(uuid.UUID(int=rng.getrandbits(128), version=4))
+
+
+# ======================
+# потоковая генерация
+# ======================
+
+class JsonStream:
+    """
+    Пишет записи в файл по одной, не собирая коллекцию в памяти.
+    В part-файл блока попадают только записи через ",\\n" — скобки
+    списка / словаря добавляет join_parts при склейке.
+    """
+
+    def __init__(self, path, keyed=False):
+        self.f = open(path, "w", encoding="utf-8")
+        self.keyed = keyed
+        self.count = 0
+
+    def write(self, record, key=None):
+        if self.count:
+            self.f.write(",\n")
+        if self.keyed:
+            self.f.write(json.dumps(key, ensure_ascii=False) + ": ")
+        self.f.write(json.dumps(record, ensure_ascii=False))
+        self.count += 1
+
+    def close(self):
+        self.f.close()
+
+
+def block_rng(seed, kind, block):
+    """
+    Генератор блока: зависит только от seed, вида блока и его номера.
+    """
+    if seed is None:
+        return random.Random()
+    return random.Random(f"{seed}:{kind}:{block}")
+
+
+def images_for_user(rng, images_per_user, heavy_users, heavy_factor):
+    """
+    Сколько фото у пользователя: обычно из диапазона images_per_user,
+    а доля heavy_users «тяжёлых» пользователей получает в heavy_factor раз больше.
+    """
+    count = rng.randint(images_per_user[0], images_per_user[1])
+    if heavy_users and rng.random() < heavy_users:
+        count *= heavy_factor
+    return count
+
+
+def time_after(rng, start, end):
+    return start + (end - start) * rng.random()
+
+
+def generate_user_block(task):
+    """
+    Один блок пользователей (запускается в процессе пула).
+    Пишет users/albums/images блока в part-файлы в tmp_dir.
+    """
+    (block, first, last, seed, tmp_dir, max_albums_per_user,
+     images_per_user, heavy_users, heavy_factor, album_ratio, epoch) = task
+
+    rng = block_rng(seed, "users", block)
+    fake.seed_instance(rng.getrandbits(64))
+    now = epoch + timedelta(days=HISTORY_DAYS)
+
+    streams = {
+        name: JsonStream(Path(tmp_dir) / f"{name}-{block:06d}.part")
+        for name in ("users", "albums", "images")
+    }
+
+    for index in range(first, last):
+        u = make_user(
+            rng=rng,
+            index=index,
+            created_at=time_after(rng, epoch, now).isoformat()
+        )
+        streams["users"].write(u)
+        user_created = datetime.fromisoformat(u["created_at"])
+
+        # Генерация альбомов пользователя
+        user_albums = []
+        for _ in range(rng.randint(0, max_albums_per_user)):
+            a = make_album(u["id"], rng=rng, created_at=time_after(rng, user_created, now).isoformat())
+            streams["albums"].write(a)
+            user_albums.append(a["id"])
+
+        # Генерация изображений пользователя
+        # Часть изображений кладётся в альбомы, часть — без альбома
+        for _ in range(images_for_user(rng, images_per_user, heavy_users, heavy_factor)):
+            album_id = None
+            if user_albums and rng.random() < album_ratio:
+                album_id = rng.choice(user_albums)
+            streams["images"].write(make_image(
+                u["id"],
+                album_id=album_id,
+                rng=rng,
+                created_at=time_after(rng, user_created, now).isoformat()
+            ))
+
+    counts = {}
+    for name, stream in streams.items():
+        stream.close()
+        counts[name] = stream.count
+    return block, counts
+
+
+def generate_guest_block(task):
+    """
+    Один блок гостевых загрузок (запускается в процессе пула).
+    """
+    block, count, seed, tmp_dir, epoch = task
+
+    rng = block_rng(seed, "guests", block)
+    fake.seed_instance(rng.getrandbits(64))
+    now = epoch + timedelta(days=HISTORY_DAYS)
+
+    stream = JsonStream(Path(tmp_dir) / f"guests-{block:06d}.part", keyed=True)
+    for _ in range(count):
+        gid, obj = make_guest_upload(rng=rng, uploaded_at=time_after(rng, epoch, now).isoformat())
+        stream.write({
+            "key": obj["key"],
+            "title": obj["title"],
+            "uploaded_at": obj["uploaded_at"],
+        }, key=gid)
+    stream.close()
+    return block, {"guests": stream.count}
+
+
+def join_parts(tmp_dir, name, path, keyed=False):
+    """
+    Склеивает part-файлы блоков по порядку номеров в один JSON-файл.
+    """
+    parts = sorted(Path(tmp_dir).glob(f"{name}-*.part"))
+    with open(path, "w", encoding="utf-8") as out:
+        out.write("{\n" if keyed else "[\n")
+        first = True
+        for part in parts:
+            if part.stat().st_size == 0:
+                continue
+            if not first:
+                out.write(",\n")
+            with open(part, "r", encoding="utf-8") as f:
+                shutil.copyfileobj(f, out, 1024 * 1024)
+            first = False
+        out.write("\n}\n" if keyed else "\n]\n")
+
+
+def run_blocks(worker, tasks, workers):
+    if workers <= 1 or len(tasks) <= 1:
+        return [worker(t) for t in tasks]
+    with Pool(processes=min(workers, len(tasks))) as pool:
+        return list(pool.imap_unordered(worker, tasks))
+
+
+def generate(
+    users_count=15,
+    max_albums_per_user=5,
+    images_per_user=(8, 25),
+    guest_uploads_count=10,
+    seed=None,
+    workers=1,
+    heavy_users=0.0,
+    heavy_factor=1,
+    album_ratio=0.6,
+    out_dir=None,
+):
+    """
+    Основная функция генерации seed-данных.
+
+    Параметры:
+    - users_count            — количество пользователей
+    - max_albums_per_user    — максимум альбомов на пользователя
+    - images_per_user        — диапазон количества изображений
+    - guest_uploads_count    — количество гостевых загрузок
+    - seed                   — одинаковый seed даёт одинаковые файлы
+    - workers                — число процессов (блоки пользователей делятся между ними)
+    - heavy_users            — доля «тяжёлых» пользователей (0.01 = 1%)
+    - heavy_factor           — во сколько раз у них больше изображений
+    - album_ratio            — доля изображений, попадающих в альбомы
+    - out_dir                — куда писать файлы (по умолчанию рядом со скриптом)
+
+    Записи пишутся в файлы по мере генерации, целиком в памяти не держатся.
+    Возвращает {коллекция: число записей}.
+    """
+    if out_dir is None:
+        paths = {"users": USERS_FILE, "albums": ALBUMS_FILE, "images": IMAGES_FILE, "guests": GUEST_FILE}
+    else:
+        out_dir = Path(out_dir)
+        out_dir.mkdir(parents=True, exist_ok=True)
+        paths = {
+            "users": out_dir / "users.json",
+            "albums": out_dir / "albums.json",
+            "images": out_dir / "images.json",
+            "guests": out_dir / "guest_uploads.json",
+        }
+
+    if seed is not None:
+        epoch = SEED_EPOCH
+    else:
+        epoch = datetime.now(timezone.utc) - timedelta(days=HISTORY_DAYS)
+
+    counts = {"users": 0, "albums": 0, "images": 0, "guests": 0}
+    with tempfile.TemporaryDirectory(prefix="seed-", dir=Path(paths["images"]).parent) as tmp_dir:
+        user_tasks = [
+            (block, first, min(first + BLOCK_USERS, users_count), seed, tmp_dir,
+             max_albums_per_user, tuple(images_per_user), heavy_users, heavy_factor, album_ratio, epoch)
+            for block, first in enumerate(range(0, users_count, BLOCK_USERS))
+        ]
+        guest_tasks = [
+            (block, min(BLOCK_GUESTS, guest_uploads_count - first), seed, tmp_dir, epoch)
+            for block, first in enumerate(range(0, guest_uploads_count, BLOCK_GUESTS))
+        ]
+
+        for _block, block_counts in run_blocks(generate_user_block, user_tasks, workers):
+            for name, n in block_counts.items():
+                counts[name] += n
+        for _block, block_counts in run_blocks(generate_guest_block, guest_tasks, workers):
+            counts["guests"] += block_counts["guests"]
+
+        # Сохранение данных в JSON-файлы
+        join_parts(tmp_dir, "users", paths["users"])
+        join_parts(tmp_dir, "albums", paths["albums"])
+        join_parts(tmp_dir, "images", paths["images"])
+        join_parts(tmp_dir, "guests", paths["guests"], keyed=True)
+
+    # Информация в консоль
+    print("Seed data generated:")
+    print(f"- users:  {counts['users']}  -> {paths['users']}")
+    print(f"- albums: {counts['albums']} -> {paths['albums']}")
+    print(f"- images: {counts['images']} -> {paths['images']}")
+    print(f"- guests: {counts['guests']} -> {paths['guests']}")
+    return counts
+
+
+def parse_range(text):
+    """
+    "8-25" -> (8, 25), "10" -> (10, 10)
+    """
+    low, _, high = text.partition("-")
+    low = int(low)
+    high = int(high) if high else low
+    if low < 0 or high < low:
+        raise argparse.ArgumentTypeError(f"bad range: {text}")
+    return low, high
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate Pixo seed data (users, albums, images, guests)")
+    parser.add_argument("--users", type=int, default=15, help="number of users")
+    parser.add_argument("--images-per-user", type=parse_range, default=(8, 25), help="range, e.g. 8-25")
+    parser.add_argument("--max-albums-per-user", type=int, default=5)
+    parser.add_argument("--guests", type=int, default=10, help="number of guest uploads")
+    parser.add_argument("--album-ratio", type=float, default=0.6, help="share of images placed in albums")
+    parser.add_argument("--heavy-users", type=float, default=0.0, help="share of heavy users, e.g. 0.01")
+    parser.add_argument("--heavy-factor", type=int, default=1, help="image multiplier for heavy users")
+    parser.add_argument("--seed", type=int, help="same seed -> same files")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="generator processes")
+    parser.add_argument("--out-dir", help="output directory (default: next to this script)")
+    args = parser.parse_args(argv)
+
+    generate(
+        users_count=args.users,
+        max_albums_per_user=args.max_albums_per_user,
+        images_per_user=args.images_per_user,
+        guest_uploads_count=args.guests,
+        seed=args.seed,
+        workers=args.workers,
+        heavy_users=args.heavy_users,
+        heavy_factor=args.heavy_factor,
+        album_ratio=args.album_ratio,
+        out_dir=args.out_dir,
+    )
+
+
+# Запуск генерации при прямом запуске файла
+if __name__ == "__main__":
+    main()
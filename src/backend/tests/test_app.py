@@ -1,342 +1,2238 @@
-# backend/tests/test_app.py
-
-import json
-import importlib.util
-from pathlib import Path
-
-import pytest
-
-
-# =========================
-# helpers (вспомогательные функции)
-# =========================
-
-def load_app_module():
-    """
-    Динамически загружает backend/app.py как модуль.
-    Нужно, чтобы в тестах можно было подменять переменные
-    (пути к файлам, s3 и т.п.) через monkeypatch.
-    """
-    backend_dir = Path(__file__).resolve().parents[1]
-    app_path = backend_dir / "app.py"
-
-    spec = importlib.util.spec_from_file_location("app", app_path)
-    module = importlib.util.module_from_spec(spec)
-    spec.loader.exec_module(module)
-    return module
-
-
-class DummyS3:
-    """
-    Заглушка для S3.
-    Используется, чтобы тесты не ходили в реальное облачное хранилище.
-    """
-    def upload_fileobj(self, *args, **kwargs):
-        return None
-
-    def delete_object(self, *args, **kwargs):
-        return None
-
-
-def read_json(path: Path, default):
-    """
-    Удобная функция для чтения JSON-файлов.
-    Если файл не существует — возвращает default.
-    """
-    if not path.exists():
-        return default
-    with path.open("r", encoding="utf-8") as f:
-        return json.load(f)
-
-
-# =========================
-# fixtures (фикстуры pytest)
-# =========================
-
-@pytest.fixture()
-def client(tmp_path, monkeypatch):
-    """
-    Создаёт тестовый клиент Flask-приложения.
-
-    - Подменяет пути к JSON-файлам на временные (tmp_path)
-    - Подменяет S3 на DummyS3
-    - Включает TESTING режим
-    """
-    app_module = load_app_module()
-
-    # Подмена файлов хранилища на временные
-    monkeypatch.setattr(app_module, "USERS_FILE", str(tmp_path / "users.json"))
-    monkeypatch.setattr(app_module, "IMAGES_FILE", str(tmp_path / "images.json"))
-    monkeypatch.setattr(app_module, "ALBUMS_FILE", str(tmp_path / "albums.json"))
-    monkeypatch.setattr(app_module, "GUEST_FILE", str(tmp_path / "guest_uploads.json"))
-
-    # Подмена S3
-    monkeypatch.setattr(app_module, "s3", DummyS3())
-
-    app_module.app.config["TESTING"] = True
-
-    # Сохраняем ссылку на модуль, чтобы обращаться к путям файлов в тестах
-    app_module.app.config["APP_MODULE"] = app_module
-
-    with app_module.app.test_client() as c:
-        yield c
-
-
-# =========================
-# tests: auth (регистрация и вход)
-# =========================
-
-def test_sign_up_success(client):
-    """
-    Успешная регистрация нового пользователя
-    """
-    res = client.post("/api/sign-up", json={"email": "a@a.com", "password": "123"})
-    assert res.status_code == 201
-
-    data = res.get_json()
-    assert data["message"] == "registered"
-    assert data["user"]["email"] == "a@a.com"
-    assert "id" in data["user"]
-
-
-def test_sign_up_missing_fields(client):
-    """
-    Регистрация с пустыми email и password → ошибка
-    """
-    res = client.post("/api/sign-up", json={"email": "", "password": ""})
-    assert res.status_code == 400
-
-    data = res.get_json()
-    assert data["error"] == "email_or_password_missing"
-
-
-def test_sign_up_existing_user(client):
-    """
-    Попытка зарегистрировать пользователя с уже существующим email
-    """
-    r1 = client.post("/api/sign-up", json={"email": "dup@a.com", "password": "123"})
-    assert r1.status_code == 201
-
-    r2 = client.post("/api/sign-up", json={"email": "dup@a.com", "password": "456"})
-    assert r2.status_code == 400
-
-    data = r2.get_json()
-    assert data["error"] == "user_exists"
-
-
-def test_sign_in_success(client):
-    """
-    Успешный вход с корректными данными
-    """
-    client.post("/api/sign-up", json={"email": "login@a.com", "password": "pass"})
-    res = client.post("/api/sign-in", json={"email": "login@a.com", "password": "pass"})
-
-    assert res.status_code == 200
-    data = res.get_json()
-    assert data["message"] == "ok"
-    assert data["user"]["email"] == "login@a.com"
-
-
-def test_sign_in_wrong_password(client):
-    """
-    Вход с неправильным паролем
-    """
-    client.post("/api/sign-up", json={"email": "wp@a.com", "password": "pass"})
-    res = client.post("/api/sign-in", json={"email": "wp@a.com", "password": "wrong"})
-
-    assert res.status_code == 400
-    data = res.get_json()
-    assert data["error"] == "wrong_password"
-
-
-def test_sign_in_user_not_found(client):
-    """
-    Вход для несуществующего пользователя
-    """
-    res = client.post("/api/sign-in", json={"email": "no@a.com", "password": "pass"})
-    assert res.status_code == 400
-
-    data = res.get_json()
-    assert data["error"] == "user_not_found"
-
-
-# =========================
-# tests: albums (работа с альбомами)
-# =========================
-
-def test_create_album_success(client):
-    """
-    Успешное создание альбома
-    """
-    u = client.post("/api/sign-up", json={"email": "alb@a.com", "password": "1"}).get_json()["user"]["id"]
-
-    res = client.post("/api/albums", json={"user_id": u, "title": "My album"})
-    assert res.status_code == 201
-
-    data = res.get_json()
-    assert data["album"]["title"] == "My album"
-    assert data["album"]["user_id"] == u
-    assert "id" in data["album"]
-
-
-def test_create_album_missing_title(client):
-    """
-    Попытка создать альбом без названия
-    """
-    u = client.post("/api/sign-up", json={"email": "alb2@a.com", "password": "1"}).get_json()["user"]["id"]
-
-    res = client.post("/api/albums", json={"user_id": u, "title": ""})
-    assert res.status_code == 400
-
-    data = res.get_json()
-    assert data["error"] == "user_id_or_title_missing"
-
-
-def test_rename_album_forbidden(client):
-    """
-    Попытка переименовать альбом чужим пользователем
-    """
-    u1 = client.post("/api/sign-up", json={"email": "u1@a.com", "password": "1"}).get_json()["user"]["id"]
-    u2 = client.post("/api/sign-up", json={"email": "u2@a.com", "password": "1"}).get_json()["user"]["id"]
-
-    alb = client.post("/api/albums", json={"user_id": u1, "title": "A"}).get_json()["album"]
-    album_id = alb["id"]
-
-    res = client.post(f"/api/album/{album_id}/rename", json={"user_id": u2, "title": "HACK"})
-    assert res.status_code == 403
-
-    data = res.get_json()
-    assert data["error"] == "forbidden"
-
-
-def test_delete_album_success_detaches_images(client):
-    """
-    Удаление альбома:
-    - альбом удаляется
-    - у всех изображений album_id становится None
-    """
-    app_module = client.application.config["APP_MODULE"]
-    images_path = Path(app_module.IMAGES_FILE)
-
-    u = client.post("/api/sign-up", json={"email": "delalb@a.com", "password": "1"}).get_json()["user"]["id"]
-    alb = client.post("/api/albums", json={"user_id": u, "title": "ToDel"}).get_json()["album"]
-    album_id = alb["id"]
-
-    # Имитируем изображения, привязанные к альбому
-    images = [
-        {"id": "img1", "user_id": u, "title": "1", "album_id": album_id, "key": "k1", "url": "u1", "created_at": "1"},
-        {"id": "img2", "user_id": u, "title": "2", "album_id": album_id, "key": "k2", "url": "u2", "created_at": "2"},
-    ]
-    images_path.write_text(json.dumps(images, ensure_ascii=False, indent=2), encoding="utf-8")
-
-    res = client.delete(f"/api/album/{album_id}", json={"user_id": u})
-    assert res.status_code == 200
-
-    data = res.get_json()
-    assert data["message"] == "ok"
-
-    after_images = read_json(images_path, [])
-    assert all(x.get("album_id") is None for x in after_images)
-
-
-# =========================
-# tests: images (работа с изображениями)
-# =========================
-
-def test_rename_image_success(client):
-    """
-    Успешное переименование изображения
-    """
-    app_module = client.application.config["APP_MODULE"]
-    images_path = Path(app_module.IMAGES_FILE)
-
-    u = client.post("/api/sign-up", json={"email": "ri@a.com", "password": "1"}).get_json()["user"]["id"]
-
-    images = [
-        {"id": "img1", "user_id": u, "title": "Old", "album_id": None, "key": "k1", "url": "u1", "created_at": "1"}
-    ]
-    images_path.write_text(json.dumps(images, ensure_ascii=False, indent=2), encoding="utf-8")
-
-    res = client.post("/api/image/img1/rename", json={"user_id": u, "title": "New"})
-    assert res.status_code == 200
-
-    data = res.get_json()
-    assert data["message"] == "ok"
-    assert data["image"]["title"] == "New"
-
-    after_images = read_json(images_path, [])
-    assert after_images[0]["title"] == "New"
-
-
-def test_rename_image_missing_title(client):
-    """
-    Переименование изображения без нового названия
-    """
-    app_module = client.application.config["APP_MODULE"]
-    images_path = Path(app_module.IMAGES_FILE)
-
-    u = client.post("/api/sign-up", json={"email": "ri2@a.com", "password": "1"}).get_json()["user"]["id"]
-    images_path.write_text(
-        json.dumps(
-            [{"id": "img1", "user_id": u, "title": "Old", "album_id": None, "key": "k1", "url": "u1"}],
-            ensure_ascii=False, indent=2
-        ),
-        encoding="utf-8"
-    )
-
-    res = client.post("/api/image/img1/rename", json={"user_id": u, "title": ""})
-    assert res.status_code == 400
-
-    data = res.get_json()
-    assert data["error"] == "user_id_or_title_missing"
-
-
-def test_delete_image_forbidden(client):
-    """
-    Попытка удалить изображение чужим пользователем
-    """
-    app_module = client.application.config["APP_MODULE"]
-    images_path = Path(app_module.IMAGES_FILE)
-
-    u1 = client.post("/api/sign-up", json={"email": "d1@a.com", "password": "1"}).get_json()["user"]["id"]
-    u2 = client.post("/api/sign-up", json={"email": "d2@a.com", "password": "1"}).get_json()["user"]["id"]
-
-    images_path.write_text(
-        json.dumps(
-            [{"id": "imgX", "user_id": u1, "title": "X", "album_id": None, "key": "kX", "url": "uX"}],
-            ensure_ascii=False, indent=2
-        ),
-        encoding="utf-8"
-    )
-
-    res = client.delete("/api/image/imgX", json={"user_id": u2})
-    assert res.status_code == 403
-
-    data = res.get_json()
-    assert data["error"] == "forbidden"
-
-
-def test_set_image_album_album_not_found(client):
-    """
-    Попытка привязать изображение к несуществующему альбому
-    """
-    app_module = client.application.config["APP_MODULE"]
-    images_path = Path(app_module.IMAGES_FILE)
-    albums_path = Path(app_module.ALBUMS_FILE)
-
-    u = client.post("/api/sign-up", json={"email": "sia@a.com", "password": "1"}).get_json()["user"]["id"]
-
-    images_path.write_text(
-        json.dumps(
-            [{"id": "img1", "user_id": u, "title": "1", "album_id": None, "key": "k1", "url": "u1"}],
-            ensure_ascii=False, indent=2
-        ),
-        encoding="utf-8"
-    )
-    albums_path.write_text(json.dumps([], ensure_ascii=False, indent=2), encoding="utf-8")
-
-    res = client.post("/api/image/img1/set-album", json={"user_id": u, "album_id": "no_such_album"})
-    assert res.status_code == 404
-
-    data = res.get_json()
-    assert data["error"] == "album_not_found"
+# backend/tests/test_app.py
+
+import hashlib
+import io
+import os
+import subprocess
+import sys
+import json
+import threading
+import time
+import importlib.util
+from pathlib import Path
+
+import pytest
+
+
+# =========================
+# helpers (вспомогательные функции)
+# =========================
+
+# общий секрет токенов: без него app.py вне debug не стартует
+os.environ.setdefault("PIXO_SESSION_SECRET", "test-secret")
+
+
+def load_app_module():
+    """
+    Динамически загружает backend/app.py как модуль.
+    Нужно, чтобы в тестах можно было подменять переменные
+    (пути к файлам, s3 и т.п.) через monkeypatch.
+    """
+    backend_dir = Path(__file__).resolve().parents[1]
+    app_path = backend_dir / "app.py"
+
+    spec = importlib.util.spec_from_file_location("app", app_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class DummyS3:
+    """
+    Заглушка для S3.
+    Используется, чтобы тесты не ходили в реальное облачное хранилище.
+    """
+    def upload_fileobj(self, *args, **kwargs):
+        return None
+
+    def delete_object(self, *args, **kwargs):
+        return None
+
+    def delete_objects(self, Bucket, Delete):
+        for obj in Delete["Objects"]:
+            self.delete_object(Bucket=Bucket, Key=obj["Key"])
+        return {"Errors": []}
+
+    def generate_presigned_post(self, Bucket, Key, Fields=None, Conditions=None, ExpiresIn=3600):
+        self.last_presign = {"Key": Key, "Fields": Fields, "Conditions": Conditions}
+        return {"url": f"https://bucket.example/{Bucket}", "fields": {**(Fields or {}), "key": Key}}
+
+    def head_object(self, Bucket, Key):
+        # «загруженные напрямую» объекты тест кладёт сюда сам
+        head = getattr(self, "objects", {}).get(Key)
+        if head is None:
+            raise KeyError(Key)
+        return head
+
+
+def read_json(path: Path, default):
+    """
+    Удобная функция для чтения JSON-файлов.
+    Если файл не существует — возвращает default.
+    """
+    if not path.exists():
+        return default
+    with path.open("r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+# =========================
+# fixtures (фикстуры pytest)
+# =========================
+
+@pytest.fixture()
+def client(tmp_path, monkeypatch):
+    """
+    Создаёт тестовый клиент Flask-приложения.
+
+    - Подменяет пути к JSON-файлам на временные (tmp_path)
+    - Подменяет S3 на LocalObjectStore во временном каталоге (без сети)
+    - Включает TESTING режим
+    """
+    app_module = load_app_module()
+
+    # Подмена файлов хранилища на временные
+    monkeypatch.setattr(app_module, "USERS_FILE", str(tmp_path / "users.json"))
+    monkeypatch.setattr(app_module, "IMAGES_FILE", str(tmp_path / "images.json"))
+    monkeypatch.setattr(app_module, "ALBUMS_FILE", str(tmp_path / "albums.json"))
+    monkeypatch.setattr(app_module, "GUEST_FILE", str(tmp_path / "guest_uploads.json"))
+    monkeypatch.setattr(app_module, "BLOBS_FILE", str(tmp_path / "blobs.json"))
+
+    # Подмена S3
+    monkeypatch.setattr(app_module, "s3", app_module.LocalObjectStore(str(tmp_path / "objects")))
+    monkeypatch.setattr(app_module, "image_cache", app_module.ObjectCache(
+        app_module.IMAGE_CACHE_MEMORY_BYTES, app_module.IMAGE_CACHE_DISK_BYTES, str(tmp_path / "image_cache")
+    ))
+
+    # Превью считаем в фоновом потоке, без пула процессов
+    monkeypatch.setattr(app_module, "DERIVATIVE_WORKERS", 0)
+
+    app_module.app.config["TESTING"] = True
+
+    # Сохраняем ссылку на модуль, чтобы обращаться к путям файлов в тестах
+    app_module.app.config["APP_MODULE"] = app_module
+
+    with app_module.app.test_client() as c:
+        yield c
+
+    # фоновые превью дописывают blob и запись — пока пути ещё подменены
+    if app_module._derivative_executor is not None:
+        app_module._derivative_executor.shutdown(wait=True)
+
+
+# =========================
+# tests: auth (регистрация и вход)
+# =========================
+
+def test_sign_up_success(client):
+    """
+    Успешная регистрация нового пользователя
+    """
+    res = client.post("/api/sign-up", json={"email": "a@a.com", "password": "123"})
+    assert res.status_code == 201
+
+    data = res.get_json()
+    assert data["message"] == "registered"
+    assert data["user"]["email"] == "a@a.com"
+    assert "id" in data["user"]
+
+
+def test_sign_up_missing_fields(client):
+    """
+    Регистрация с пустыми email и password → ошибка
+    """
+    res = client.post("/api/sign-up", json={"email": "", "password": ""})
+    assert res.status_code == 400
+
+    data = res.get_json()
+    assert data["error"] == "email_or_password_missing"
+
+
+def test_sign_up_existing_user(client):
+    """
+    Попытка зарегистрировать пользователя с уже существующим email
+    """
+    r1 = client.post("/api/sign-up", json={"email": "dup@a.com", "password": "123"})
+    assert r1.status_code == 201
+
+    r2 = client.post("/api/sign-up", json={"email": "dup@a.com", "password": "456"})
+    assert r2.status_code == 400
+
+    data = r2.get_json()
+    assert data["error"] == "user_exists"
+
+
+def test_sign_in_success(client):
+    """
+    Успешный вход с корректными данными
+    """
+    client.post("/api/sign-up", json={"email": "login@a.com", "password": "pass"})
+    res = client.post("/api/sign-in", json={"email": "login@a.com", "password": "pass"})
+
+    assert res.status_code == 200
+    data = res.get_json()
+    assert data["message"] == "ok"
+    assert data["user"]["email"] == "login@a.com"
+
+
+def test_sign_in_wrong_password(client):
+    """
+    Вход с неправильным паролем
+    """
+    client.post("/api/sign-up", json={"email": "wp@a.com", "password": "pass"})
+    res = client.post("/api/sign-in", json={"email": "wp@a.com", "password": "wrong"})
+
+    assert res.status_code == 400
+    data = res.get_json()
+    assert data["error"] == "wrong_password"
+
+
+def test_sign_in_user_not_found(client):
+    """
+    Вход для несуществующего пользователя
+    """
+    res = client.post("/api/sign-in", json={"email": "no@a.com", "password": "pass"})
+    assert res.status_code == 400
+
+    data = res.get_json()
+    assert data["error"] == "user_not_found"
+
+
+# =========================
+# tests: albums (работа с альбомами)
+# =========================
+
+def test_create_album_success(client):
+    """
+    Успешное создание альбома
+    """
+    u = client.post("/api/sign-up", json={"email": "alb@a.com", "password": "1"}).get_json()["user"]["id"]
+
+    res = client.post("/api/albums", json={"user_id": u, "title": "My album"})
+    assert res.status_code == 201
+
+    data = res.get_json()
+    assert data["album"]["title"] == "My album"
+    assert data["album"]["user_id"] == u
+    assert "id" in data["album"]
+
+
+def test_create_album_missing_title(client):
+    """
+    Попытка создать альбом без названия
+    """
+    u = client.post("/api/sign-up", json={"email": "alb2@a.com", "password": "1"}).get_json()["user"]["id"]
+
+    res = client.post("/api/albums", json={"user_id": u, "title": ""})
+    assert res.status_code == 400
+
+    data = res.get_json()
+    assert data["error"] == "user_id_or_title_missing"
+
+
+def test_rename_album_forbidden(client):
+    """
+    Попытка переименовать альбом чужим пользователем
+    """
+    u1 = client.post("/api/sign-up", json={"email": "u1@a.com", "password": "1"}).get_json()["user"]["id"]
+    u2 = client.post("/api/sign-up", json={"email": "u2@a.com", "password": "1"}).get_json()["user"]["id"]
+
+    alb = client.post("/api/albums", json={"user_id": u1, "title": "A"}).get_json()["album"]
+    album_id = alb["id"]
+
+    res = client.post(f"/api/album/{album_id}/rename", json={"user_id": u2, "title": "HACK"})
+    assert res.status_code == 403
+
+    data = res.get_json()
+    assert data["error"] == "forbidden"
+
+
+def test_delete_album_success_detaches_images(client):
+    """
+    Удаление альбома:
+    - альбом удаляется
+    - у всех изображений album_id становится None
+    """
+    app_module = client.application.config["APP_MODULE"]
+    images_path = Path(app_module.IMAGES_FILE)
+
+    u = client.post("/api/sign-up", json={"email": "delalb@a.com", "password": "1"}).get_json()["user"]["id"]
+    alb = client.post("/api/albums", json={"user_id": u, "title": "ToDel"}).get_json()["album"]
+    album_id = alb["id"]
+
+    # Имитируем изображения, привязанные к альбому
+    images = [
+        {"id": "img1", "user_id": u, "title": "1", "album_id": album_id, "key": "k1", "url": "u1", "created_at": "1"},
+        {"id": "img2", "user_id": u, "title": "2", "album_id": album_id, "key": "k2", "url": "u2", "created_at": "2"},
+    ]
+    images_path.write_text(json.dumps(images, ensure_ascii=False, indent=2), encoding="utf-8")
+
+    res = client.delete(f"/api/album/{album_id}", json={"user_id": u})
+    assert res.status_code == 200
+
+    data = res.get_json()
+    assert data["message"] == "ok"
+
+    after_images = read_json(images_path, [])
+    assert all(x.get("album_id") is None for x in after_images)
+
+
+# =========================
+# tests: images (работа с изображениями)
+# =========================
+
+def test_rename_image_success(client):
+    """
+    Успешное переименование изображения
+    """
+    app_module = client.application.config["APP_MODULE"]
+    images_path = Path(app_module.IMAGES_FILE)
+
+    u = client.post("/api/sign-up", json={"email": "ri@a.com", "password": "1"}).get_json()["user"]["id"]
+
+    images = [
+        {"id": "img1", "user_id": u, "title": "Old", "album_id": None, "key": "k1", "url": "u1", "created_at": "1"}
+    ]
+    images_path.write_text(json.dumps(images, ensure_ascii=False, indent=2), encoding="utf-8")
+
+    res = client.post("/api/image/img1/rename", json={"user_id": u, "title": "New"})
+    assert res.status_code == 200
+
+    data = res.get_json()
+    assert data["message"] == "ok"
+    assert data["image"]["title"] == "New"
+
+    after_images = read_json(images_path, [])
+    assert after_images[0]["title"] == "New"
+
+
+def test_rename_image_missing_title(client):
+    """
+    Переименование изображения без нового названия
+    """
+    app_module = client.application.config["APP_MODULE"]
+    images_path = Path(app_module.IMAGES_FILE)
+
+    u = client.post("/api/sign-up", json={"email": "ri2@a.com", "password": "1"}).get_json()["user"]["id"]
+    images_path.write_text(
+        json.dumps(
+            [{"id": "img1", "user_id": u, "title": "Old", "album_id": None, "key": "k1", "url": "u1"}],
+            ensure_ascii=False, indent=2
+        ),
+        encoding="utf-8"
+    )
+
+    res = client.post("/api/image/img1/rename", json={"user_id": u, "title": ""})
+    assert res.status_code == 400
+
+    data = res.get_json()
+    assert data["error"] == "user_id_or_title_missing"
+
+
+def test_delete_image_forbidden(client):
+    """
+    Попытка удалить изображение чужим пользователем
+    """
+    app_module = client.application.config["APP_MODULE"]
+    images_path = Path(app_module.IMAGES_FILE)
+
+    u1 = client.post("/api/sign-up", json={"email": "d1@a.com", "password": "1"}).get_json()["user"]["id"]
+    u2 = client.post("/api/sign-up", json={"email": "d2@a.com", "password": "1"}).get_json()["user"]["id"]
+
+    images_path.write_text(
+        json.dumps(
+            [{"id": "imgX", "user_id": u1, "title": "X", "album_id": None, "key": "kX", "url": "uX"}],
+            ensure_ascii=False, indent=2
+        ),
+        encoding="utf-8"
+    )
+
+    res = client.delete("/api/image/imgX", json={"user_id": u2})
+    assert res.status_code == 403
+
+    data = res.get_json()
+    assert data["error"] == "forbidden"
+
+
+def test_set_image_album_album_not_found(client):
+    """
+    Попытка привязать изображение к несуществующему альбому
+    """
+    app_module = client.application.config["APP_MODULE"]
+    images_path = Path(app_module.IMAGES_FILE)
+    albums_path = Path(app_module.ALBUMS_FILE)
+
+    u = client.post("/api/sign-up", json={"email": "sia@a.com", "password": "1"}).get_json()["user"]["id"]
+
+    images_path.write_text(
+        json.dumps(
+            [{"id": "img1", "user_id": u, "title": "1", "album_id": None, "key": "k1", "url": "u1"}],
+            ensure_ascii=False, indent=2
+        ),
+        encoding="utf-8"
+    )
+    albums_path.write_text(json.dumps([], ensure_ascii=False, indent=2), encoding="utf-8")
+
+    res = client.post("/api/image/img1/set-album", json={"user_id": u, "album_id": "no_such_album"})
+    assert res.status_code == 404
+
+    data = res.get_json()
+    assert data["error"] == "album_not_found"
+
+
+# =========================
+# tests: storage (журнал изменений)
+# =========================
+
+def test_wal_mode_appends_records_instead_of_rewriting(client, monkeypatch):
+    """
+    Режим wal:
+    - регистрация и создание альбома не переписывают JSON-файлы
+    - изменения попадают в журнал и видны при чтении
+    """
+    app_module = client.application.config["APP_MODULE"]
+    monkeypatch.setattr(app_module, "STORAGE_MODE", "wal")
+
+    u = client.post("/api/sign-up", json={"email": "wal@a.com", "password": "1"}).get_json()["user"]["id"]
+    client.post("/api/albums", json={"user_id": u, "title": "A"})
+    client.post(f"/api/user/{u}/update", json={"username": "walter"})
+
+    assert not Path(app_module.USERS_FILE).exists()
+    assert not Path(app_module.ALBUMS_FILE).exists()
+
+    wal_lines = Path(app_module.USERS_FILE + ".wal").read_text(encoding="utf-8").splitlines()
+    assert [json.loads(line)["op"] for line in wal_lines] == ["start", "put", "put"]
+
+    res = client.post("/api/sign-in", json={"email": "wal@a.com", "password": "1"})
+    assert res.status_code == 200
+
+    albums = client.get(f"/api/albums/{u}").get_json()["albums"]
+    assert [a["title"] for a in albums] == ["A"]
+
+    user = client.get(f"/api/user/{u}").get_json()["user"]
+    assert user["username"] == "walter"
+
+
+def test_wal_compaction_writes_snapshot(client, monkeypatch):
+    """
+    Сворачивание журнала:
+    - снимок содержит все записи
+    - журнал очищается
+    """
+    app_module = client.application.config["APP_MODULE"]
+    monkeypatch.setattr(app_module, "STORAGE_MODE", "wal")
+    users_path = Path(app_module.USERS_FILE)
+
+    client.post("/api/sign-up", json={"email": "c1@a.com", "password": "1"})
+    client.post("/api/sign-up", json={"email": "c2@a.com", "password": "1"})
+
+    assert app_module.compact_wal("users") is True
+
+    snapshot = read_json(users_path, [])
+    assert [u["email"] for u in snapshot] == ["c1@a.com", "c2@a.com"]
+    assert Path(app_module.USERS_FILE + ".wal").read_text(encoding="utf-8") == ""
+
+    # после сворачивания журнал снова принимает записи
+    client.post("/api/sign-up", json={"email": "c3@a.com", "password": "1"})
+    assert len(app_module.load_users()) == 3
+
+
+def test_sqlite_mode_routes(client, monkeypatch, tmp_path):
+    """
+    Режим sqlite:
+    - регистрация, вход, альбомы и привязка фото работают через базу
+    - повторный email отсекается уникальным индексом
+    """
+    app_module = client.application.config["APP_MODULE"]
+    monkeypatch.setattr(app_module, "STORAGE_MODE", "sqlite")
+    monkeypatch.setattr(app_module, "SQLITE_FILE", str(tmp_path / "pixo.db"))
+
+    u = client.post("/api/sign-up", json={"email": "sql@a.com", "password": "1"}).get_json()["user"]["id"]
+    dup = client.post("/api/sign-up", json={"email": "sql@a.com", "password": "2"})
+    assert dup.status_code == 400
+    assert dup.get_json()["error"] == "user_exists"
+
+    # гонка: проверка email не увидела соседа, отсекает сам индекс
+    with monkeypatch.context() as m:
+        m.setattr(app_module, "find_user_by_email", lambda email: None)
+        raced = client.post("/api/sign-up", json={"email": "sql@a.com", "password": "3"})
+    assert raced.status_code == 400
+    assert raced.get_json()["error"] == "user_exists"
+
+    assert client.post("/api/sign-in", json={"email": "sql@a.com", "password": "1"}).status_code == 200
+
+    album_id = client.post("/api/albums", json={"user_id": u, "title": "A"}).get_json()["album"]["id"]
+    app_module.put_record("images", {
+        "id": "img1", "user_id": u, "title": "1", "album_id": None, "key": "k1", "url": "u1", "created_at": "1"
+    })
+
+    res = client.post("/api/image/img1/set-album", json={"user_id": u, "album_id": album_id})
+    assert res.status_code == 200
+
+    album = client.get(f"/api/album/{album_id}").get_json()
+    assert [img["id"] for img in album["images"]] == ["img1"]
+    assert [img["id"] for img in client.get(f"/api/gallery/{u}").get_json()["images"]] == ["img1"]
+
+    assert not Path(app_module.USERS_FILE).exists()
+
+
+def test_sqlite_write_does_not_commit_outer_transaction(client, monkeypatch, tmp_path):
+    """
+    Запись внутри table_transaction откатывается вместе с ним, а не коммитится сама
+    """
+    app_module = client.application.config["APP_MODULE"]
+    monkeypatch.setattr(app_module, "STORAGE_MODE", "sqlite")
+    monkeypatch.setattr(app_module, "SQLITE_FILE", str(tmp_path / "pixo.db"))
+
+    with pytest.raises(RuntimeError):
+        with app_module.table_transaction("images"):
+            app_module.put_record("images", {"id": "img1", "user_id": "u1", "created_at": "1"})
+            assert app_module.db().in_transaction
+            raise RuntimeError("abort")
+
+    assert app_module.find_image("img1") is None
+    assert not app_module.db().in_transaction
+
+
+def test_migrate_json_to_sqlite(client, monkeypatch, tmp_path):
+    """
+    Перенос JSON-файлов в SQLite: все записи доступны после переключения режима,
+    повторный запуск ничего не дублирует
+    """
+    app_module = client.application.config["APP_MODULE"]
+
+    u = client.post("/api/sign-up", json={"email": "mig@a.com", "password": "1"}).get_json()["user"]["id"]
+    client.post("/api/albums", json={"user_id": u, "title": "Old"})
+    Path(app_module.IMAGES_FILE).write_text(
+        json.dumps(
+            [{"id": "img1", "user_id": u, "title": "1", "album_id": None, "key": "k1", "url": "u1", "created_at": "1"}],
+            ensure_ascii=False, indent=2
+        ),
+        encoding="utf-8"
+    )
+    Path(app_module.GUEST_FILE).write_text(json.dumps({"g1": {"key": "guest/x.png"}}), encoding="utf-8")
+
+    monkeypatch.setattr(app_module, "SQLITE_FILE", str(tmp_path / "pixo.db"))
+    result = app_module.migrate_json_to_sqlite()
+    assert result == {"users": (1, 1), "images": (1, 1), "albums": (1, 1), "guests": (1, 1), "blobs": (0, 0)}
+    assert app_module.migrate_json_to_sqlite()["images"] == (1, 0)
+
+    monkeypatch.setattr(app_module, "STORAGE_MODE", "sqlite")
+    assert client.post("/api/sign-in", json={"email": "mig@a.com", "password": "1"}).status_code == 200
+    assert [a["title"] for a in client.get(f"/api/albums/{u}").get_json()["albums"]] == ["Old"]
+    assert [img["id"] for img in client.get(f"/api/gallery/{u}").get_json()["images"]] == ["img1"]
+    assert app_module.find_guest("g1") == {"key": "guest/x.png"}
+
+
+# =========================
+# tests: repository (коллекции в памяти)
+# =========================
+
+def test_repository_parses_file_once(client, monkeypatch):
+    """
+    Повторные запросы не перечитывают images.json, пока файл не изменился
+    """
+    app_module = client.application.config["APP_MODULE"]
+    images_path = Path(app_module.IMAGES_FILE)
+    images_path.write_text(
+        json.dumps(
+            [{"id": "img1", "user_id": "u1", "title": "1", "album_id": None, "key": "k1", "url": "u1", "created_at": "1"}],
+            ensure_ascii=False, indent=2
+        ),
+        encoding="utf-8"
+    )
+
+    reads = []
+    original = app_module.read_json_file
+
+    def counting_read(path, default):
+        reads.append(path)
+        return original(path, default)
+
+    monkeypatch.setattr(app_module, "read_json_file", counting_read)
+
+    for _ in range(3):
+        assert client.get("/api/image/img1").status_code == 200
+        assert len(client.get("/api/gallery/u1").get_json()["images"]) == 1
+
+    assert reads.count(str(images_path)) == 1
+
+
+def test_repository_reloads_when_file_changes(client):
+    """
+    Изменение файла другим процессом (новые mtime/size) видно в следующем запросе
+    """
+    app_module = client.application.config["APP_MODULE"]
+    images_path = Path(app_module.IMAGES_FILE)
+
+    images = [{"id": "img1", "user_id": "u1", "title": "1", "album_id": None, "key": "k1", "url": "u1", "created_at": "1"}]
+    images_path.write_text(json.dumps(images), encoding="utf-8")
+    assert len(client.get("/api/gallery/u1").get_json()["images"]) == 1
+
+    images.append({"id": "img2", "user_id": "u1", "title": "2", "album_id": None, "key": "k2", "url": "u2", "created_at": "2"})
+    images_path.write_text(json.dumps(images), encoding="utf-8")
+
+    ids = [img["id"] for img in client.get("/api/gallery/u1").get_json()["images"]]
+    assert ids == ["img2", "img1"]
+    assert client.get("/api/image/img2").status_code == 200
+
+
+def test_repository_applies_wal_tail(client, monkeypatch):
+    """
+    Режим wal: записи, дописанные в журнал, применяются без повторного разбора снимка
+    """
+    app_module = client.application.config["APP_MODULE"]
+    monkeypatch.setattr(app_module, "STORAGE_MODE", "wal")
+
+    u = client.post("/api/sign-up", json={"email": "tail@a.com", "password": "1"}).get_json()["user"]["id"]
+    assert client.get(f"/api/user/{u}").status_code == 200
+
+    reads = []
+    original = app_module.read_json_file
+    monkeypatch.setattr(app_module, "read_json_file", lambda path, default: reads.append(path) or original(path, default))
+
+    # запись другого процесса
+    entry = {"op": "put", "key": "u2", "value": {"id": "u2", "email": "other@a.com", "password": "1"}}
+    with open(app_module.USERS_FILE + ".wal", "a", encoding="utf-8") as f:
+        f.write(json.dumps(entry) + "\n")
+
+    assert client.post("/api/sign-in", json={"email": "other@a.com", "password": "1"}).status_code == 200
+    assert reads == []
+
+
+# =========================
+# tests: pagination (постраничная выдача)
+# =========================
+
+@pytest.mark.parametrize("storage_mode", ["json", "sqlite"])
+def test_gallery_pagination_walks_all_images(client, monkeypatch, tmp_path, storage_mode):
+    """
+    Постраничная выдача галереи:
+    - страницы по limit идут от новых к старым без пропусков и повторов
+    - на последней странице next_cursor = None
+    """
+    app_module = client.application.config["APP_MODULE"]
+    monkeypatch.setattr(app_module, "STORAGE_MODE", storage_mode)
+    monkeypatch.setattr(app_module, "SQLITE_FILE", str(tmp_path / "pixo.db"))
+
+    # два изображения с одинаковым created_at — порядок всё равно однозначный
+    created = ["1", "3", "2", "5", "4", "4", "6"]
+    images = [
+        {"id": f"img{i}", "user_id": "u1", "title": str(i), "album_id": None,
+         "key": f"k{i}", "url": f"u{i}", "created_at": c}
+        for i, c in enumerate(created)
+    ]
+    app_module.save_images(images)
+
+    full = [img["id"] for img in client.get("/api/gallery/u1").get_json()["images"]]
+    assert full == ["img6", "img3", "img5", "img4", "img1", "img2", "img0"]
+
+    seen, cursor = [], None
+    while True:
+        url = "/api/gallery/u1?limit=3" + (f"&cursor={cursor}" if cursor else "")
+        data = client.get(url).get_json()
+        seen += [img["id"] for img in data["images"]]
+        cursor = data["next_cursor"]
+        if cursor is None:
+            break
+
+    assert seen == full
+
+
+def test_album_pagination_sees_new_uploads(client):
+    """
+    Постраничная выдача альбома учитывает изображения, добавленные после первой загрузки
+    """
+    u = client.post("/api/sign-up", json={"email": "pg@a.com", "password": "1"}).get_json()["user"]["id"]
+    album_id = client.post("/api/albums", json={"user_id": u, "title": "A"}).get_json()["album"]["id"]
+
+    app_module = client.application.config["APP_MODULE"]
+    for i in range(3):
+        app_module.put_record("images", {
+            "id": f"img{i}", "user_id": u, "title": str(i), "album_id": album_id,
+            "key": f"k{i}", "url": f"u{i}", "created_at": str(i)
+        })
+
+    first = client.get(f"/api/album/{album_id}?limit=2").get_json()
+    assert [img["id"] for img in first["images"]] == ["img2", "img1"]
+
+    client.post("/api/image/img0/set-album", json={"user_id": u, "album_id": None})
+
+    second = client.get(f"/api/album/{album_id}?limit=2&cursor={first['next_cursor']}").get_json()
+    assert second["images"] == []
+    assert second["next_cursor"] is None
+
+
+def test_pagination_bad_params(client):
+    """
+    Некорректные limit / cursor → 400
+    """
+    assert client.get("/api/gallery/u1?limit=0").get_json()["error"] == "bad_limit"
+    assert client.get("/api/gallery/u1?limit=abc").get_json()["error"] == "bad_limit"
+    assert client.get("/api/gallery/u1?cursor=not-a-cursor").get_json()["error"] == "bad_cursor"
+
+
+# =========================
+# tests: etag (условные запросы)
+# =========================
+
+@pytest.mark.parametrize("storage_mode", ["json", "wal", "sqlite"])
+def test_gallery_etag_304_until_user_changes(client, monkeypatch, tmp_path, storage_mode):
+    """
+    ETag галереи:
+    - с совпавшим If-None-Match ответ 304 без тела
+    - загрузка другого пользователя ETag не меняет
+    - загрузка самого пользователя меняет
+    """
+    app_module = client.application.config["APP_MODULE"]
+    monkeypatch.setattr(app_module, "STORAGE_MODE", storage_mode)
+    monkeypatch.setattr(app_module, "SQLITE_FILE", str(tmp_path / "pixo.db"))
+
+    def upload(user_id):
+        return client.post(
+            "/api/upload-user",
+            data={"user_id": user_id, "file": (io.BytesIO(b"img"), "a.png", "image/png")},
+            content_type="multipart/form-data",
+        )
+
+    upload("u1")
+    first = client.get("/api/gallery/u1")
+    etag = first.headers["ETag"]
+    assert len(first.get_json()["images"]) == 1
+
+    res = client.get("/api/gallery/u1", headers={"If-None-Match": etag})
+    assert res.status_code == 304
+    assert res.data == b""
+
+    upload("u2")
+    assert client.get("/api/gallery/u1", headers={"If-None-Match": etag}).status_code == 304
+
+    upload("u1")
+    res = client.get("/api/gallery/u1", headers={"If-None-Match": etag})
+    assert res.status_code == 200
+    assert res.headers["ETag"] != etag
+    assert len(res.get_json()["images"]) == 2
+
+
+@pytest.mark.parametrize("storage_mode", ["json", "wal", "sqlite"])
+def test_etags_match_across_separately_loaded_stores(tmp_path, monkeypatch, storage_mode):
+    """
+    Два воркера на одних файлах (и воркер, запущенный позже) отдают одинаковые
+    ETag; запись одного пользователя не меняет ETag другого ни у кого из них
+    """
+    def worker():
+        app_module = load_app_module()
+        for name, file in [("USERS_FILE", "users.json"), ("IMAGES_FILE", "images.json"),
+                           ("ALBUMS_FILE", "albums.json"), ("GUEST_FILE", "guest_uploads.json"),
+                           ("BLOBS_FILE", "blobs.json")]:
+            monkeypatch.setattr(app_module, name, str(tmp_path / file))
+        monkeypatch.setattr(app_module, "STORAGE_MODE", storage_mode)
+        monkeypatch.setattr(app_module, "SQLITE_FILE", str(tmp_path / "pixo.db"))
+        monkeypatch.setattr(app_module, "s3", app_module.LocalObjectStore(str(tmp_path / "objects")))
+        monkeypatch.setattr(app_module, "HAS_PILLOW", False)
+        app_module.app.config["TESTING"] = True
+        return app_module.app.test_client()
+
+    def upload(client, user_id):
+        res = client.post(
+            "/api/upload-user",
+            data={"user_id": user_id, "file": (io.BytesIO(user_id.encode()), "a.png", "image/png")},
+            content_type="multipart/form-data",
+        )
+        assert res.status_code == 201
+
+    def etags(path):
+        return {c.get(path).headers["ETag"] for c in (a, b)}
+
+    a, b = worker(), worker()
+    upload(a, "u1")
+    upload(b, "u2")
+    first = etags("/api/gallery/u1")
+    assert len(first) == 1
+
+    upload(b, "u2")
+    assert etags("/api/gallery/u1") == first
+    assert worker().get("/api/gallery/u1").headers["ETag"] in first
+
+    upload(b, "u1")
+    second = etags("/api/gallery/u1")
+    assert len(second) == 1 and second != first
+    assert worker().get("/api/gallery/u1").headers["ETag"] in second
+
+
+def test_album_and_user_etags(client):
+    """
+    ETag альбома меняется при привязке фото, ETag профиля — при обновлении профиля
+    """
+    app_module = client.application.config["APP_MODULE"]
+    u = client.post("/api/sign-up", json={"email": "et@a.com", "password": "1"}).get_json()["user"]["id"]
+    album_id = client.post("/api/albums", json={"user_id": u, "title": "A"}).get_json()["album"]["id"]
+    app_module.put_record("images", {
+        "id": "img1", "user_id": u, "title": "1", "album_id": None, "key": "k1", "url": "u1", "created_at": "1"
+    })
+
+    album_etag = client.get(f"/api/album/{album_id}").headers["ETag"]
+    user_etag = client.get(f"/api/user/{u}").headers["ETag"]
+    image_etag = client.get("/api/image/img1").headers["ETag"]
+
+    assert client.get(f"/api/album/{album_id}", headers={"If-None-Match": album_etag}).status_code == 304
+    assert client.get(f"/api/user/{u}", headers={"If-None-Match": user_etag}).status_code == 304
+    assert client.get("/api/image/img1", headers={"If-None-Match": image_etag}).status_code == 304
+
+    client.post("/api/image/img1/set-album", json={"user_id": u, "album_id": album_id})
+    client.post(f"/api/user/{u}/update", json={"username": "new"})
+
+    res = client.get(f"/api/album/{album_id}", headers={"If-None-Match": album_etag})
+    assert res.status_code == 200
+    assert [img["id"] for img in res.get_json()["images"]] == ["img1"]
+    assert client.get(f"/api/user/{u}", headers={"If-None-Match": user_etag}).status_code == 200
+    assert client.get("/api/image/img1", headers={"If-None-Match": image_etag}).status_code == 200
+
+
+# =========================
+# tests: direct upload (загрузка напрямую в бакет)
+# =========================
+
+def post_to_bucket(client, upload, body, content_type=None):
+    """
+    То, что делает браузер с ответом /presign: POST формы прямо в хранилище
+    """
+    fields = dict(upload["fields"])
+    if content_type:
+        fields["Content-Type"] = content_type
+    return client.post(
+        upload["url"],
+        data={**fields, "file": (io.BytesIO(body), "f", fields.get("Content-Type"))},
+        content_type="multipart/form-data",
+    )
+
+
+def test_presigned_user_upload_flow(client):
+    """
+    Двухшаговая загрузка:
+    - presign выдаёт политику с лимитом размера и image/*
+    - confirm без объекта в бакете → ошибка
+    - confirm после загрузки создаёт запись, повторный confirm её не дублирует
+    """
+    app_module = client.application.config["APP_MODULE"]
+
+    res = client.post("/api/upload-user/presign", json={"user_id": "u1", "filename": "cat.PNG", "content_type": "image/png"})
+    assert res.status_code == 200
+    data = res.get_json()
+    key = data["key"]
+    assert key == f"user/u1/{data['image_id']}.png"
+    assert data["upload"]["fields"]["key"] == key
+    policy = json.loads(app_module.b64decode(data["upload"]["fields"]["policy"]))
+    assert ["content-length-range", 1, app_module.MAX_SIZE_BYTES] in policy["conditions"]
+    assert ["starts-with", "$Content-Type", "image/"] in policy["conditions"]
+
+    confirm = {"user_id": "u1", "image_id": data["image_id"], "key": key, "title": "Cat"}
+    assert client.post("/api/upload-user/confirm", json=confirm).get_json()["error"] == "upload_not_found"
+
+    assert post_to_bucket(client, data["upload"], b"cat").status_code == 204
+    res = client.post("/api/upload-user/confirm", json=confirm)
+    assert res.status_code == 201
+    assert res.get_json()["image"]["title"] == "Cat"
+
+    assert client.post("/api/upload-user/confirm", json=confirm).status_code == 200
+    assert len(client.get("/api/gallery/u1").get_json()["images"]) == 1
+
+
+def test_presigned_upload_rejects_foreign_key_and_non_images(client):
+    """
+    confirm не принимает чужой ключ, presign — не-изображения
+    """
+    res = client.post("/api/upload-user/presign", json={"user_id": "u1", "filename": "a.txt", "content_type": "text/plain"})
+    assert res.get_json()["error"] == "only_images_allowed"
+
+    data = client.post("/api/upload-user/presign", json={"user_id": "u1", "filename": "a.png", "content_type": "image/png"}).get_json()
+    res = client.post("/api/upload-user/confirm", json={"user_id": "u2", "image_id": data["image_id"], "key": data["key"]})
+    assert res.status_code == 400
+    assert res.get_json()["error"] == "bad_key"
+
+
+def test_presigned_guest_upload_sets_cookie(client):
+    """
+    Гостевая загрузка напрямую:
+    - presign ставит cookie guest_id и подписывает ключ для этого гостя
+    - confirm без подписи или с cookie другого гостя — bad_key
+    - confirm того же гостя записывает загрузку
+    """
+    app_module = client.application.config["APP_MODULE"]
+
+    res = client.post("/api/upload-guest/presign", json={"filename": "a.jpg", "content_type": "image/jpeg"})
+    assert "guest_id=" in res.headers["Set-Cookie"]
+    data = res.get_json()
+    key = data["key"]
+    assert post_to_bucket(client, data["upload"], b"jpeg").status_code == 204
+
+    res = client.post("/api/upload-guest/confirm", json={"key": key})
+    assert (res.status_code, res.get_json()) == (400, {"error": "bad_key"})
+
+    other = app_module.app.test_client()
+    other.post("/api/upload-guest/presign", json={"filename": "b.jpg", "content_type": "image/jpeg"})
+    res = other.post("/api/upload-guest/confirm", json={"key": key, "ticket": data["ticket"]})
+    assert (res.status_code, res.get_json()) == (400, {"error": "bad_key"})
+
+    res = client.post("/api/upload-guest/confirm", json={"key": key, "ticket": data["ticket"]})
+    assert res.status_code == 201
+    assert "guest_id=" in res.headers["Set-Cookie"]
+    assert app_module.find_guest(res.get_json()["guest_id"])["key"] == key
+
+
+def test_local_store_serves_ranges_and_conditional_requests(client):
+    """
+    Объект локального хранилища отдаётся с его Content-Type, по Range (206 / 416)
+    и с 304 на If-None-Match; ключи вне каталога и .meta недоступны
+    """
+    body = b"0123456789" * 10
+    res = client.post(
+        "/api/upload-guest",
+        data={"file": (io.BytesIO(body), "a.png", "image/png")},
+        content_type="multipart/form-data",
+    )
+    url = res.get_json()["url"]
+    assert url.startswith("http://localhost:5000/objects/guest/")
+    path = url.split("localhost:5000", 1)[1]
+
+    full = client.get(path)
+    assert full.status_code == 200
+    assert full.data == body
+    assert full.mimetype == "image/png"
+    assert full.headers["Accept-Ranges"] == "bytes"
+
+    part = client.get(path, headers={"Range": "bytes=10-19"})
+    assert part.status_code == 206
+    assert part.data == body[10:20]
+    assert part.headers["Content-Range"] == "bytes 10-19/100"
+    assert client.get(path, headers={"Range": "bytes=500-"}).status_code == 416
+
+    cached = client.get(path, headers={"If-None-Match": full.headers["ETag"]})
+    assert cached.status_code == 304
+    assert cached.data == b""
+
+    assert client.get("/objects/guest/missing.png").status_code == 404
+    assert client.get("/objects/.meta/" + path.split("/objects/", 1)[1] + ".json").status_code == 404
+    app_module = client.application.config["APP_MODULE"]
+    with pytest.raises(app_module.ObjectNotFound):
+        app_module.s3.path("../users.json")
+
+
+def test_local_store_rejects_bad_presigned_posts(client):
+    """
+    POST в локальное хранилище проверяет подпись, ключ и условия политики
+    """
+    app_module = client.application.config["APP_MODULE"]
+    upload = client.post(
+        "/api/upload-user/presign", json={"user_id": "u1", "filename": "a.png", "content_type": "image/png"}
+    ).get_json()["upload"]
+
+    forged = {**upload, "fields": {**upload["fields"], "key": "user/u2/x.png"}}
+    assert post_to_bucket(client, forged, b"x").get_json()["error"] == "bad_key"
+
+    tampered = {**upload, "fields": {**upload["fields"], "signature": "AAAA"}}
+    assert post_to_bucket(client, tampered, b"x").get_json()["error"] == "bad_signature"
+    tampered = {**upload, "fields": {**upload["fields"], "signature": "подпись"}}
+    assert post_to_bucket(client, tampered, b"x").get_json()["error"] == "bad_signature"
+
+    assert post_to_bucket(client, upload, b"x", content_type="text/html").get_json()["error"] == "policy_condition_failed"
+    assert post_to_bucket(client, upload, b"").get_json()["error"] == "policy_condition_failed"
+
+    with pytest.raises(app_module.ObjectNotFound):
+        app_module.s3.head_object(Bucket=app_module.S3_BUCKET, Key=upload["fields"]["key"])
+
+
+# =========================
+# tests: upload limits / streaming (лимиты и потоковая загрузка)
+# =========================
+
+class ReadingS3(DummyS3):
+    """
+    S3-заглушка, которая, как настоящий клиент, вычитывает поток до конца
+    """
+    def __init__(self):
+        self.uploaded = {}
+
+    def upload_fileobj(self, fileobj, bucket, key, ExtraArgs=None, Config=None):
+        data = b""
+        while True:
+            chunk = fileobj.read(1024)
+            if not chunk:
+                break
+            data += chunk
+        self.uploaded[key] = data
+
+    def get_object(self, Bucket, Key):
+        return {"Body": io.BytesIO(self.uploaded[Key])}
+
+
+def test_oversized_upload_rejected_by_content_length(client, monkeypatch):
+    """
+    Слишком большое тело отсекается по Content-Length ещё до разбора формы
+    """
+    app_module = client.application.config["APP_MODULE"]
+    s3 = ReadingS3()
+    monkeypatch.setattr(app_module, "s3", s3)
+    monkeypatch.setattr(app_module, "MAX_SIZE_BYTES", 1024)
+
+    res = client.post(
+        "/api/upload-user",
+        data={"user_id": "u1", "file": (io.BytesIO(b"x" * 200 * 1024), "big.png", "image/png")},
+        content_type="multipart/form-data",
+    )
+    assert res.status_code == 400
+    assert res.get_json()["error"] == "file_too_large"
+    assert s3.uploaded == {}
+
+    # тело даже не читается: заявленного Content-Length достаточно
+    res = client.post(
+        "/api/upload-user",
+        data=b"",
+        content_type="multipart/form-data; boundary=x",
+        environ_overrides={"CONTENT_LENGTH": str(10 ** 9)},
+    )
+    assert res.get_json()["error"] == "file_too_large"
+
+
+def test_stream_upload_goes_straight_to_s3(client, monkeypatch):
+    """
+    Потоковая загрузка: тело запроса целиком уходит в S3 и появляется в галерее
+    """
+    app_module = client.application.config["APP_MODULE"]
+    s3 = ReadingS3()
+    monkeypatch.setattr(app_module, "s3", s3)
+
+    body = b"\x89PNG" + b"x" * 5000
+    res = client.put("/api/upload-user/stream?user_id=u1&filename=a.png&title=A", data=body, content_type="image/png")
+    assert res.status_code == 201
+
+    image = res.get_json()["image"]
+    assert image["title"] == "A"
+    assert s3.uploaded[image["key"]] == body
+    assert [img["id"] for img in client.get("/api/gallery/u1").get_json()["images"]] == [image["id"]]
+
+
+def test_stream_upload_without_content_length_is_cut_at_limit(client, monkeypatch):
+    """
+    Потоковая загрузка без Content-Length обрывается, как только прочитано больше лимита
+    """
+    app_module = client.application.config["APP_MODULE"]
+    monkeypatch.setattr(app_module, "s3", ReadingS3())
+    monkeypatch.setattr(app_module, "MAX_SIZE_BYTES", 1000)
+
+    res = client.put(
+        "/api/upload-guest/stream?filename=a.png",
+        input_stream=io.BytesIO(b"x" * 5000),
+        content_type="image/png",
+    )
+    assert res.status_code == 400
+    assert res.get_json()["error"] == "file_too_large"
+    assert app_module.load_guests() == {}
+
+
+# =========================
+# tests: background uploads (фоновая загрузка)
+# =========================
+
+def wait_for_job(client, job_id, timeout=5.0):
+    """
+    Опрашивает /api/upload-status, пока задача не завершится
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = client.get(f"/api/upload-status/{job_id}").get_json()["job"]
+        if job["status"] in ("done", "failed"):
+            return job
+        time.sleep(0.01)
+    raise AssertionError(f"job {job_id} did not finish")
+
+
+def test_async_upload_returns_202_and_finishes_in_background(client, monkeypatch, tmp_path):
+    """
+    Режим async:
+    - ответ 202 с job_id до загрузки в S3
+    - по завершении задача done, изображение в галерее, spool-файл удалён
+    """
+    app_module = client.application.config["APP_MODULE"]
+    s3 = ReadingS3()
+    monkeypatch.setattr(app_module, "s3", s3)
+    monkeypatch.setattr(app_module, "UPLOAD_MODE", "async")
+    monkeypatch.setattr(app_module, "UPLOAD_SPOOL_DIR", str(tmp_path / "spool"))
+
+    res = client.post(
+        "/api/upload-user",
+        data={"user_id": "u1", "file": (io.BytesIO(b"img-bytes"), "a.png", "image/png")},
+        content_type="multipart/form-data",
+    )
+    assert res.status_code == 202
+    job = res.get_json()["job"]
+    assert job["status"] == "queued"
+
+    done = wait_for_job(client, job["id"])
+    assert done["status"] == "done"
+    assert done["image"]["id"] == job["image_id"]
+    assert s3.uploaded[done["image"]["key"]] == b"img-bytes"
+
+    assert [img["id"] for img in client.get("/api/gallery/u1").get_json()["images"]] == [job["image_id"]]
+    assert not list((tmp_path / "spool").glob("*.part"))
+
+    # статусы задач в /metrics — одним рядом, а не по файлу на задачу
+    text = client.get("/metrics").get_data(as_text=True)
+    assert 'file="job"' in text
+    assert ".job.json" not in text
+
+
+def test_async_upload_failure_is_reported(client, monkeypatch, tmp_path):
+    """
+    Ошибка S3 в фоне → задача failed, метаданные не записаны
+    """
+    app_module = client.application.config["APP_MODULE"]
+
+    class FailingS3(DummyS3):
+        def upload_fileobj(self, *args, **kwargs):
+            raise RuntimeError("bucket unavailable")
+
+    monkeypatch.setattr(app_module, "s3", FailingS3())
+    monkeypatch.setattr(app_module, "UPLOAD_MODE", "async")
+    monkeypatch.setattr(app_module, "UPLOAD_SPOOL_DIR", str(tmp_path / "spool"))
+
+    res = client.post(
+        "/api/upload-user",
+        data={"user_id": "u1", "file": (io.BytesIO(b"img"), "a.png", "image/png")},
+        content_type="multipart/form-data",
+    )
+    job = wait_for_job(client, res.get_json()["job"]["id"])
+    assert job["status"] == "failed"
+    assert client.get("/api/gallery/u1").get_json()["images"] == []
+
+    assert client.get("/api/upload-status/not-a-job").status_code == 404
+
+
+def test_old_jobs_are_swept(client, monkeypatch, tmp_path):
+    """
+    Статусы задач и spool-файлы старше JOB_TTL удаляются, свежие остаются
+    """
+    app_module = client.application.config["APP_MODULE"]
+    spool = tmp_path / "spool"
+    spool.mkdir()
+    monkeypatch.setattr(app_module, "UPLOAD_SPOOL_DIR", str(spool))
+
+    old_time = time.time() - app_module.JOB_TTL - 60
+    for name in ["old.job.json", "old.part", "fresh.job.json", "other.txt"]:
+        (spool / name).write_text("{}")
+    for name in ["old.job.json", "old.part", "other.txt"]:
+        os.utime(spool / name, (old_time, old_time))
+
+    assert app_module.sweep_jobs() == 2
+    assert sorted(p.name for p in spool.iterdir()) == ["fresh.job.json", "other.txt"]
+
+
+def test_derivatives_do_not_share_the_upload_queue(client, monkeypatch):
+    """
+    Заполненная очередь загрузок не отбрасывает задачу превью
+    """
+    app_module = client.application.config["APP_MODULE"]
+    monkeypatch.setattr(app_module, "HAS_PILLOW", True)
+    done = threading.Event()
+    monkeypatch.setattr(app_module, "generate_derivatives", lambda *args: done.set())
+
+    taken = 0
+    while app_module._upload_slots.acquire(blocking=False):
+        taken += 1
+    try:
+        assert not app_module.submit_background(print)
+        app_module.schedule_derivatives({"id": "i1", "key": "user/u1/a.png"})
+        assert done.wait(5)
+    finally:
+        for _ in range(taken):
+            app_module._upload_slots.release()
+
+
+# =========================
+# tests: derivatives (превью)
+# =========================
+
+def png_bytes(width, height):
+    Image = pytest.importorskip("PIL.Image")
+    buf = io.BytesIO()
+    Image.new("RGB", (width, height), (200, 40, 40)).save(buf, "PNG")
+    return buf.getvalue()
+
+
+def wait_for_image_field(client, user_id, field, timeout=5.0):
+    """
+    Ждёт, пока фоновая задача допишет поле в изображение из галереи
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        images = client.get(f"/api/gallery/{user_id}").get_json()["images"]
+        if images and images[0].get(field):
+            return images[0]
+        time.sleep(0.01)
+    raise AssertionError(f"{field} did not appear")
+
+
+def test_upload_generates_thumbnail_and_preview(client, monkeypatch):
+    """
+    После загрузки в фоне появляются webp-превью:
+    - thumb не больше 256px, preview не увеличивает маленький оригинал
+    - ссылки записаны в изображение, оригинал не тронут
+    """
+    from PIL import Image
+
+    app_module = client.application.config["APP_MODULE"]
+    s3 = ReadingS3()
+    monkeypatch.setattr(app_module, "s3", s3)
+    original = png_bytes(800, 400)
+
+    res = client.post(
+        "/api/upload-user",
+        data={"user_id": "u1", "file": (io.BytesIO(original), "a.png", "image/png")},
+        content_type="multipart/form-data",
+    )
+    assert res.status_code == 201
+    key = res.get_json()["image"]["key"]
+
+    img = wait_for_image_field(client, "u1", "preview_url")
+    thumb_key = app_module.derivative_key(key, "thumb")
+    preview_key = app_module.derivative_key(key, "preview")
+    assert img["thumb_url"].endswith(thumb_key)
+    assert img["preview_url"].endswith(preview_key)
+    assert s3.uploaded[key] == original
+
+    with Image.open(io.BytesIO(s3.uploaded[thumb_key])) as thumb:
+        assert thumb.format == "WEBP"
+        assert thumb.size == (256, 128)
+    with Image.open(io.BytesIO(s3.uploaded[preview_key])) as preview:
+        assert preview.size == (800, 400)
+
+
+def test_stream_upload_builds_derivatives_from_bucket(client, monkeypatch):
+    """
+    Потоковая загрузка: превью строятся из объекта, уже лежащего в бакете
+    """
+    app_module = client.application.config["APP_MODULE"]
+    s3 = ReadingS3()
+    monkeypatch.setattr(app_module, "s3", s3)
+
+    res = client.put(
+        "/api/upload-user/stream?user_id=u1&filename=a.png",
+        data=png_bytes(300, 300),
+        content_type="image/png",
+    )
+    assert res.status_code == 201
+
+    img = wait_for_image_field(client, "u1", "thumb_url")
+    assert app_module.derivative_key(img["key"], "thumb") in s3.uploaded
+
+
+# =========================
+# tests: dedup (одинаковое содержимое)
+# =========================
+
+class CountingS3(ReadingS3):
+    def __init__(self):
+        super().__init__()
+        self.deleted = []
+
+    def delete_object(self, Bucket, Key):
+        self.deleted.append(Key)
+        self.uploaded.pop(Key, None)
+
+
+@pytest.mark.parametrize("storage_mode", ["json", "wal", "sqlite"])
+def test_duplicate_upload_reuses_object(client, monkeypatch, tmp_path, storage_mode):
+    """
+    Повторная загрузка того же содержимого тем же пользователем:
+    - в бакет ничего не отправляется, запись ссылается на тот же ключ
+    - refs растёт, DELETE /api/image удаляет объект (и превью) только
+      с последней ссылкой
+    - другой пользователь получает свой объект, а не ключ user/<чужой id>/
+    """
+    app_module = client.application.config["APP_MODULE"]
+    monkeypatch.setattr(app_module, "STORAGE_MODE", storage_mode)
+    monkeypatch.setattr(app_module, "SQLITE_FILE", str(tmp_path / "pixo.db"))
+    s3 = CountingS3()
+    monkeypatch.setattr(app_module, "s3", s3)
+
+    def upload(user_id, body):
+        res = client.post(
+            "/api/upload-user",
+            data={"user_id": user_id, "file": (io.BytesIO(body), "a.png", "image/png")},
+            content_type="multipart/form-data",
+        )
+        assert res.status_code == 201
+        return res.get_json()["image"]
+
+    first = upload("u1", b"same-bytes")
+    second = upload("u1", b"same-bytes")
+    other = upload("u1", b"other-bytes")
+    foreign = upload("u2", b"same-bytes")
+
+    assert second["id"] != first["id"]
+    assert second["key"] == first["key"] and second["url"] == first["url"]
+    assert other["key"] != first["key"]
+    assert foreign["key"].startswith("user/u2/")
+    assert sorted(s3.uploaded) == sorted([first["key"], other["key"], foreign["key"]])
+    assert s3.uploaded[first["key"]] == s3.uploaded[foreign["key"]] == b"same-bytes"
+
+    digest = first["digest"]
+    assert digest == "u1:" + hashlib.sha256(b"same-bytes").hexdigest()
+    assert second["digest"] == digest and foreign["digest"] != digest
+    assert app_module.find_blob(digest)["refs"] == 2
+    assert app_module.find_blob(foreign["digest"])["refs"] == 1
+
+    assert client.delete(f"/api/image/{first['id']}", json={"user_id": "u1"}).status_code == 200
+    assert app_module.find_image(first["id"]) is None
+    assert first["key"] in s3.uploaded
+    assert app_module.find_blob(digest)["refs"] == 1
+
+    assert client.delete(f"/api/image/{second['id']}", json={"user_id": "u1"}).status_code == 200
+    assert first["key"] not in s3.uploaded
+    assert app_module.derivative_key(first["key"], "thumb") in s3.deleted
+    assert app_module.find_blob(digest) is None
+    assert foreign["key"] in s3.uploaded
+    assert client.delete(f"/api/image/{second['id']}", json={"user_id": "u1"}).status_code == 404
+
+
+def test_duplicate_uploaded_while_derivatives_build_gets_them(client, monkeypatch):
+    """
+    Копия, загруженная, пока превью оригинала ещё строятся, второй раз их
+    не строит, но получает thumb_url / preview_url, когда сборка закончится
+    """
+    app_module = client.application.config["APP_MODULE"]
+    monkeypatch.setattr(app_module, "HAS_PILLOW", True)
+    started, release = threading.Event(), threading.Event()
+    renders = []
+
+    def slow_render(data, sizes, quality):
+        renders.append(data)
+        started.set()
+        assert release.wait(10)
+        return {name: b"webp-" + name.encode() for name in sizes}
+
+    monkeypatch.setattr(app_module, "render_derivatives", slow_render)
+
+    def upload():
+        res = client.post(
+            "/api/upload-user",
+            data={"user_id": "u1", "file": (io.BytesIO(b"same-bytes"), "a.png", "image/png")},
+            content_type="multipart/form-data",
+        )
+        assert res.status_code == 201
+        return res.get_json()["image"]
+
+    first = upload()
+    assert started.wait(10)
+    second = upload()
+    assert "thumb_url" not in second
+
+    release.set()
+    app_module.derivative_executor().shutdown(wait=True)
+    images = [app_module.find_image(i["id"]) for i in (first, second)]
+
+    assert images[0]["thumb_url"] == images[1]["thumb_url"]
+    assert images[0]["preview_url"] == images[1]["preview_url"]
+    assert renders == [b"same-bytes"]
+    assert "building" not in app_module.find_blob(first["digest"])
+
+
+def test_duplicate_stream_upload_drops_new_object(client, monkeypatch):
+    """
+    Потоковая загрузка: хэш считается на лету, дубликат удаляется из бакета
+    """
+    app_module = client.application.config["APP_MODULE"]
+    s3 = CountingS3()
+    monkeypatch.setattr(app_module, "s3", s3)
+
+    first = client.put("/api/upload-user/stream?user_id=u1&filename=a.png", data=b"dup", content_type="image/png")
+    second = client.put("/api/upload-user/stream?user_id=u1&filename=b.png", data=b"dup", content_type="image/png")
+    first, second = first.get_json()["image"], second.get_json()["image"]
+
+    assert second["key"] == first["key"]
+    assert list(s3.uploaded) == [first["key"]]
+    assert len(s3.deleted) == 1 and s3.deleted[0] != first["key"]
+    assert app_module.find_blob(first["digest"])["refs"] == 2
+
+
+# =========================
+# tests: batch upload (пакетная загрузка)
+# =========================
+
+@pytest.mark.parametrize("storage_mode", ["json", "wal", "sqlite"])
+def test_batch_upload_reports_each_file(client, monkeypatch, tmp_path, storage_mode):
+    """
+    Пакет из нескольких файлов:
+    - результат по каждому файлу в порядке формы
+    - плохие файлы не мешают остальным
+    - записи изображений сохраняются одной записью
+    """
+    app_module = client.application.config["APP_MODULE"]
+    monkeypatch.setattr(app_module, "STORAGE_MODE", storage_mode)
+    monkeypatch.setattr(app_module, "SQLITE_FILE", str(tmp_path / "pixo.db"))
+    s3 = ReadingS3()
+    monkeypatch.setattr(app_module, "s3", s3)
+
+    # json пишет через json_commit, wal/sqlite — через save_table
+    writes = []
+
+    def counting(fn):
+        def wrapper(name, *args, **kwargs):
+            writes.append(name)
+            return fn(name, *args, **kwargs)
+        return wrapper
+
+    monkeypatch.setattr(app_module, "save_table", counting(app_module.save_table))
+    monkeypatch.setattr(app_module, "json_commit", counting(app_module.json_commit))
+
+    res = client.post(
+        "/api/upload-user/batch",
+        data={
+            "user_id": "u1",
+            "files": [
+                (io.BytesIO(b"one"), "1.png", "image/png"),
+                (io.BytesIO(b"text"), "notes.txt", "text/plain"),
+                (io.BytesIO(b"two"), "2.jpg", "image/jpeg"),
+            ],
+        },
+        content_type="multipart/form-data",
+    )
+    assert res.status_code == 201
+    results = res.get_json()["results"]
+    assert [r["filename"] for r in results] == ["1.png", "notes.txt", "2.jpg"]
+    assert results[1] == {"filename": "notes.txt", "error": "only_images_allowed"}
+    assert s3.uploaded[results[0]["image"]["key"]] == b"one"
+    assert s3.uploaded[results[2]["image"]["key"]] == b"two"
+
+    assert writes.count("images") == 1
+    gallery = client.get("/api/gallery/u1").get_json()["images"]
+    assert sorted(img["title"] for img in gallery) == ["1.png", "2.jpg"]
+
+
+def test_batch_upload_failed_object_is_not_recorded(client, monkeypatch):
+    """
+    Ошибка S3 на одном файле: он помечается upload_failed, остальные сохраняются
+    """
+    app_module = client.application.config["APP_MODULE"]
+
+    class FlakyS3(ReadingS3):
+        def upload_fileobj(self, fileobj, bucket, key, ExtraArgs=None, Config=None):
+            if key.endswith(".gif"):
+                raise RuntimeError("bucket unavailable")
+            super().upload_fileobj(fileobj, bucket, key, ExtraArgs, Config)
+
+    monkeypatch.setattr(app_module, "s3", FlakyS3())
+
+    res = client.post(
+        "/api/upload-user/batch",
+        data={
+            "user_id": "u1",
+            "files": [
+                (io.BytesIO(b"a"), "a.gif", "image/gif"),
+                (io.BytesIO(b"b"), "b.png", "image/png"),
+            ],
+        },
+        content_type="multipart/form-data",
+    )
+    assert res.status_code == 201
+    results = res.get_json()["results"]
+    assert results[0] == {"filename": "a.gif", "error": "upload_failed"}
+    assert [img["title"] for img in client.get("/api/gallery/u1").get_json()["images"]] == ["b.png"]
+
+    assert client.post("/api/upload-user/batch", data={"user_id": "u1"}).get_json()["error"] == "no_file"
+
+
+# =========================
+# tests: bulk album (массовый перенос в альбом)
+# =========================
+
+@pytest.mark.parametrize("storage_mode", ["json", "wal", "sqlite"])
+def test_bulk_set_album_reports_each_id(client, monkeypatch, tmp_path, storage_mode):
+    """
+    Массовый перенос:
+    - свои фото переносятся, чужие и несуществующие — ошибка по id
+    - изображения сохраняются одной записью
+    - пустой album_id убирает фото из альбома
+    """
+    app_module = client.application.config["APP_MODULE"]
+    monkeypatch.setattr(app_module, "STORAGE_MODE", storage_mode)
+    monkeypatch.setattr(app_module, "SQLITE_FILE", str(tmp_path / "pixo.db"))
+
+    album = client.post("/api/albums", json={"user_id": "u1", "title": "Trip"}).get_json()["album"]
+    app_module.put_records("images", [
+        {"id": f"img{i}", "user_id": "u1" if i < 3 else "u2", "album_id": None, "created_at": str(i)}
+        for i in range(4)
+    ])
+
+    writes = []
+    put_records = app_module.put_records
+
+    def counting_put_records(name, records):
+        writes.append((name, len(records)))
+        return put_records(name, records)
+
+    monkeypatch.setattr(app_module, "put_records", counting_put_records)
+
+    res = client.post("/api/images/set-album", json={
+        "user_id": "u1",
+        "album_id": album["id"],
+        "image_ids": ["img0", "img3", "nope", "img1", "img0"],
+    })
+    assert res.status_code == 200
+    assert res.get_json()["results"] == [
+        {"id": "img0", "album_id": album["id"]},
+        {"id": "img3", "error": "forbidden"},
+        {"id": "nope", "error": "not_found"},
+        {"id": "img1", "album_id": album["id"]},
+    ]
+    assert writes == [("images", 2)]
+
+    album_ids = [img["id"] for img in client.get(f"/api/album/{album['id']}").get_json()["images"]]
+    assert sorted(album_ids) == ["img0", "img1"]
+    assert app_module.find_image("img3")["album_id"] is None
+
+    res = client.post("/api/images/set-album", json={"user_id": "u1", "album_id": "", "image_ids": ["img0"]})
+    assert res.get_json()["results"] == [{"id": "img0", "album_id": None}]
+    assert app_module.find_image("img0")["album_id"] is None
+
+
+def test_bulk_set_album_validation(client):
+    """
+    Чужой альбом и пустой список id отклоняются целиком
+    """
+    album = client.post("/api/albums", json={"user_id": "u2", "title": "Other"}).get_json()["album"]
+
+    res = client.post("/api/images/set-album", json={"user_id": "u1", "album_id": album["id"], "image_ids": ["x"]})
+    assert res.status_code == 404
+    assert res.get_json()["error"] == "album_not_found"
+
+    res = client.post("/api/images/set-album", json={"user_id": "u1", "image_ids": []})
+    assert res.status_code == 400
+    assert res.get_json()["error"] == "image_ids_missing"
+
+
+@pytest.mark.parametrize("storage_mode", ["json", "wal", "sqlite"])
+def test_single_record_updates_keep_concurrent_fields(client, monkeypatch, tmp_path, storage_mode):
+    """
+    set-album, update и change-password пишут только свои поля:
+    превью, дописанные фоном, и пароль, сменённый параллельно, не теряются
+    """
+    app_module = client.application.config["APP_MODULE"]
+    monkeypatch.setattr(app_module, "STORAGE_MODE", storage_mode)
+    monkeypatch.setattr(app_module, "SQLITE_FILE", str(tmp_path / "pixo.db"))
+
+    album = client.post("/api/albums", json={"user_id": "u1", "title": "Trip"}).get_json()["album"]
+    app_module.put_record("images", {"id": "img0", "user_id": "u1", "album_id": None, "created_at": "1"})
+
+    # превью готово, пока роут проверяет альбом
+    find_album = app_module.find_album
+
+    def find_album_during_derivatives(album_id):
+        app_module.patch_record("images", "img0", {"thumb_url": "thumb"})
+        return find_album(album_id)
+
+    monkeypatch.setattr(app_module, "find_album", find_album_during_derivatives)
+    res = client.post("/api/image/img0/set-album", json={"user_id": "u1", "album_id": album["id"]})
+    assert res.status_code == 200
+    image = app_module.find_image("img0")
+    assert (image["album_id"], image["thumb_url"]) == (album["id"], "thumb")
+
+    user = client.post("/api/sign-up", json={"email": "a@a.com", "password": "old"}).get_json()["user"]
+
+    # пароль меняется, пока update проверяет email
+    find_user_by_email = app_module.find_user_by_email
+
+    def find_by_email_during_password_change(email):
+        app_module.patch_record("users", user["id"], {"password": "new"})
+        return find_user_by_email(email)
+
+    monkeypatch.setattr(app_module, "find_user_by_email", find_by_email_during_password_change)
+    res = client.post(f"/api/user/{user['id']}/update", json={"user_id": user["id"], "email": "b@a.com", "username": "bob"})
+    assert res.status_code == 200
+    stored = app_module.find_user(user["id"])
+    assert (stored["email"], stored["username"], stored["password"]) == ("b@a.com", "bob", "new")
+
+    res = client.post(f"/api/user/{user['id']}/change-password", json={
+        "user_id": user["id"], "old_password": "new", "new_password": "newer"
+    })
+    assert res.status_code == 200
+    assert app_module.find_user(user["id"])["username"] == "bob"
+
+
+# =========================
+# tests: guest expiry (уборка просроченных гостей)
+# =========================
+
+class BatchDeleteS3(DummyS3):
+    def __init__(self, fail_keys=()):
+        self.batches = []
+        self.fail_keys = set(fail_keys)
+
+    def delete_objects(self, Bucket, Delete):
+        keys = [o["Key"] for o in Delete["Objects"]]
+        self.batches.append(keys)
+        return {"Errors": [{"Key": k, "Code": "AccessDenied"} for k in keys if k in self.fail_keys]}
+
+
+@pytest.mark.parametrize("storage_mode", ["json", "wal", "sqlite"])
+def test_sweep_guests_removes_expired_entries_and_objects(client, monkeypatch, tmp_path, storage_mode):
+    """
+    Уборка гостей:
+    - удаляются только записи старше GUEST_TTL (и без uploaded_at)
+    - объекты удаляются пачками не больше S3_DELETE_BATCH
+    - счётчики отдаются через /api/system/guest-sweep, только с X-Admin-Token
+    """
+    from datetime import datetime, timedelta
+
+    app_module = client.application.config["APP_MODULE"]
+    monkeypatch.setattr(app_module, "STORAGE_MODE", storage_mode)
+    monkeypatch.setattr(app_module, "SQLITE_FILE", str(tmp_path / "pixo.db"))
+    monkeypatch.setattr(app_module, "S3_DELETE_BATCH", 2)
+    s3 = BatchDeleteS3(fail_keys={"guest/old3.png"})
+    monkeypatch.setattr(app_module, "s3", s3)
+
+    now = datetime(2024, 5, 2, 12, 0)
+    old = (now - timedelta(days=2)).isoformat()
+    fresh = (now - timedelta(hours=1)).isoformat()
+    for i in range(4):
+        app_module.put_record("guests", {"key": f"guest/old{i}.png", "uploaded_at": old}, key=f"old{i}")
+    app_module.put_record("guests", {"key": "guest/legacy.png"}, key="legacy")
+    app_module.put_record("guests", {"key": "guest/fresh.png", "uploaded_at": fresh}, key="fresh")
+
+    result = app_module.sweep_guests(now=now)
+    assert result == {"entries": 5, "objects": 4, "failed": 1}
+    assert [len(batch) for batch in s3.batches] == [2, 2, 1]
+    assert "guest/fresh.png" not in sum(s3.batches, [])
+
+    assert sorted(app_module.load_guests()) == ["fresh"]
+    assert app_module.sweep_guests(now=now) == {"entries": 0, "objects": 0, "failed": 0}
+
+    monkeypatch.setattr(app_module, "ADMIN_TOKEN", "secret")
+    assert client.get("/api/system/guest-sweep").status_code == 403
+    assert client.get("/api/system/guest-sweep", headers={"X-Admin-Token": "nope"}).status_code == 403
+
+    stats = client.get("/api/system/guest-sweep", headers={"X-Admin-Token": "secret"}).get_json()["sweeper"]
+    assert stats["runs"] == 2
+    assert (stats["entries"], stats["objects"], stats["failed"]) == (5, 4, 1)
+    assert stats["last"] == {"entries": 0, "objects": 0, "failed": 0}
+
+
+def test_guest_sweeper_starts_only_from_serving_entry(monkeypatch):
+    """
+    Импорт app уборку не запускает; init_serving — да, если не выключена
+    """
+    app_module = load_app_module()
+    assert app_module._guest_sweeper is None
+
+    started = []
+    monkeypatch.setattr(app_module, "start_guest_sweeper", lambda: started.append(True))
+    monkeypatch.setattr(os, "register_at_fork", lambda **kw: None)
+
+    monkeypatch.setattr(app_module, "GUEST_SWEEPER", False)
+    app_module.init_serving()
+    assert started == []
+
+    monkeypatch.setattr(app_module, "_serving", False)
+    monkeypatch.setattr(app_module, "GUEST_SWEEPER", True)
+    app_module.init_serving()
+    app_module.init_serving()
+    assert started == [True]
+
+    monkeypatch.setenv("PIXO_GUEST_SWEEPER", "0")
+    assert load_app_module().GUEST_SWEEPER is False
+
+
+# =========================
+# tests: session tokens (подписанные токены)
+# =========================
+
+def sign_in_token(client, email):
+    client.post("/api/sign-up", json={"email": email, "password": "1"})
+    data = client.post("/api/sign-in", json={"email": email, "password": "1"}).get_json()
+    return data["user"]["id"], data["token"]
+
+
+def test_token_resolves_caller_without_reading_users(client, monkeypatch):
+    """
+    Токен из sign-in:
+    - защищённые роуты работают без user_id от клиента
+    - users.json при этом не читается
+    - user_id в теле не может подменить владельца токена
+    """
+    app_module = client.application.config["APP_MODULE"]
+    u, token = sign_in_token(client, "tok@a.com")
+    auth = {"Authorization": f"Bearer {token}"}
+
+    def no_users(*args, **kwargs):
+        raise AssertionError("users must not be read")
+
+    monkeypatch.setattr(app_module, "find_user", no_users)
+    monkeypatch.setattr(app_module, "find_user_by_email", no_users)
+
+    res = client.post("/api/albums", json={"user_id": "someone-else", "title": "Mine"}, headers=auth)
+    assert res.status_code == 201
+    assert res.get_json()["album"]["user_id"] == u
+
+    res = client.post(
+        "/api/upload-user",
+        data={"file": (io.BytesIO(b"img"), "a.png", "image/png")},
+        content_type="multipart/form-data",
+        headers=auth,
+    )
+    assert res.status_code == 201
+    assert res.get_json()["image"]["user_id"] == u
+
+
+def test_bad_or_expired_token_is_rejected(client, monkeypatch):
+    """
+    Подделанный, испорченный и просроченный токены — 401;
+    с REQUIRE_TOKEN запрос без токена тоже 401
+    """
+    app_module = client.application.config["APP_MODULE"]
+    u, token = sign_in_token(client, "bad@a.com")
+
+    payload, signature = token.split(".")
+    forged = app_module.b64encode(json.dumps({"sub": "admin", "exp": 2 ** 40}).encode()) + "." + signature
+    expired = app_module.issue_token(u, now=time.time() - app_module.SESSION_TTL - 1)
+
+    for bad in (forged, payload, "garbage", expired):
+        res = client.post("/api/albums", json={"title": "A"}, headers={"Authorization": f"Bearer {bad}"})
+        assert res.status_code == 401
+        assert res.get_json()["error"] == "invalid_token"
+
+    assert app_module.verify_token(token) == u
+
+    # старый клиент с user_id — пока разрешён
+    assert client.post("/api/albums", json={"user_id": u, "title": "A"}).status_code == 201
+
+    monkeypatch.setattr(app_module, "REQUIRE_TOKEN", True)
+    res = client.post("/api/albums", json={"user_id": u, "title": "A"})
+    assert res.status_code == 401
+    assert res.get_json()["error"] == "token_missing"
+
+
+def test_session_secret_is_required_outside_debug(monkeypatch):
+    """
+    Без PIXO_SESSION_SECRET сервер не стартует и токены не подписываются;
+    в debug — случайный секрет. Сам импорт секрета не требует
+    """
+    monkeypatch.delenv("PIXO_SESSION_SECRET", raising=False)
+    monkeypatch.delenv("FLASK_DEBUG", raising=False)
+    app_module = load_app_module()
+    with pytest.raises(RuntimeError, match="PIXO_SESSION_SECRET"):
+        app_module.init_serving()
+    with pytest.raises(RuntimeError, match="PIXO_SESSION_SECRET"):
+        app_module.issue_token(1)
+
+    app_module.init_serving(debug=True)
+    assert app_module.SESSION_SECRET
+    assert app_module.verify_token(app_module.issue_token(1))
+
+
+def test_derivative_pool_starts_without_session_secret(tmp_path):
+    """
+    Процессы пула превью (spawn) импортируют app заново — без секрета тоже
+    """
+    env = {k: v for k, v in os.environ.items() if k not in ("PIXO_SESSION_SECRET", "FLASK_DEBUG")}
+    probe = (
+        "import io\n"
+        "from PIL import Image\n"
+        "import app\n"
+        "buf = io.BytesIO()\n"
+        "Image.new('RGB', (64, 64)).save(buf, format='PNG')\n"
+        "app.DERIVATIVE_WORKERS = 1\n"
+        "out = app.derivative_pool().submit(app.render_derivatives, buf.getvalue(), {'thumb': 32}, 80).result(timeout=60)\n"
+        "assert set(out) == {'thumb'}, out\n"
+    )
+    res = subprocess.run(
+        [sys.executable, "-c", probe],
+        cwd=Path(__file__).resolve().parents[1], env=env,
+        capture_output=True, text=True, timeout=120,
+    )
+    assert res.returncode == 0, res.stderr
+
+
+def test_token_must_match_user_in_path(client):
+    """
+    Изменение профиля по токену другого пользователя запрещено
+    """
+    u1, _ = sign_in_token(client, "one@a.com")
+    _, token2 = sign_in_token(client, "two@a.com")
+
+    res = client.post(f"/api/user/{u1}/update", json={"username": "x"}, headers={"Authorization": f"Bearer {token2}"})
+    assert res.status_code == 403
+
+
+# =========================
+# tests: bootstrap (галерея одним запросом)
+# =========================
+
+def test_bootstrap_returns_user_albums_and_projected_images(client):
+    """
+    /api/bootstrap:
+    - профиль, альбомы и изображения одним ответом
+    - fields= оставляет у изображений только нужные поля (id — всегда)
+    - limit/cursor работают как в /api/gallery
+    """
+    u, _ = sign_in_token(client, "boot@a.com")
+    client.post("/api/albums", json={"user_id": u, "title": "Trip"})
+    for i in range(3):
+        client.post(
+            "/api/upload-user",
+            data={"user_id": u, "title": f"t{i}", "file": (io.BytesIO(b"x%d" % i), "a.png", "image/png")},
+            content_type="multipart/form-data",
+        )
+
+    res = client.get(f"/api/bootstrap/{u}?fields=url,album_id")
+    assert res.status_code == 200
+    data = res.get_json()
+    assert data["user"]["email"] == "boot@a.com"
+    assert [a["title"] for a in data["albums"]] == ["Trip"]
+    assert len(data["images"]) == 3
+    assert all(set(img) == {"id", "url", "album_id"} for img in data["images"])
+
+    full = client.get(f"/api/gallery/{u}").get_json()["images"]
+    assert [img["id"] for img in data["images"]] == [img["id"] for img in full]
+
+    page = client.get(f"/api/bootstrap/{u}?fields=title&limit=2").get_json()
+    assert [img["title"] for img in page["images"]] == ["t2", "t1"]
+    rest = client.get(f"/api/gallery/{u}?fields=title&limit=2&cursor={page['next_cursor']}").get_json()
+    assert rest["images"] == [{"id": full[2]["id"], "title": "t0"}]
+    assert rest["next_cursor"] is None
+
+
+def test_bootstrap_etag_and_errors(client):
+    """
+    ETag сбрасывается при изменении любой из трёх частей; ошибки параметров — 400
+    """
+    u, _ = sign_in_token(client, "boot2@a.com")
+
+    res = client.get(f"/api/bootstrap/{u}")
+    etag = res.headers["ETag"]
+    assert client.get(f"/api/bootstrap/{u}", headers={"If-None-Match": etag}).status_code == 304
+
+    client.post("/api/albums", json={"user_id": u, "title": "New"})
+    assert client.get(f"/api/bootstrap/{u}", headers={"If-None-Match": etag}).status_code == 200
+
+    assert client.get(f"/api/bootstrap/{u}?fields=").get_json()["error"] == "bad_fields"
+    assert client.get(f"/api/bootstrap/{u}?fields=a-b").status_code == 400
+    assert client.get("/api/bootstrap/nobody").status_code == 404
+
+
+# =========================
+# tests: response cache (готовые JSON-ответы)
+# =========================
+
+def test_gallery_body_is_cached_until_user_changes(client, monkeypatch):
+    """
+    Повторный запрос галереи не собирает тело заново; загрузка
+    нового фото (смена версии пользователя) сбрасывает запись
+    """
+    app_module = client.application.config["APP_MODULE"]
+    calls = []
+    user_images = app_module.user_images
+
+    def counting_user_images(*args, **kwargs):
+        calls.append(args)
+        return user_images(*args, **kwargs)
+
+    monkeypatch.setattr(app_module, "user_images", counting_user_images)
+
+    def upload(body):
+        client.post(
+            "/api/upload-user",
+            data={"user_id": "u1", "file": (io.BytesIO(body), "a.png", "image/png")},
+            content_type="multipart/form-data",
+        )
+
+    upload(b"one")
+    first = client.get("/api/gallery/u1")
+    second = client.get("/api/gallery/u1")
+    assert first.data == second.data
+    assert len(calls) == 1
+
+    upload(b"two")
+    third = client.get("/api/gallery/u1")
+    assert len(third.get_json()["images"]) == 2
+    assert len(calls) == 2
+
+    # другой пользователь и другой query string — отдельные записи
+    client.get("/api/gallery/u2")
+    client.get("/api/gallery/u1?limit=1")
+    assert len(calls) == 4
+
+
+def test_cached_response_is_precompressed(client, monkeypatch):
+    """
+    Большое тело отдаётся в gzip по Accept-Encoding (сжатие — один раз),
+    маленькое и без Accept-Encoding — как есть
+    """
+    import gzip
+
+    app_module = client.application.config["APP_MODULE"]
+    compressed = []
+    compress = app_module.compress
+
+    def counting_compress(body, encoding):
+        compressed.append(encoding)
+        return compress(body, encoding)
+
+    monkeypatch.setattr(app_module, "compress", counting_compress)
+    monkeypatch.setattr(app_module, "HAS_BROTLI", False)
+
+    for i in range(20):
+        client.post(
+            "/api/upload-user",
+            data={"user_id": "u1", "title": f"photo {i}", "file": (io.BytesIO(b"x%d" % i), "a.png", "image/png")},
+            content_type="multipart/form-data",
+        )
+
+    plain = client.get("/api/gallery/u1")
+    assert "Content-Encoding" not in plain.headers
+
+    for _ in range(2):
+        res = client.get("/api/gallery/u1", headers={"Accept-Encoding": "gzip, br"})
+        assert res.headers["Content-Encoding"] == "gzip"
+        assert res.headers["Vary"] == "Accept-Encoding"
+        assert gzip.decompress(res.data) == plain.data
+    assert compressed == ["gzip"]
+
+    small = client.get("/api/albums/u1", headers={"Accept-Encoding": "gzip"})
+    assert "Content-Encoding" not in small.headers
+
+
+def test_response_cache_evicts_least_recently_used(client):
+    """
+    Кэш держит суммарный размер тел в пределах лимита, вытесняя давние записи
+    """
+    app_module = client.application.config["APP_MODULE"]
+    cache = app_module.ResponseCache(max_bytes=100)
+
+    cache.store("/a", "e1", "identity", b"x" * 40)
+    cache.store("/b", "e1", "identity", b"x" * 40)
+    assert cache.lookup("/a", "e1") is not None  # /a теперь свежее /b
+    cache.store("/c", "e1", "identity", b"x" * 40)
+
+    assert cache.lookup("/b", "e1") is None
+    assert cache.lookup("/a", "e1") is not None
+    assert cache.lookup("/a", "e2") is None
+    assert cache.size <= 100
+
+
+
+# =========================
+# tests: metrics (/metrics)
+# =========================
+
+def metric_value(text, line_prefix):
+    for line in text.splitlines():
+        if line.startswith(line_prefix):
+            return float(line.rsplit(" ", 1)[1])
+    return None
+
+
+def test_metrics_split_request_storage_and_s3_time(client):
+    """
+    После загрузки фото /metrics показывает:
+    - число запросов и гистограмму задержки по шаблону роута
+    - время записи images.json отдельно от вызова S3, оба с меткой роута
+    - отправленные в бакет байты, размер файла и число записей
+    """
+    body = b"metrics-image"
+    res = client.post(
+        "/api/upload-user",
+        data={"user_id": "u1", "file": (io.BytesIO(body), "a.png", "image/png")},
+        content_type="multipart/form-data",
+    )
+    assert res.status_code == 201
+    assert client.get("/api/gallery/u1").status_code == 200
+
+    res = client.get("/metrics")
+    assert res.status_code == 200
+    assert res.mimetype == "text/plain"
+    text = res.get_data(as_text=True)
+
+    route = 'route="/api/upload-user"'
+    assert metric_value(text, f'pixo_http_requests_total{{method="POST",{route},status="201"}}') == 1
+    assert metric_value(text, 'pixo_http_requests_total{method="GET",route="/api/gallery/<user_id>",status="200"}') == 1
+    assert metric_value(text, f'pixo_http_request_duration_seconds_count{{method="POST",{route}}}') == 1
+    assert metric_value(text, f'pixo_http_request_duration_seconds_bucket{{method="POST",{route},le="+Inf"}}') == 1
+
+    assert metric_value(text, f'pixo_storage_seconds_count{{file="images.json",kind="write",{route}}}') == 1
+    assert metric_value(text, f'pixo_storage_seconds_count{{file="images.json",kind="encode",{route}}}') == 1
+    assert metric_value(text, f'pixo_s3_seconds_count{{op="upload_fileobj",{route}}}') == 1
+    assert metric_value(text, f'pixo_s3_uploaded_bytes_total{{{route}}}') == len(body)
+
+    assert metric_value(text, 'pixo_table_records{table="images"}') == 1
+    assert metric_value(text, 'pixo_storage_file_bytes{file="images.json"}') > 0
+
+
+def test_metrics_count_failed_s3_calls(client, monkeypatch):
+    """
+    Ошибка бакета попадает в pixo_s3_errors_total и не теряет запрос в счётчиках
+    """
+    app_module = client.application.config["APP_MODULE"]
+
+    class BrokenS3(DummyS3):
+        def upload_fileobj(self, *args, **kwargs):
+            raise RuntimeError("bucket down")
+
+    monkeypatch.setattr(app_module, "s3", BrokenS3())
+    app_module.app.config["PROPAGATE_EXCEPTIONS"] = False
+
+    res = client.post(
+        "/api/upload-guest",
+        data={"file": (io.BytesIO(b"x"), "a.png", "image/png")},
+        content_type="multipart/form-data",
+    )
+    assert res.status_code == 500
+
+    text = client.get("/metrics").get_data(as_text=True)
+    assert metric_value(text, 'pixo_s3_errors_total{op="upload_fileobj"}') == 1
+    assert metric_value(text, 'pixo_http_requests_total{method="POST",route="/api/upload-guest",status="500"}') == 1
+
+
+# =========================
+# tests: profiling (выборочный cProfile)
+# =========================
+
+def test_profile_on_trusted_header_and_slowest_list(client, monkeypatch, tmp_path):
+    """
+    - без заголовка (и с PROFILE_SAMPLE_RATE=0) профиль не снимается
+    - с X-Pixo-Profile = ADMIN_TOKEN пишется .prof с роутом и длительностью в имени
+    - /api/system/profiles закрыт без X-Admin-Token, с ним отдаёт самые
+      медленные запросы (по убыванию) и последние профили с топом функций
+    """
+    app_module = client.application.config["APP_MODULE"]
+    monkeypatch.setattr(app_module, "ADMIN_TOKEN", "secret")
+    monkeypatch.setattr(app_module, "PROFILE_SAMPLE_RATE", 0)
+    monkeypatch.setattr(app_module, "PROFILE_DIR", str(tmp_path / "profiles"))
+
+    def upload(headers=None):
+        return client.post(
+            "/api/upload-user",
+            data={"user_id": "u1", "file": (io.BytesIO(b"img"), "a.png", "image/png")},
+            content_type="multipart/form-data",
+            headers=headers or {},
+        )
+
+    assert upload().status_code == 201
+    assert upload({"X-Pixo-Profile": "wrong"}).status_code == 201
+    assert not (tmp_path / "profiles").exists()
+
+    assert upload({"X-Pixo-Profile": "secret"}).status_code == 201
+    files = list((tmp_path / "profiles").iterdir())
+    assert len(files) == 1
+    _stamp, slug, duration, _id = files[0].name.split("-")
+    assert slug == "POST_api_upload_user"
+    assert duration.endswith("ms") and duration[:-2].isdigit()
+
+    assert client.get("/api/system/profiles").status_code == 403
+    assert client.get("/api/system/profiles", headers={"X-Admin-Token": "nope"}).status_code == 403
+    assert client.get("/api/system/profiles", headers={"X-Admin-Token": "nöpe"}).status_code == 403
+
+    data = client.get("/api/system/profiles", headers={"X-Admin-Token": "secret"}).get_json()
+    slowest = data["slowest"]
+    assert len(slowest) == 6  # три загрузки и три отклонённых запроса к /api/system/profiles
+    assert [e["ms"] for e in slowest] == sorted((e["ms"] for e in slowest), reverse=True)
+    assert {e["route"] for e in slowest} == {"/api/upload-user", "/api/system/profiles"}
+
+    (profile,) = data["profiles"]
+    assert profile["profile"] == files[0].name
+    assert profile["route"] == "/api/upload-user"
+    assert any("upload_user" in f["function"] for f in profile["top"])
+
+
+def test_slowest_list_keeps_only_slowest(client, monkeypatch):
+    """
+    Список ограничен PROFILE_SLOWEST и вытесняет самые быстрые запросы
+    """
+    app_module = client.application.config["APP_MODULE"]
+    monkeypatch.setattr(app_module, "PROFILE_SLOWEST", 3)
+
+    for ms in (5, 1, 9, 3, 7):
+        app_module.remember_request({"ms": ms})
+
+    assert sorted(e["ms"] for _ms, _seq, e in app_module._slowest) == [5, 7, 9]
+
+
+# =========================
+# tests: lazy s3 client (ленивый клиент)
+# =========================
+
+def test_s3_client_is_built_on_first_use_and_after_fork(monkeypatch):
+    """
+    - при импорте клиент не строится
+    - строится при первом обращении, дальше переиспользуется
+    - в другом процессе (после fork) строится заново
+    """
+    app_module = load_app_module()
+    assert isinstance(app_module.s3, app_module.LazyClient)
+    assert app_module.s3._client is None
+
+    built = []
+
+    def factory():
+        built.append(DummyS3())
+        return built[-1]
+
+    lazy = app_module.LazyClient(factory)
+    monkeypatch.setattr(app_module, "s3", lazy)
+    assert built == []
+
+    lazy.delete_object(Bucket="b", Key="k")
+    lazy.delete_object(Bucket="b", Key="k")
+    assert len(built) == 1
+    assert lazy.get() is built[0]
+
+    monkeypatch.setattr(app_module.os, "getpid", lambda: -1)
+    assert lazy.get() is not built[0]
+    assert len(built) == 2
+
+
+# =========================
+# tests: image proxy (/api/image/<id>/raw)
+# =========================
+
+def upload_png(client, body, user_id="u1"):
+    res = client.post(
+        "/api/upload-user",
+        data={"user_id": user_id, "file": (io.BytesIO(body), "a.png", "image/png")},
+        content_type="multipart/form-data",
+    )
+    return res.get_json()["image"]
+
+
+def test_image_proxy_caches_and_serves_ranges(client, monkeypatch):
+    """
+    - первый запрос идёт в бакет, следующие — из кэша
+    - Range (206) и If-None-Match (304) работают и на закэшированном объекте
+    - неизвестное фото / пропавший объект — 404
+    """
+    app_module = client.application.config["APP_MODULE"]
+    body = bytes(range(256)) * 4
+    img = upload_png(client, body)
+
+    fetched = []
+    get_object = app_module.s3.get_object
+
+    def counting_get_object(**kwargs):
+        fetched.append(kwargs["Key"])
+        return get_object(**kwargs)
+
+    monkeypatch.setattr(app_module.s3, "get_object", counting_get_object)
+
+    first = client.get(f"/api/image/{img['id']}/raw")
+    assert first.status_code == 200
+    assert first.data == body
+    assert first.mimetype == "image/png"
+
+    part = client.get(f"/api/image/{img['id']}/raw", headers={"Range": "bytes=256-511"})
+    assert part.status_code == 206
+    assert part.data == body[256:512]
+
+    cached = client.get(f"/api/image/{img['id']}/raw", headers={"If-None-Match": first.headers["ETag"]})
+    assert cached.status_code == 304
+    assert fetched == [img["key"]]
+
+    assert client.get("/api/image/nope/raw").status_code == 404
+    assert client.get(f"/api/image/{img['id']}/raw?variant=huge").status_code == 404
+
+    other = upload_png(client, b"second")
+    app_module.s3.delete_object(Bucket=app_module.S3_BUCKET, Key=other["key"])
+    assert client.get(f"/api/image/{other['id']}/raw").get_json()["error"] == "object_not_found"
+
+    text = client.get("/metrics").get_data(as_text=True)
+    assert 'pixo_image_cache_requests_total{result="miss"} 1' in text
+    assert 'pixo_image_cache_requests_total{result="memory"} 2' in text
+
+
+def test_object_cache_demotes_to_disk_and_stays_bounded(tmp_path):
+    """
+    Вытесненное из памяти ложится на диск, диск ограничен по байтам,
+    а новый экземпляр кэша (перезапуск) подхватывает файлы с диска
+    """
+    app_module = load_app_module()
+    cache = app_module.ObjectCache(memory_bytes=100, disk_bytes=150, directory=str(tmp_path))
+
+    def fetch(key):
+        data = key.encode() * 10
+        return {"key": key, "content_type": "image/png", "etag": key, "last_modified": 0, "size": len(data)}, data
+
+    for key in ("aaaaa", "bbbbb", "ccccc", "ddddd"):  # по 50 байт
+        cache.get(key, fetch)
+
+    assert list(cache.memory) == ["ccccc", "ddddd"]
+    assert list(cache.disk) == ["aaaaa", "bbbbb"]
+
+    (meta, data, path), source = cache.get("aaaaa", fetch)
+    assert source == "disk" and data is None
+    with open(path, "rb") as f:
+        assert f.read() == b"aaaaa" * 10
+
+    for key in ("eeeee", "fffff"):
+        cache.get(key, fetch)
+    assert cache.disk_size <= 150
+    assert "bbbbb" not in cache.disk  # самый давний на диске
+    assert len([n for n in os.listdir(tmp_path) if not n.endswith(".json")]) == len(cache.disk)
+
+    restarted = app_module.ObjectCache(memory_bytes=100, disk_bytes=150, directory=str(tmp_path))
+    assert restarted.lookup("aaaaa")[0]["etag"] == "aaaaa"
+
+
+def test_object_cache_skips_broken_meta_on_disk(tmp_path):
+    """
+    meta пишется атомарно (без временных файлов в каталоге после записи);
+    недописанная meta или meta не от этого файла — промах, а не ошибка
+    """
+    app_module = load_app_module()
+    cache = app_module.ObjectCache(memory_bytes=0, disk_bytes=1024, directory=str(tmp_path))
+
+    def fetch(key):
+        data = key.encode() * 10
+        return {"key": key, "content_type": "image/png", "etag": key, "last_modified": 0, "size": len(data)}, data
+
+    for key in ("aaaaa", "bbbbb", "ccccc"):
+        cache.get(key, fetch)
+    assert not [n for n in os.listdir(tmp_path) if n.startswith(".cache-")]
+
+    Path(cache.file_path("aaaaa") + ".json").write_text('{"key": "aaaaa", "si', encoding="utf-8")
+    Path(cache.file_path("bbbbb")).write_bytes(b"truncated")
+
+    restarted = app_module.ObjectCache(memory_bytes=0, disk_bytes=1024, directory=str(tmp_path))
+    assert restarted.lookup("aaaaa") is None
+    assert restarted.lookup("bbbbb") is None
+    assert restarted.lookup("ccccc")[0]["etag"] == "ccccc"
+
+
+def test_object_cache_coalesces_concurrent_misses(tmp_path):
+    """
+    Одновременные промахи по одному ключу — одна загрузка из бакета
+    """
+    import threading
+
+    app_module = load_app_module()
+    cache = app_module.ObjectCache(memory_bytes=1024, disk_bytes=0, directory=str(tmp_path))
+    calls = []
+    release = threading.Event()
+
+    def slow_fetch(key):
+        calls.append(key)
+        release.wait(5)
+        return {"key": key, "content_type": "image/png", "etag": "e", "last_modified": 0, "size": 3}, b"abc"
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get("k", slow_fetch))) for _ in range(8)]
+    for t in threads:
+        t.start()
+    while not calls:
+        time.sleep(0.01)
+    time.sleep(0.05)
+    release.set()
+    for t in threads:
+        t.join(5)
+
+    assert calls == ["k"]
+    assert len(results) == 8
+    assert all(r[0][1] == b"abc" for r in results)
+    assert sorted(source for _, source in results).count("miss") == 1
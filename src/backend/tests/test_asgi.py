@@ -0,0 +1,432 @@
+# backend/tests/test_asgi.py
+
+import asyncio
+import importlib.util
+import io
+from pathlib import Path
+
+import pytest
+from werkzeug.test import EnvironBuilder
+
+from test_app import load_app_module
+
+
+# =========================
+# helpers (вспомогательные функции)
+# =========================
+
+BACKEND_DIR = Path(__file__).resolve().parents[1]
+
+
+def load_asgi_module(monkeypatch):
+    """
+    Загружает backend/asgi.py (он импортирует app.py — нужен путь к backend)
+    """
+    monkeypatch.syspath_prepend(str(BACKEND_DIR))
+    spec = importlib.util.spec_from_file_location("pixo_asgi", BACKEND_DIR / "asgi.py")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def scope(method, path, query=b"", headers=()):
+    return {
+        "type": "http",
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "http",
+        "path": path,
+        "query_string": query,
+        "root_path": "",
+        "headers": [(k.lower().encode(), v.encode()) for k, v in headers],
+        "server": ("testserver", 80),
+        "client": ("127.0.0.1", 12345),
+    }
+
+
+async def call(asgi_app, method, path, body=b"", query=b"", headers=(), chunk=64 * 1024):
+    """
+    Один запрос к ASGI-приложению: тело уходит кусками по chunk.
+    Возвращает (статус, заголовки, тело).
+    """
+    messages = [
+        {"type": "http.request", "body": body[i:i + chunk], "more_body": i + chunk < len(body)}
+        for i in range(0, max(len(body), 1), chunk)
+    ]
+    sent = []
+
+    async def receive():
+        if messages:
+            return messages.pop(0)
+        await asyncio.sleep(3600)  # клиент больше ничего не шлёт
+
+    async def send(message):
+        sent.append(message)
+
+    await asgi_app(scope(method, path, query, headers), receive, send)
+    start = sent[0]
+    headers = {}
+    for k, v in start["headers"]:
+        headers.setdefault(k.decode(), []).append(v.decode())
+    return start["status"], headers, b"".join(m.get("body", b"") for m in sent[1:])
+
+
+def multipart(fields):
+    """
+    Тело multipart/form-data и его заголовки (собирает Werkzeug, как test_client)
+    """
+    environ = EnvironBuilder(method="POST", data=fields).get_environ()
+    body = environ["wsgi.input"].read()
+    return body, [("Content-Type", environ["CONTENT_TYPE"]), ("Content-Length", str(len(body)))]
+
+
+@pytest.fixture()
+def asgi(tmp_path, monkeypatch):
+    """
+    PixoAsgi поверх app.py с временными файлами и LocalObjectStore
+    """
+    app_module = load_app_module()
+    for name, file in [("USERS_FILE", "users.json"), ("IMAGES_FILE", "images.json"),
+                       ("ALBUMS_FILE", "albums.json"), ("GUEST_FILE", "guest_uploads.json"),
+                       ("BLOBS_FILE", "blobs.json")]:
+        monkeypatch.setattr(app_module, name, str(tmp_path / file))
+    monkeypatch.setattr(app_module, "s3", app_module.LocalObjectStore(str(tmp_path / "objects")))
+    monkeypatch.setattr(app_module, "DERIVATIVE_WORKERS", 0)
+    monkeypatch.setattr(app_module, "HAS_PILLOW", False)  # превью здесь не проверяем
+    monkeypatch.setattr(app_module, "image_cache", app_module.ObjectCache(1 << 20, 1 << 20, str(tmp_path / "cache")))
+    app_module.app.config["TESTING"] = True
+
+    asgi_module = load_asgi_module(monkeypatch)
+    return asgi_module, asgi_module.PixoAsgi(app_module), app_module
+
+
+# =========================
+# tests: ASGI-вариант
+# =========================
+
+def test_asgi_upload_and_gallery_match_flask_contract(asgi, tmp_path):
+    """
+    - upload-user (корутина) отвечает тем же JSON, что и Flask, объект в хранилище
+    - повторная загрузка того же содержимого ссылается на тот же объект
+    - gallery и /objects (Range через send_file) идут через Flask как есть
+    """
+    _asgi_module, asgi_app, app_module = asgi
+    png = b"\x89PNG" + b"x" * 300_000  # больше ASGI_SPOOL_MEMORY — тело уходит во временный файл
+
+    async def scenario():
+        body, headers = multipart({"user_id": "u1", "title": "t", "file": (io.BytesIO(png), "a.png", "image/png")})
+        first = await call(asgi_app, "POST", "/api/upload-user", body, headers=headers)
+        body, headers = multipart({"user_id": "u1", "file": (io.BytesIO(png), "b.png", "image/png")})
+        second = await call(asgi_app, "POST", "/api/upload-user", body, headers=headers)
+        gallery = await call(asgi_app, "GET", "/api/gallery/u1")
+        return first, second, gallery
+
+    first, second, gallery = asyncio.run(scenario())
+    status, _headers, body = first
+    assert status == 201
+    image = app_module.json.loads(body)["image"]
+    assert image["title"] == "t" and image["user_id"] == "u1"
+    assert (tmp_path / "objects" / image["key"]).read_bytes() == png
+
+    status, _headers, body = second
+    assert status == 201
+    assert app_module.json.loads(body)["image"]["key"] == image["key"]
+
+    status, _headers, body = gallery
+    assert status == 200
+    assert {img["key"] for img in app_module.json.loads(body)["images"]} == {image["key"]}
+
+    status, headers, body = asyncio.run(call(
+        asgi_app, "GET", f"/objects/{image['key']}", headers=[("Range", "bytes=0-3")]
+    ))
+    assert status == 206
+    assert body == b"\x89PNG"
+    assert headers["content-type"] == ["image/png"]
+
+
+def test_asgi_stream_upload_limits_and_errors(asgi, tmp_path, monkeypatch):
+    """
+    - потоковая загрузка без Content-Length: тело идёт в хранилище кусками
+    - больше MAX_SIZE_BYTES — file_too_large, недописанный объект не остаётся
+    - ошибки проверок — те же коды и JSON, что у Flask
+    """
+    _asgi_module, asgi_app, app_module = asgi
+    monkeypatch.setattr(app_module, "MAX_SIZE_BYTES", 100_000)
+    headers = [("Content-Type", "image/png")]
+
+    status, _h, body = asyncio.run(call(
+        asgi_app, "PUT", "/api/upload-user/stream", b"p" * 90_000, b"user_id=u1&filename=a.png", headers, chunk=10_000
+    ))
+    assert status == 201
+    key = app_module.json.loads(body)["image"]["key"]
+    assert (tmp_path / "objects" / key).stat().st_size == 90_000
+
+    status, _h, body = asyncio.run(call(
+        asgi_app, "PUT", "/api/upload-user/stream", b"p" * 150_000, b"user_id=u1&filename=b.png", headers, chunk=10_000
+    ))
+    assert status == 400
+    assert app_module.json.loads(body) == {"error": "file_too_large"}
+    objects = [p for p in (tmp_path / "objects" / "user" / "u1").iterdir()]
+    assert [p.name for p in objects] == [Path(key).name]
+
+    status, _h, body = asyncio.run(call(asgi_app, "PUT", "/api/upload-user/stream", b"p", b"filename=a.png", headers))
+    assert (status, app_module.json.loads(body)) == (400, {"error": "user_id_missing"})
+
+    status, _h, body = asyncio.run(call(
+        asgi_app, "PUT", "/api/upload-user/stream", b"p", b"user_id=u1&filename=a.txt", [("Content-Type", "text/plain")]
+    ))
+    assert (status, app_module.json.loads(body)) == (400, {"error": "only_images_allowed"})
+
+
+def test_asgi_guest_upload_replaces_previous_object(asgi, tmp_path):
+    """
+    Второе фото гостя (та же cookie) удаляет из хранилища первое
+    """
+    _asgi_module, asgi_app, app_module = asgi
+
+    body, headers = multipart({"file": (io.BytesIO(b"one"), "a.png", "image/png")})
+    status, resp_headers, resp = asyncio.run(call(asgi_app, "POST", "/api/upload-guest", body, headers=headers))
+    assert status == 201
+    first = app_module.json.loads(resp)
+    assert any(c.startswith(f"guest_id={first['guest_id']}") for c in resp_headers["set-cookie"])
+
+    status, _h, resp = asyncio.run(call(
+        asgi_app, "PUT", "/api/upload-guest/stream", b"two", b"filename=b.png",
+        [("Content-Type", "image/png"), ("Cookie", f"guest_id={first['guest_id']}")]
+    ))
+    assert status == 201
+    second = app_module.json.loads(resp)
+    assert second["guest_id"] == first["guest_id"]
+    assert not (tmp_path / "objects" / first["key"]).exists()
+    assert (tmp_path / "objects" / second["key"]).read_bytes() == b"two"
+
+
+def test_asgi_batch_confirm_and_raw_match_flask_contract(asgi, tmp_path):
+    """
+    Корутины вместо Flask-роутов, ответы те же:
+    - /batch: результаты по файлам в порядке формы, объекты в хранилище
+    - /confirm пользователя и гостя: HEAD через асинхронное хранилище,
+      гостю нужен ticket и его cookie
+    - /raw: объект (и Range) через кэш
+    """
+    _asgi_module, asgi_app, app_module = asgi
+    client = app_module.app.test_client()
+
+    body, headers = multipart({"user_id": "u1", "files": [
+        (io.BytesIO(b"one"), "a.png", "image/png"),
+        (io.BytesIO(b"text"), "b.txt", "text/plain"),
+        (io.BytesIO(b"two"), "c.png", "image/png"),
+    ]})
+    status, _h, resp = asyncio.run(call(asgi_app, "POST", "/api/upload-user/batch", body, headers=headers))
+    assert status == 201
+    results = app_module.json.loads(resp)["results"]
+    assert [r.get("error") for r in results] == [None, "only_images_allowed", None]
+    assert (tmp_path / "objects" / results[2]["image"]["key"]).read_bytes() == b"two"
+
+    ticket = client.post(
+        "/api/upload-user/presign", json={"user_id": "u1", "filename": "d.png", "content_type": "image/png"}
+    ).get_json()
+    fields = ticket["upload"]["fields"]
+    assert client.post("/objects", data={**fields, "file": (io.BytesIO(b"direct"), "d.png", "image/png")},
+                       content_type="multipart/form-data").status_code == 204
+    confirm = app_module.json.dumps({"user_id": "u1", "image_id": ticket["image_id"], "key": ticket["key"]}).encode()
+    json_headers = [("Content-Type", "application/json")]
+    status, _h, resp = asyncio.run(call(asgi_app, "POST", "/api/upload-user/confirm", confirm, headers=json_headers))
+    assert status == 201
+    image = app_module.json.loads(resp)["image"]
+    assert image["key"] == ticket["key"]
+
+    missing = app_module.json.dumps({"user_id": "u1", "image_id": "x", "key": "user/u1/x.png"}).encode()
+    status, _h, resp = asyncio.run(call(asgi_app, "POST", "/api/upload-user/confirm", missing, headers=json_headers))
+    assert (status, app_module.json.loads(resp)) == (400, {"error": "upload_not_found"})
+
+    res = client.post("/api/upload-guest/presign", json={"filename": "g.png", "content_type": "image/png"})
+    guest_id = res.headers["Set-Cookie"].split(";", 1)[0].split("=", 1)[1]
+    ticket = res.get_json()
+    client.post("/objects", data={**ticket["upload"]["fields"], "file": (io.BytesIO(b"guest"), "g.png", "image/png")},
+                content_type="multipart/form-data")
+    confirm = app_module.json.dumps({"key": ticket["key"], "ticket": ticket["ticket"]}).encode()
+    status, _h, resp = asyncio.run(call(
+        asgi_app, "POST", "/api/upload-guest/confirm", confirm, headers=json_headers + [("Cookie", "guest_id=other")]
+    ))
+    assert (status, app_module.json.loads(resp)) == (400, {"error": "bad_key"})
+    status, _h, resp = asyncio.run(call(
+        asgi_app, "POST", "/api/upload-guest/confirm", confirm, headers=json_headers + [("Cookie", f"guest_id={guest_id}")]
+    ))
+    assert status == 201
+    assert app_module.find_guest(guest_id)["key"] == ticket["key"]
+
+    status, headers, resp = asyncio.run(call(asgi_app, "GET", f"/api/image/{image['id']}/raw"))
+    assert (status, resp) == (200, b"direct")
+    assert headers["content-type"] == ["image/png"]
+    status, _h, resp = asyncio.run(call(
+        asgi_app, "GET", f"/api/image/{image['id']}/raw", headers=[("Range", "bytes=1-3")]
+    ))
+    assert (status, resp) == (206, b"ire")
+    status, _h, _b = asyncio.run(call(asgi_app, "GET", "/api/image/nope/raw"))
+    assert status == 404
+
+
+def test_asgi_async_mode_upload_runs_as_task(asgi, tmp_path, monkeypatch):
+    """
+    PIXO_UPLOAD_MODE=async: 202 сразу, загрузка — asyncio-задача,
+    статус — в том же файле задачи, что читает /api/upload-status
+    """
+    _asgi_module, asgi_app, app_module = asgi
+    monkeypatch.setattr(app_module, "UPLOAD_MODE", "async")
+    monkeypatch.setattr(app_module, "UPLOAD_SPOOL_DIR", str(tmp_path / "spool"))
+
+    async def scenario():
+        body, headers = multipart({"user_id": "u1", "file": (io.BytesIO(b"later"), "a.png", "image/png")})
+        accepted = await call(asgi_app, "POST", "/api/upload-user", body, headers=headers)
+        await asyncio.wait(asgi_app.jobs)
+        job = app_module.json.loads(accepted[2])["job"]
+        return accepted[0], await call(asgi_app, "GET", f"/api/upload-status/{job['id']}")
+
+    status, (_s, _h, resp) = asyncio.run(scenario())
+    assert status == 202
+    job = app_module.json.loads(resp)["job"]
+    assert job["status"] == "done"
+    assert (tmp_path / "objects" / job["image"]["key"]).read_bytes() == b"later"
+
+
+def test_object_stores_stream_the_body(asgi, monkeypatch):
+    """
+    Тело не собирается в памяти целиком:
+    - ThreadedObjectStore: boto3 читает его кусками, пока оно ещё приходит
+    - AsyncS3Store: части multipart по ASGI_S3_PART_SIZE, меньшее тело — одним PUT
+    """
+    asgi_module, asgi_app, app_module = asgi
+    monkeypatch.setattr(app_module, "transfer_config", lambda: None)
+    produced = []
+
+    async def chunks(count, size=10_000):
+        for i in range(count):
+            produced.append(i)
+            yield bytes([i]) * size
+
+    class BotoClient:
+        reads = []
+
+        def upload_fileobj(self, fileobj, Bucket, Key, ExtraArgs=None, Config=None):
+            while True:
+                data = fileobj.read(25_000)
+                if not data:
+                    return
+                self.reads.append((len(data), len(produced)))
+
+    async def threaded():
+        store = asgi_module.ThreadedObjectStore(app_module, BotoClient(), asgi_app.run_s3)
+        await store.upload("k", chunks(10), "image/png")
+
+    asyncio.run(threaded())
+    assert [n for n, _ in BotoClient.reads] == [25_000] * 4
+    assert BotoClient.reads[0][1] < 10
+
+    class AioClient:
+        def __init__(self):
+            self.calls = []
+
+        async def create_multipart_upload(self, **kwargs):
+            self.calls.append(("create", None))
+            return {"UploadId": "up"}
+
+        async def upload_part(self, Body, PartNumber, **kwargs):
+            self.calls.append(("part", len(Body)))
+            return {"ETag": f"e{PartNumber}"}
+
+        async def complete_multipart_upload(self, MultipartUpload, **kwargs):
+            self.calls.append(("complete", [p["ETag"] for p in MultipartUpload["Parts"]]))
+
+        async def put_object(self, Body, **kwargs):
+            self.calls.append(("put", len(Body)))
+
+    monkeypatch.setattr(asgi_module, "ASGI_S3_PART_SIZE", 30_000)
+
+    async def multipart_upload(count):
+        store = asgi_module.AsyncS3Store(app_module)
+        store.client = AioClient()
+        await store.upload("k", chunks(count), "image/png")
+        return store.client.calls
+
+    assert asyncio.run(multipart_upload(7)) == [
+        ("create", None), ("part", 30_000), ("part", 30_000), ("part", 10_000), ("complete", ["e1", "e2", "e3"])
+    ]
+    assert asyncio.run(multipart_upload(2)) == [("put", 20_000)]
+
+
+def test_slow_bucket_does_not_hold_threads(asgi, monkeypatch):
+    """
+    Сотня загрузок, пакет, confirm (HEAD) и /raw (get_object) ждут
+    медленный бакет, а пул роутов из двух потоков свободен: /api/gallery
+    отвечает, пока ни один вызов бакета не закончился
+    """
+    asgi_module, asgi_app, app_module = asgi
+    monkeypatch.setattr(asgi_app, "views", asgi_module.ThreadPoolExecutor(2))
+    uploads = 100
+    client = app_module.app.test_client()
+
+    image = client.post(
+        "/api/upload-user", data={"user_id": "u2", "file": (io.BytesIO(b"raw"), "r.png", "image/png")},
+        content_type="multipart/form-data",
+    ).get_json()["image"]
+    ticket = client.post(
+        "/api/upload-user/presign", json={"user_id": "u2", "filename": "d.png", "content_type": "image/png"}
+    ).get_json()
+    client.post("/objects", data={**ticket["upload"]["fields"], "file": (io.BytesIO(b"d"), "d.png", "image/png")},
+                content_type="multipart/form-data")
+    confirm = app_module.json.dumps({"user_id": "u2", "image_id": ticket["image_id"], "key": ticket["key"]}).encode()
+    batch, batch_headers = multipart({"user_id": "u2", "files": [(io.BytesIO(b"b"), "b.png", "image/png")]})
+
+    async def scenario():
+        release = asyncio.Event()
+        waiting = []
+        store = asgi_app.object_store()
+
+        class SlowStore:
+            async def upload(self, key, chunks, content_type):
+                waiting.append(key)
+                await release.wait()
+                await store.upload(key, chunks, content_type)
+
+            async def delete(self, key):
+                await store.delete(key)
+
+            async def head(self, key):
+                waiting.append(key)
+                await release.wait()
+                return await store.head(key)
+
+            async def get(self, key):
+                waiting.append(key)
+                await release.wait()
+                return await store.get(key)
+
+        monkeypatch.setattr(asgi_app, "object_store", SlowStore)
+
+        tasks = [
+            asyncio.create_task(call(
+                asgi_app, "PUT", "/api/upload-user/stream", f"img-{i}".encode(),
+                f"user_id=u1&filename={i}.png".encode(), [("Content-Type", "image/png")]
+            ))
+            for i in range(uploads)
+        ] + [
+            asyncio.create_task(call(asgi_app, "POST", "/api/upload-user/batch", batch, headers=batch_headers)),
+            asyncio.create_task(call(
+                asgi_app, "POST", "/api/upload-user/confirm", confirm, headers=[("Content-Type", "application/json")]
+            )),
+            asyncio.create_task(call(asgi_app, "GET", f"/api/image/{image['id']}/raw")),
+        ]
+        while len(waiting) < len(tasks):
+            await asyncio.sleep(0.01)
+
+        gallery = await asyncio.wait_for(call(asgi_app, "GET", "/api/gallery/u1"), timeout=5)
+        release.set()
+        return gallery, await asyncio.gather(*tasks)
+
+    gallery, results = asyncio.run(scenario())
+    assert gallery[0] == 200
+    assert app_module.json.loads(gallery[2])["images"] == []
+    assert [status for status, _h, _b in results] == [201] * (uploads + 2) + [200]
+    assert results[-1][2] == b"raw"
+    assert len([img for img in app_module.load_images() if img["user_id"] == "u1"]) == uploads
@@ -0,0 +1,81 @@
+# backend/tests/test_bench.py
+
+import importlib.util
+import json
+from pathlib import Path
+
+import pytest
+
+
+def load_bench_module():
+    """
+    Загружает benchmarks/bench_api.py как модуль (как app.py в test_app.py)
+    """
+    path = Path(__file__).resolve().parents[1] / "benchmarks" / "bench_api.py"
+    spec = importlib.util.spec_from_file_location("bench_api", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+# =========================
+# tests: benchmark harness (нагрузочный прогон)
+# =========================
+
+def test_benchmark_covers_every_route_and_writes_report(tmp_path):
+    """
+    Маленький прогон:
+    - у каждого роута app.py есть сценарий (новый роут без сценария — ошибка)
+    - сценарии попадают в успешную ветку, а не в 4xx/5xx
+    - отчёт пишется в JSON и сравнивается сам с собой без регрессий
+    """
+    pytest.importorskip("faker")
+    bench = load_bench_module()
+    out = tmp_path / "report.json"
+
+    assert bench.main(["--scales", "200", "--requests", "2", "--warmup", "0", "--out", str(out)]) == 0
+
+    report = json.loads(out.read_text(encoding="utf-8"))
+    scale = report["scales"]["200"]
+    assert scale["images"] == 200
+    assert scale["uncovered_routes"] == []
+    assert set(scale["endpoints"]) == set(bench.SCENARIOS)
+
+    for name, result in scale["endpoints"].items():
+        assert result["p50_ms"] <= result["p95_ms"] <= result["p99_ms"]
+        if "upload-status" not in name:  # статус несуществующей задачи — 404
+            assert all(code < "400" for code in result["statuses"]), name
+
+    lines, regressed = bench.compare(report, report, threshold=0.2)
+    assert len(lines) == len(bench.SCENARIOS) and not regressed
+
+
+def test_percentile_nearest_rank():
+    bench = load_bench_module()
+    values = list(range(1, 101))
+    assert bench.percentile(values, 50) == 50
+    assert bench.percentile(values, 95) == 95
+    assert bench.percentile(values, 99) == 99
+    assert bench.percentile([7], 99) == 7
+
+
+def load_import_bench_module():
+    path = Path(__file__).resolve().parents[1] / "benchmarks" / "bench_import.py"
+    spec = importlib.util.spec_from_file_location("bench_import", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def test_import_does_not_load_heavy_modules():
+    """
+    Свежий `import app` не тянет boto3, Pillow, sqlite3 и прочие модули из
+    FORBIDDEN_MODULES, замер времени и вклад модулей попадают в отчёт
+    """
+    bench = load_import_bench_module()
+    report = bench.measure(runs=1)
+
+    assert "sqlite3" in bench.FORBIDDEN_MODULES
+    assert report["forbidden_loaded"] == []
+    assert report["import_ms"]["p50"] > 0
+    assert "flask" in report["top_modules_ms"]
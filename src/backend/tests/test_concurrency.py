@@ -0,0 +1,149 @@
+# backend/tests/test_concurrency.py
+
+import io
+import multiprocessing
+from pathlib import Path
+
+import pytest
+
+from test_app import load_app_module, DummyS3, read_json
+
+
+# =========================
+# helpers (вспомогательные функции)
+# =========================
+
+WORKERS = 6
+UPLOADS_PER_WORKER = 25
+
+# воркеры gunicorn — это fork одного процесса, здесь так же
+mp = multiprocessing.get_context("fork")
+
+
+def make_app(tmp_path, storage_mode):
+    """
+    Загружает app.py с временными файлами хранилища и DummyS3
+    """
+    app_module = load_app_module()
+    app_module.USERS_FILE = str(tmp_path / "users.json")
+    app_module.IMAGES_FILE = str(tmp_path / "images.json")
+    app_module.ALBUMS_FILE = str(tmp_path / "albums.json")
+    app_module.GUEST_FILE = str(tmp_path / "guest_uploads.json")
+    app_module.BLOBS_FILE = str(tmp_path / "blobs.json")
+    app_module.STORAGE_MODE = storage_mode
+    app_module.s3 = DummyS3()
+    app_module.DERIVATIVE_WORKERS = 0  # без пула процессов внутри fork-воркеров
+    app_module.app.config["TESTING"] = True
+    return app_module
+
+
+def upload_worker(app_module, user_id, worker_no, errors):
+    """
+    Один «воркер»: много загрузок подряд + чтение галереи между ними
+    """
+    try:
+        with app_module.app.test_client() as c:
+            for i in range(UPLOADS_PER_WORKER):
+                res = c.post(
+                    "/api/upload-user",
+                    data={
+                        "user_id": user_id,
+                        "title": f"{worker_no}-{i}",
+                        "file": (io.BytesIO(b"img"), "a.png", "image/png"),
+                    },
+                    content_type="multipart/form-data",
+                )
+                if res.status_code != 201:
+                    errors.put(f"upload {worker_no}-{i}: {res.status_code}")
+                if c.get(f"/api/gallery/{user_id}").status_code != 200:
+                    errors.put(f"gallery {worker_no}-{i}")
+    except Exception as e:  # noqa: BLE001 — отдаём любую ошибку в родителя
+        errors.put(repr(e))
+
+
+def sign_up_worker(app_module, results):
+    with app_module.app.test_client() as c:
+        res = c.post("/api/sign-up", json={"email": "race@a.com", "password": "1"})
+        results.put(res.status_code)
+
+
+def run_workers(target, args_for):
+    procs = [mp.Process(target=target, args=args_for(n)) for n in range(WORKERS)]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join(timeout=60)
+        assert p.exitcode == 0
+
+
+def drain(queue):
+    items = []
+    while not queue.empty():
+        items.append(queue.get())
+    return items
+
+
+# =========================
+# tests: параллельная запись несколькими процессами
+# =========================
+
+@pytest.mark.parametrize("storage_mode", ["json", "wal"])
+def test_parallel_uploads_lose_nothing(tmp_path, storage_mode):
+    """
+    Несколько процессов одновременно загружают фото:
+    - ни одна запись не теряется
+    - файл на диске остаётся корректным JSON
+    """
+    app_module = make_app(tmp_path, storage_mode)
+    errors = mp.Queue()
+
+    run_workers(upload_worker, lambda n: (app_module, "u1", n, errors))
+    assert drain(errors) == []
+
+    if storage_mode == "wal":
+        app_module.compact_wal("images")
+
+    images = read_json(Path(app_module.IMAGES_FILE), [])
+    titles = sorted(img["title"] for img in images)
+    expected = sorted(f"{w}-{i}" for w in range(WORKERS) for i in range(UPLOADS_PER_WORKER))
+    assert titles == expected
+
+    # все загрузки одинаковые: один объект, ни одна ссылка не потеряна
+    if storage_mode == "wal":
+        app_module.compact_wal("blobs")
+    blobs = read_json(Path(app_module.BLOBS_FILE), {})
+    assert [blob["refs"] for blob in blobs.values()] == [WORKERS * UPLOADS_PER_WORKER]
+
+    # временные файлы за собой не оставляем
+    assert not list(tmp_path.glob("*.tmp"))
+
+
+@pytest.mark.parametrize("storage_mode", ["json", "wal"])
+def test_parallel_sign_up_same_email(tmp_path, storage_mode):
+    """
+    Одновременная регистрация одного email из разных процессов — ровно один успех
+    """
+    app_module = make_app(tmp_path, storage_mode)
+    results = mp.Queue()
+
+    run_workers(sign_up_worker, lambda n: (app_module, results))
+
+    codes = sorted(drain(results))
+    assert codes == [201] + [400] * (WORKERS - 1)
+    assert len(app_module.load_users()) == 1
+
+
+def test_corrupted_file_is_not_treated_as_empty(tmp_path):
+    """
+    Битый images.json не превращается молча в пустой список
+    (иначе следующая загрузка затёрла бы все записи)
+    """
+    app_module = make_app(tmp_path, "json")
+    images_path = Path(app_module.IMAGES_FILE)
+    images_path.write_text('[{"id": "img1"', encoding="utf-8")
+
+    with pytest.raises(app_module.StorageError):
+        app_module.load_images()
+
+    # файл не тронут, ничего не перезаписано
+    assert images_path.read_text(encoding="utf-8") == '[{"id": "img1"'
@@ -0,0 +1,62 @@
+# backend/tests/test_seed_data.py
+
+import importlib.util
+import json
+import sys
+from pathlib import Path
+
+
+def load_seed_module():
+    """
+    Загружает generator_run/seed_data.py как модуль
+    """
+    path = Path(__file__).resolve().parents[1] / "generator_run" / "seed_data.py"
+    spec = importlib.util.spec_from_file_location("seed_data", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+# =========================
+# tests: seed generator (генератор данных)
+# =========================
+
+def test_seed_generation_is_reproducible_across_workers(tmp_path, monkeypatch):
+    """
+    Один --seed даёт побайтово одинаковые файлы при любом числе процессов,
+    файлы — валидный JSON, email уникальны, «тяжёлые» пользователи получают больше фото
+    """
+    seed_data = load_seed_module()
+    # пул процессов ищет функции блоков по имени модуля
+    monkeypatch.setitem(sys.modules, "seed_data", seed_data)
+    monkeypatch.setattr(seed_data, "BLOCK_USERS", 7)
+    monkeypatch.setattr(seed_data, "BLOCK_GUESTS", 3)
+
+    args = dict(
+        users_count=30,
+        images_per_user=(2, 2),
+        guest_uploads_count=8,
+        seed=42,
+        heavy_users=0.2,
+        heavy_factor=10,
+    )
+    counts = seed_data.generate(workers=1, out_dir=tmp_path / "a", **args)
+    seed_data.generate(workers=3, out_dir=tmp_path / "b", **args)
+
+    for name in ("users.json", "albums.json", "images.json", "guest_uploads.json"):
+        assert (tmp_path / "a" / name).read_bytes() == (tmp_path / "b" / name).read_bytes()
+
+    users = json.loads((tmp_path / "a" / "users.json").read_text(encoding="utf-8"))
+    images = json.loads((tmp_path / "a" / "images.json").read_text(encoding="utf-8"))
+    guests = json.loads((tmp_path / "a" / "guest_uploads.json").read_text(encoding="utf-8"))
+
+    assert len(users) == counts["users"] == 30
+    assert len({u["email"] for u in users}) == 30
+    assert len(guests) == counts["guests"] == 8
+    assert len(images) == counts["images"]
+
+    per_user = {}
+    for img in images:
+        per_user[img["user_id"]] = per_user.get(img["user_id"], 0) + 1
+    assert set(per_user.values()) <= {2, 20}
+    assert 20 in per_user.values()
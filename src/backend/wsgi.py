@@ -0,0 +1,5 @@
+"""WSGI-точка входа: gunicorn wsgi:app --workers 4"""
+
+from app import app, init_serving
+
+init_serving()
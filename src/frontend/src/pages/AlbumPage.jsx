@@ -112,7 +112,7 @@ function AlbumPage({ user, onLogout }) {
                 >
                   <img
                     className="photo-thumb"
-                    src={img.url}
+                    src={img.thumb_url || img.url}
                     alt={img.title || t("common.photo")}
                     loading="lazy"
                   />
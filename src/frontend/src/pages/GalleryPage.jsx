@@ -22,26 +22,26 @@ function GalleryPage({ user, onLogout }) {
   const location = useLocation();
   const navigate = useNavigate();
 
+  // фото и альбомы одним запросом; у фото — только поля, нужные сетке
   useEffect(() => {
     if (!user?.id) return;
 
     setLoading(true);
-    fetch(`http://localhost:5000/api/gallery/${user.id}`)
+    fetch(
+      `http://localhost:5000/api/bootstrap/${user.id}?fields=title,album_id,url,thumb_url`
+    )
       .then((r) => r.json())
-      .then((data) => setImages(Array.isArray(data.images) ? data.images : []))
-      .catch(() => setImages([]))
+      .then((data) => {
+        setImages(Array.isArray(data.images) ? data.images : []);
+        setAlbums(Array.isArray(data.albums) ? data.albums : []);
+      })
+      .catch(() => {
+        setImages([]);
+        setAlbums([]);
+      })
       .finally(() => setLoading(false));
   }, [user?.id]);
 
-  useEffect(() => {
-    if (!user?.id) return;
-
-    fetch(`http://localhost:5000/api/albums/${user.id}`)
-      .then((r) => r.json())
-      .then((data) => setAlbums(Array.isArray(data.albums) ? data.albums : []))
-      .catch(() => setAlbums([]));
-  }, [user?.id]);
-
   useEffect(() => {
     const highlightId = location.state?.highlightId;
     if (highlightId) setSelectedId(highlightId);
@@ -91,8 +91,11 @@ function GalleryPage({ user, onLogout }) {
 
     const res = await fetch("http://localhost:5000/api/albums", {
       method: "POST",
-      headers: { "Content-Type": "application/json" },
-      body: JSON.stringify({ user_id: user.id, title: title.trim() }),
+      headers: {
+        "Content-Type": "application/json",
+        Authorization: `Bearer ${user.token}`,
+      },
+      body: JSON.stringify({ title: title.trim() }),
     });
 
     const data = await res.json().catch(() => ({}));
@@ -130,8 +133,11 @@ function GalleryPage({ user, onLogout }) {
       `http://localhost:5000/api/image/${selectedId}/set-album`,
       {
         method: "POST",
-        headers: { "Content-Type": "application/json" },
-        body: JSON.stringify({ user_id: user.id, album_id: selectedAlbumId }),
+        headers: {
+          "Content-Type": "application/json",
+          Authorization: `Bearer ${user.token}`,
+        },
+        body: JSON.stringify({ album_id: selectedAlbumId }),
       }
     );
 
@@ -275,7 +281,7 @@ function GalleryPage({ user, onLogout }) {
                   >
                     <img
                       className="photo-thumb"
-                      src={item.url}
+                      src={item.thumb_url || item.url}
                       alt={item.title || t("common.photo")}
                       loading="lazy"
                     />
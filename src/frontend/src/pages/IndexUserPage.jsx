@@ -15,9 +15,9 @@ function IndexUserPage({ user, onLogout }) {
   };
 
   const onFileSelected = async (e) => {
-    const file = e.target.files?.[0];
+    const files = Array.from(e.target.files || []);
     e.target.value = "";
-    if (!file) return;
+    if (!files.length) return;
 
     if (!user?.id) {
       alert(t("common.noUserId"));
@@ -28,23 +28,41 @@ function IndexUserPage({ user, onLogout }) {
 
     try {
       const fd = new FormData();
-      fd.append("file", file);
-      fd.append("title", file.name);
-      fd.append("user_id", user.id);
 
-      const res = await fetch("http://localhost:5000/api/upload-user", {
-        method: "POST",
-        body: fd,
-      });
+      // несколько файлов — одним запросом в /api/upload-user/batch
+      const batch = files.length > 1;
+      if (batch) {
+        files.forEach((file) => fd.append("files", file));
+      } else {
+        fd.append("file", files[0]);
+        fd.append("title", files[0].name);
+      }
+
+      const res = await fetch(
+        `http://localhost:5000/api/upload-user${batch ? "/batch" : ""}`,
+        {
+          method: "POST",
+          headers: { Authorization: `Bearer ${user.token}` },
+          body: fd,
+        }
+      );
 
       const data = await res.json().catch(() => ({}));
 
       if (!res.ok) {
-        alert(data.error || t("common.uploadError"));
+        const firstError = data?.results?.find((r) => r.error)?.error;
+        alert(data.error || firstError || t("common.uploadError"));
         return;
       }
 
-      const imageId = data?.image?.id;
+      const failed = (data?.results || []).filter((r) => r.error);
+      if (failed.length) {
+        alert(failed.map((r) => `${r.filename}: ${r.error}`).join("\n"));
+      }
+
+      const imageId = batch
+        ? data.results.find((r) => r.image)?.image.id
+        : data?.image?.id;
       navigate("/gallery", { state: { highlightId: imageId } });
     } catch {
       alert(t("common.connectError"));
@@ -78,6 +96,7 @@ function IndexUserPage({ user, onLogout }) {
           ref={inputRef}
           type="file"
           accept="image/*"
+          multiple
           style={{ display: "none" }}
           onChange={onFileSelected}
         />
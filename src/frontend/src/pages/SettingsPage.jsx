@@ -44,7 +44,10 @@ function SettingsPage({ user, onLogout, onUserUpdate }) {
 
     const res = await fetch(`http://localhost:5000/api/user/${user.id}/update`, {
       method: "POST",
-      headers: { "Content-Type": "application/json" },
+      headers: {
+        "Content-Type": "application/json",
+        Authorization: `Bearer ${user.token}`,
+      },
       body: JSON.stringify({ email, username, lang }),
     });
 
@@ -70,7 +73,10 @@ function SettingsPage({ user, onLogout, onUserUpdate }) {
       `http://localhost:5000/api/user/${user.id}/change-password`,
       {
         method: "POST",
-        headers: { "Content-Type": "application/json" },
+        headers: {
+          "Content-Type": "application/json",
+          Authorization: `Bearer ${user.token}`,
+        },
         body: JSON.stringify({ old_password: oldPass, new_password: newPass }),
       }
     );
@@ -33,7 +33,8 @@ function SignInPage({ onLogin }) {
         return;
       }
 
-      onLogin(data.user);
+      // токен подписан сервером и отправляется в Authorization
+      onLogin({ ...data.user, token: data.token });
       navigate("/user");
     } catch {
       setError(t("common.connectError"));
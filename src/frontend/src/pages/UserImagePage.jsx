@@ -68,7 +68,7 @@ function UserImagePage({ onLogout }) {
           <div className="image-placeholder">
             {img?.url ? (
               <img
-                src={img.url}
+                src={img.preview_url || img.url}
                 alt={img.title || t("common.photo")}
                 className="uploaded-image"
               />